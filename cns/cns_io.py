@@ -90,9 +90,9 @@ def table2schema(schema_excel_json, schema_urlprefix, options, schema_dir=None):
 
     #read table from excel, and convert them into mem model
     if not converter.table2mem(schema_excel_json):
-        logging.info(json4debug(converter.report.data))
+        logging.info(json4debug(converter.report.export()))
         output_json["validation_result"] = not converter.report.has_bug()
-        output_json["validation_report"] = converter.report.data
+        output_json["validation_report"] = converter.report.export()
         return output_json
 
     temp = mem4export(converter.schema, options)
@@ -162,7 +162,7 @@ def mem4export(the_schema, options):
     output_json["schema_name"] = the_schema.metadata["name"]
     output_json["schema_version"] = the_schema.metadata["version"]
     output_json["schema_identifier"] = the_schema.metadata["identifier"]
-    output_json["validation_report"] = the_schema.report.data
+    output_json["validation_report"] = the_schema.report.export()
 
     if options:
         if "dot" in options:
@@ -219,7 +219,8 @@ def _export_nquad(args, filename_output):
 def task_excel2jsonld(args):
     schema_excel_filename = args["input_file"]
     options = "jsonld,table_single,table_import,dot_compact,dot_import,dot_full,openapi"
-    output_json = excel2schema(schema_excel_filename, None, options, args.get('schema_dir'))
+    with profile_stage("excel2schema"):
+        output_json = excel2schema(schema_excel_filename, None, options, args.get('schema_dir'))
 
     #read table from excel, and convert them into mem model
     if not output_json["validation_result"]:
@@ -232,17 +233,19 @@ def task_excel2jsonld(args):
     json2file(output_json["jsonld"], filename_output)
 
     #export table and then store that in excel
-    for p in ["table_single", "table_import"]:
-        filename_output = os.path.join(args["debug_dir"], output_json["jsonld"]["identifier"]+"."+p+".xls")
-        json2excel4multiple(output_json[p], filename_output)
+    with profile_stage("write_table"):
+        for p in ["table_single", "table_import"]:
+            filename_output = os.path.join(args["debug_dir"], output_json["jsonld"]["identifier"]+"."+p+".xls")
+            json2excel4multiple(output_json[p], filename_output)
 
-        filename_output = os.path.join(args["debug_dir"], output_json["jsonld"]["identifier"]+"."+p+".json")
-        json2file(output_json[p], filename_output)
+            filename_output = os.path.join(args["debug_dir"], output_json["jsonld"]["identifier"]+"."+p+".json")
+            json2file(output_json[p], filename_output)
 
     #dot file
-    for p in ["dot_compact", "dot_full", "dot_import"]:
-        filename_output = os.path.join(args["debug_dir"], output_json["jsonld"]["identifier"]+"."+p[4:]+".dot")
-        lines2file([output_json[p]], filename_output)
+    with profile_stage("write_dot"):
+        for p in ["dot_compact", "dot_full", "dot_import"]:
+            filename_output = os.path.join(args["debug_dir"], output_json["jsonld"]["identifier"]+"."+p[4:]+".dot")
+            lines2file([output_json[p]], filename_output)
 
     #openapi yaml file
     for p in ["openapi"]:
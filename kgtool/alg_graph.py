@@ -2,6 +2,26 @@
 # -*- coding: utf-8 -*-
 # Author: Qiu Minghao
 import collections
+import logging
+import random
+import time
+
+"""
+transitive closure of a directed graph, e.g. class => all super classes
+
+compute_subtree lists for each node the nodes reachable from it in depth
+first preorder (children in arc order, first visit kept); the order is
+what index_inheritance and get_main_types rely on, self comes first
+
+ * nodes are numbered, strongly connected components are found by an
+   iterative Tarjan, which emits them sinks first
+ * a node outside a cycle merges the memoized lists of its children,
+   duplicates are skipped with a stamp array, so every node is expanded
+   once instead of once per path
+ * a node in a cycle gets its own depth first search, which splices the
+   memoized lists of nodes outside its cycle; it is not its own subtree
+"""
+
 
 class DirectedGraph:
     def __init__(self, arc_list):
@@ -19,35 +39,199 @@ class DirectedGraph:
         self.roots = node_from_list.difference( node_to_list )
         # print (self.roots)
 
-    def _dfs(self, node, path, subtree):
+    def _index(self):
         """
-            run depth first search
+            node list, and children as lists of node index
         """
-        for element in path:
-            if node not in subtree[element]:
-                subtree[element].append(node)
+        node_list = list(self.nodes)
+        node_index = dict((node, idx) for idx, node in enumerate(node_list))
+        children = [[node_index[child] for child in self.nodes[node]] for node in node_list]
+        return node_list, children
 
-        for child in self.nodes[node]:
-            if child in path:
+    def _find_scc(self, children):
+        """
+            strongly connected components, iterative Tarjan, in reverse
+            topological order (a component comes after all it can reach)
+        """
+        cnt = len(children)
+        index = [-1] * cnt
+        lowlink = [0] * cnt
+        on_stack = [False] * cnt
+        stack = []
+        ret = []
+        counter = 0
+        for start in range(cnt):
+            if index[start] >= 0:
                 continue
+            index[start] = lowlink[start] = counter
+            counter += 1
+            stack.append(start)
+            on_stack[start] = True
+            work = [(start, 0)]
+            while work:
+                node, pos = work[-1]
+                if pos < len(children[node]):
+                    work[-1] = (node, pos + 1)
+                    child = children[node][pos]
+                    if index[child] < 0:
+                        index[child] = lowlink[child] = counter
+                        counter += 1
+                        stack.append(child)
+                        on_stack[child] = True
+                        work.append((child, 0))
+                    elif on_stack[child] and index[child] < lowlink[node]:
+                        lowlink[node] = index[child]
+                    continue
+
+                work.pop()
+                if work and lowlink[node] < lowlink[work[-1][0]]:
+                    lowlink[work[-1][0]] = lowlink[node]
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        component.append(member)
+                        if member == node:
+                            break
+                    ret.append(component)
+        return ret
+
+    def _find_cycles(self, components, children):
+        """
+            components that are a cycle: more than one node, or a node
+            linked to itself
+        """
+        return [sorted(component) for component in components
+                if len(component) > 1 or component[0] in children[component[0]]]
 
-            path_child = [node]
-            path_child.extend(path)
-            self._dfs(child, path_child, subtree)
+    def find_cycles(self):
+        """
+            node lists of every cycle
+        """
+        node_list, children = self._index()
+        cycles = self._find_cycles(self._find_scc(children), children)
+        return [[node_list[idx] for idx in cycle] for cycle in cycles]
 
-    def compute_subtree(self, include_self=True):
+    def compute_subtree(self, include_self=True, allow_cycle=True):
         """
             problem is defined here
             https://www.geeksforgeeks.org/sub-tree-nodes-tree-using-dfs/
+
+            node => reachable nodes in preorder; without include_self only
+            nodes with at least one reachable node are listed. a cycle is
+            logged, or raises ValueError if allow_cycle is False
         """
-        subtree = collections.defaultdict(list)
-        # include self in subtree if required
-        if include_self:
-            for node in self.nodes:
-                subtree[node] = [node]
+        node_list, children = self._index()
+        components = self._find_scc(children)
 
-        #build subtree
-        for root in self.roots:
-           self._dfs(root, [], subtree)
+        in_cycle = [False] * len(node_list)
+        cycles = self._find_cycles(components, children)
+        for cycle in cycles:
+            for idx in cycle:
+                in_cycle[idx] = True
+        if cycles:
+            cycles = [[node_list[idx] for idx in cycle] for cycle in cycles]
+            if not allow_cycle:
+                raise ValueError(u"cycle in graph: {}".format(cycles[0]))
+            logging.warning(u"cycle in graph: {}".format(cycles))
 
+        descendants = [None] * len(node_list)
+        stamp = [-1] * len(node_list)
+        for component in components:
+            for node in component:
+                stamp[node] = node
+                ret = []
+                if in_cycle[node]:
+                    self._search_cycle(node, children, in_cycle, descendants, stamp, ret)
+                else:
+                    for child in children[node]:
+                        if stamp[child] != node:
+                            stamp[child] = node
+                            ret.append(child)
+                        for idx in descendants[child]:
+                            if stamp[idx] != node:
+                                stamp[idx] = node
+                                ret.append(idx)
+                descendants[node] = ret
+
+        subtree = collections.defaultdict(list)
+        for idx, node in enumerate(node_list):
+            if include_self:
+                subtree[node] = [node] + [node_list[x] for x in descendants[idx]]
+            elif descendants[idx]:
+                subtree[node] = [node_list[x] for x in descendants[idx]]
         return subtree
+
+    def _search_cycle(self, node, children, in_cycle, descendants, stamp, ret):
+        """
+            preorder depth first search from a node in a cycle, nodes outside
+            a cycle are already done and their lists are spliced in
+        """
+        stack = [iter(children[node])]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                continue
+            if stamp[child] == node:
+                continue
+            stamp[child] = node
+            ret.append(child)
+            if in_cycle[child]:
+                stack.append(iter(children[child]))
+            else:
+                for idx in descendants[child]:
+                    if stamp[idx] != node:
+                        stamp[idx] = node
+                        ret.append(idx)
+
+
+def gen_random_dag(cnt_node, max_parent=3, seed=0):
+    """
+        arcs node => parent of a random class hierarchy: node i links to
+        1..max_parent random nodes before it
+    """
+    rand = random.Random(seed)
+    arc_list = []
+    for node in range(1, cnt_node):
+        for parent in set(rand.randrange(node) for _ in range(rand.randint(1, max_parent))):
+            arc_list.append([node, parent])
+    return arc_list
+
+
+def task_benchmark_subtree(args):
+    """
+        compute_subtree time on random hierarchies of growing size
+    """
+    from kgtool.core import json4debug
+
+    ret = []
+    for cnt_node in [int(x) for x in (args.get("option") or "1000,10000,100000").split(",")]:
+        arc_list = gen_random_dag(cnt_node, max_parent=int(args.get("limit") or 3))
+        start = time.time()
+        subtree = DirectedGraph(arc_list).compute_subtree()
+        ret.append({
+            "nodes": cnt_node,
+            "arcs": len(arc_list),
+            "closure_size": sum(len(x) for x in subtree.values()),
+            "seconds": round(time.time() - start, 4),
+        })
+    logging.info(json4debug(ret))
+    return ret
+
+
+if __name__ == "__main__":
+    from kgtool.core import main_subtask
+
+    logging.basicConfig(format='[%(levelname)s][%(asctime)s][%(module)s][%(funcName)s][%(lineno)s] %(message)s', level=logging.INFO)
+
+    optional_params = {
+        '--option': 'comma separated node counts',
+        '--limit': 'max number of parents of a node',
+    }
+    main_subtask(__name__, optional_params=optional_params)
+
+"""
+    python kgtool/alg_graph.py task_benchmark_subtree --option=1000,10000,100000
+"""
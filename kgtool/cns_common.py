@@ -7,8 +7,13 @@
 shared code without external dependency
 """
 
+import array
 import collections
 import copy
+import numbers
+import os
+import random
+import threading
 from kgtool.core import *  # noqa
 
 
@@ -36,26 +41,396 @@ def gen_cns_id(cns_item, primary_keys=None):
         raise Exception("unexpected situation")  # unexpected situation
 
 
-class CnsBugReport():
+# xtemplate keys interned in this process, key tuple <=> integer id
+_XTEMPLATE_KEY_ID = {}
+_XTEMPLATE_KEY = []
+_XTEMPLATE_KEY_LOCK = threading.Lock()
+
+def xtemplate_key_id(key):
+    """
+        integer id of an xtemplate key tuple, the tuple of the string key,
+        e.g. ("cp", "Person", "Thing", "name") for "cp_Person_Thing_name"
+    """
+    key_id = _XTEMPLATE_KEY_ID.get(key)
+    if key_id is None:
+        # plans may be compiled in several threads, e.g. the validation server
+        with _XTEMPLATE_KEY_LOCK:
+            key_id = _XTEMPLATE_KEY_ID.get(key)
+            if key_id is None:
+                key_id = len(_XTEMPLATE_KEY)
+                _XTEMPLATE_KEY.append(key)
+                _XTEMPLATE_KEY_ID[key] = key_id
+    return key_id
+
+
+def xtemplate_key2text(key):
+    return u"_".join(key)
+
+
+class XTemplateCounter():
+    """
+        xtemplate of CnsBugReport, coverage counts by xtemplate key id (see
+        xtemplate_key_id) in an array indexed by key id, and other entries
+        by string key in extra (e.g. "parent_Person" => ancestors).
 
+        touch() returns the counts array for validation to add to by key id,
+        add_key() counts one key tuple. The array only grows up to the
+        largest key id touched. A touched key shows up with count 0.
+        to_counter() gives the string keys of report.json, e.g.
+        "cp_Person_Thing_name"; key strings are made only there.
+    """
     def __init__(self):
+        self.counts = array.array("l")
+        self.extra = {}
+        self._flag_touched = bytearray()
+        self._touched_ids = []
+        self._tokens = set()
+
+    def touch(self, key_ids, token=None):
+        """
+            touch key ids, return the counts array.
+            a token (e.g. of a validation plan) skips touching the same
+            key ids again
+        """
+        if token is not None and token in self._tokens:
+            return self.counts
+        if key_ids:
+            size = max(key_ids) + 1
+            if size > len(self.counts):
+                self.counts.extend(array.array("l", [0]) * (size - len(self.counts)))
+                self._flag_touched.extend(bytearray(size - len(self._flag_touched)))
+            flag_touched = self._flag_touched
+            for key_id in key_ids:
+                if not flag_touched[key_id]:
+                    flag_touched[key_id] = 1
+                    self._touched_ids.append(key_id)
+        if token is not None:
+            self._tokens.add(token)
+        return self.counts
+
+    def add_key(self, key, cnt=1):
+        key_id = xtemplate_key_id(key)
+        self.touch([key_id])[key_id] += cnt
+
+    def add_keys(self, key_items):
+        """
+            add [key tuple, count] pairs, e.g. from key_items()
+        """
+        key_ids = [xtemplate_key_id(tuple(key)) for key, cnt in key_items]
+        counts = self.touch(key_ids)
+        for key_id, key_cnt in zip(key_ids, key_items):
+            counts[key_id] += key_cnt[1]
+
+    def key_items(self):
+        """
+            [key tuple, count] of the touched keys
+        """
+        counts = self.counts
+        return [[_XTEMPLATE_KEY[key_id], counts[key_id]] for key_id in self._touched_ids]
+
+    def get_key(self, key, default=0):
+        key_id = _XTEMPLATE_KEY_ID.get(tuple(key))
+        if key_id is None or key_id >= len(self.counts) or not self._flag_touched[key_id]:
+            return default
+        return self.counts[key_id]
+
+    def to_counter(self):
+        """
+            collections.Counter of string keys, counts and extra entries
+        """
+        ret = collections.Counter()
+        counts = self.counts
+        for key_id in self._touched_ids:
+            ret[xtemplate_key2text(_XTEMPLATE_KEY[key_id])] += counts[key_id]
+        for key, value in self.extra.items():
+            if key in ret and isinstance(value, numbers.Number):
+                ret[key] += value
+            else:
+                ret[key] = value
+        return ret
+
+    def merge(self, other):
+        """
+            add another XTemplateCounter, or the string keys of a report
+            (numbers are added in extra, other values kept if missing)
+        """
+        if isinstance(other, XTemplateCounter):
+            self.add_keys(other.key_items())
+            items = other.extra.items()
+        else:
+            items = other.items()
+        for key, value in items:
+            if isinstance(value, numbers.Number) and not isinstance(value, bool):
+                self.extra[key] = self.extra.get(key, 0) + value
+            elif key not in self.extra:
+                self.extra[key] = value
+        return self
+
+    def __getstate__(self):
+        # key ids are interned per process, pickle the key tuples
+        return {"key_items": self.key_items(), "extra": self.extra}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.add_keys(state["key_items"])
+        self.extra = state["extra"]
+
+
+BUG_KEY_FIELDS = ["category", "description", "class", "property"]
+
+
+class CnsBugReport():
+    """
+        bugs reported by validation
+        * stats: count per bug key "category | description | class | property"
+        * bugs_sample: sample bugs per key, the bug itself when sample_size=1,
+          otherwise a list of up to sample_size bugs. sample_mode="first"
+          keeps the first ones, "reservoir" keeps a uniform random sample
+        * a sample is a snapshot through canonical json, only taken when the
+          sample is kept
+        * sample_bytes: byte budget for all stored samples, once exceeded new
+          samples only keep the bug key fields
+        * bugs: every bug when flag_detail is on; with detail_filename the
+          bugs go to that json lines file instead, call close() at the end
+        bug budgets, checked by validation to stop early (see end_item):
+        * max_bugs: stop after this many bugs
+        * max_bugs_per_category: later bugs of a category are dropped, its
+          checks are skipped (should_check is False)
+        * max_error_rate: stop when more than this fraction of the last
+          error_window items has a bug
+        * budget: stop_reason and skip_category, only with a budget
+    """
+    def __init__(self, sample_size=1, sample_mode="first", sample_bytes=None,
+                 detail_filename=None, seed=0, max_bugs=None,
+                 max_bugs_per_category=None, max_error_rate=None, error_window=1000):
+        assert sample_size >= 1
+        assert sample_mode in ["first", "reservoir"]
+        self.sample_size = sample_size
+        self.sample_mode = sample_mode
+        self.sample_bytes = sample_bytes
+        self.cnt_sample_bytes = 0
+        self.cnt_sample_truncated = 0
+        self._random = random.Random(seed)
+
+        self.detail_filename = detail_filename
+        self._detail_writer = None
+
         self.data = {   "bugs": [],
                         "bugs_sample": {},
-                        "xtemplate":collections.Counter(),
+                        "xtemplate":XTemplateCounter(),
                         "stats": collections.Counter(),
-                        "flag_detail": False }
+                        "flag_detail": bool(detail_filename) }
 
+        self.max_bugs = max_bugs
+        self.max_bugs_per_category = max_bugs_per_category
+        self.max_error_rate = max_error_rate
+        self.cnt_bug = 0
+        self.cnt_bug_category = collections.Counter()
+        self.skip_category = set()
+        self.stop_reason = None
+        self._window = collections.deque(maxlen=error_window)
+        self._cnt_window_bug = 0
+        self._cnt_bug_item = 0
+        if max_bugs or max_bugs_per_category or max_error_rate is not None:
+            self.data["budget"] = {"stop_reason": None, "skip_category": []}
+
+    def _snapshot(self, bug):
+        """
+            copy of the bug as it will be written to the report
+        """
+        try:
+            text = json_dumps(bug)
+            size = len(text)
+        except (TypeError, ValueError):
+            text = None
+            size = len(repr(bug))
+
+        if self.sample_bytes is not None and self.cnt_sample_bytes + size > self.sample_bytes:
+            if self.cnt_sample_truncated == 0:
+                logging.warning(u"bug sample budget {} bytes exceeded, keep bug key fields only".format(self.sample_bytes))
+            self.cnt_sample_truncated += 1
+            return dict([[p, bug[p]] for p in BUG_KEY_FIELDS if p in bug])
+
+        self.cnt_sample_bytes += size
+        if text is None:
+            return copy.deepcopy(bug)
+        return json_loads(text)
+
+    def get_samples(self, key):
+        sample = self.data["bugs_sample"].get(key)
+        if sample is None:
+            return []
+        elif self.sample_size == 1:
+            return [sample]
+        else:
+            return sample
+
+    def _set_samples(self, key, samples):
+        if self.sample_size == 1:
+            self.data["bugs_sample"][key] = samples[0]
+        else:
+            self.data["bugs_sample"][key] = samples
+
+    def should_check(self, category):
+        """
+            False once the budget of category is exhausted, validation
+            skips the checks of that category
+        """
+        return category not in self.skip_category
 
     def report_bug(self, bug):
-        key = r" | ".join([bug["category"], bug["description"], bug.get("class", ""), bug.get("property", "")])
+        category = bug["category"]
+        if category in self.skip_category:
+            return
+        self._count_bug(category, 1)
+
+        key = r" | ".join([category, bug["description"], bug.get("class", ""), bug.get("property", "")])
         self.data["stats"][key] += 1
-        if key not in self.data["bugs_sample"]:
-            self.data["bugs_sample"][key] = copy.deepcopy(bug)
+
+        samples = self.get_samples(key)
+        if len(samples) < self.sample_size:
+            self._set_samples(key, samples + [self._snapshot(bug)])
+        elif self.sample_mode == "reservoir":
+            # algorithm R, bug n replaces a sample with probability k/n
+            idx = self._random.randint(0, self.data["stats"][key] - 1)
+            if idx < self.sample_size:
+                samples = list(samples)
+                samples[idx] = self._snapshot(bug)
+                self._set_samples(key, samples)
 
         if self.data.get("flag_detail"):
-            msg = json.dumps(bug, ensure_ascii=False, sort_keys=True)
-            self.data["bugs"].append(bug)
+            msg = json_dumps(bug)
+            self._add_detail(bug)
             logging.info(msg)
 
+    def _count_bug(self, category, cnt):
+        self.cnt_bug += cnt
+        self.cnt_bug_category[category] += cnt
+        if self.max_bugs_per_category and self.cnt_bug_category[category] >= self.max_bugs_per_category:
+            if category not in self.skip_category:
+                logging.warning(u"bug budget of {} exhausted, skip its checks".format(category))
+                self.skip_category.add(category)
+                self.data["budget"]["skip_category"] = sorted(self.skip_category)
+        if self.max_bugs and self.cnt_bug >= self.max_bugs:
+            self.stop(u"max_bugs")
+
+    def stop(self, reason):
+        if self.stop_reason is None:
+            logging.warning(u"stop validation: {} after {} bugs".format(reason, self.cnt_bug))
+            self.stop_reason = reason
+            if "budget" in self.data:
+                self.data["budget"]["stop_reason"] = reason
+
+    def end_item(self):
+        """
+            called after each validated item, return True to stop validation
+        """
+        if self.max_error_rate is not None:
+            window = self._window
+            if len(window) == window.maxlen:
+                self._cnt_window_bug -= window[0]
+            flag_bug = 1 if self.cnt_bug > self._cnt_bug_item else 0
+            window.append(flag_bug)
+            self._cnt_window_bug += flag_bug
+            self._cnt_bug_item = self.cnt_bug
+            if len(window) == window.maxlen and self._cnt_window_bug > self.max_error_rate * window.maxlen:
+                self.stop(u"max_error_rate")
+        return self.stop_reason is not None
+
+    def _add_detail(self, bug):
+        if self.detail_filename:
+            if self._detail_writer is None:
+                self._detail_writer = ItemWriter(self.detail_filename, atomic=False)
+            self._detail_writer.write(bug)
+        else:
+            self.data["bugs"].append(bug)
+
+    def _add_detail_file(self, filename):
+        if self.detail_filename:
+            if self._detail_writer is None:
+                self._detail_writer = ItemWriter(self.detail_filename, atomic=False)
+            self._detail_writer.write_file(filename)
+        else:
+            for line in file2iter(filename):
+                self.data["bugs"].append(json_loads(line))
+
+    def close(self):
+        """
+            flush detailed bugs to detail_filename
+        """
+        if self._detail_writer is not None:
+            self._detail_writer.close()
+            self._detail_writer = None
+
+    def merge(self, other):
+        """
+            add a partial report (e.g. of one shard) into this report.
+            merging partial reports in input order gives the same data as
+            one report over the whole input: counters are added, the first
+            samples of each key are kept, detailed bugs are appended (also
+            the detail file of a closed partial report with detail_filename).
+            reservoir samples are merged by weighted sampling
+        """
+        data = other.data if isinstance(other, CnsBugReport) else other
+        stats_self = collections.Counter(self.data["stats"])
+        if isinstance(other, CnsBugReport):
+            for category, cnt in other.cnt_bug_category.items():
+                self._count_bug(category, cnt)
+            if other.stop_reason:
+                self.stop(other.stop_reason)
+        self.data["stats"].update(data["stats"])
+
+        self.data["xtemplate"].merge(data["xtemplate"])
+
+        for key, sample in data["bugs_sample"].items():
+            if isinstance(sample, list):
+                samples_other = sample
+            else:
+                samples_other = [sample]
+            samples = self.get_samples(key)
+            # merge by index, the first len(samples) are ours
+            candidates = samples + samples_other
+            index_list = list(range(len(candidates)))
+            if self.sample_mode == "reservoir":
+                index_list = self._merge_reservoir(index_list[:len(samples)], stats_self[key], index_list[len(samples):], data["stats"][key])
+            index_list = index_list[:self.sample_size]
+            if self.sample_bytes is not None:
+                # samples from the other report count against this budget too
+                samples = [candidates[idx] if idx < len(samples) else self._snapshot(candidates[idx]) for idx in index_list]
+            else:
+                samples = [candidates[idx] for idx in index_list]
+            if samples:
+                self._set_samples(key, samples)
+
+        for bug in data["bugs"]:
+            self._add_detail(bug)
+        if isinstance(other, CnsBugReport) and other.detail_filename and os.path.exists(other.detail_filename):
+            self._add_detail_file(other.detail_filename)
+        return self
+
+    def _merge_reservoir(self, samples1, cnt1, samples2, cnt2):
+        """
+            merge two uniform samples of cnt1 and cnt2 bugs
+        """
+        samples1 = list(samples1)
+        samples2 = list(samples2)
+        ret = []
+        while len(ret) < self.sample_size and (samples1 or samples2):
+            if samples1 and (not samples2 or self._random.random() * (cnt1 + cnt2) < cnt1):
+                ret.append(samples1.pop(self._random.randint(0, len(samples1) - 1)))
+                cnt1 -= 1
+            else:
+                ret.append(samples2.pop(self._random.randint(0, len(samples2) - 1)))
+                cnt2 -= 1
+        return ret
+
     def has_bug(self):
         return len(self.data["bugs_sample"]) > 0
+
+    def export(self):
+        """
+            report data made of json values, e.g. for report.json
+        """
+        ret = dict(self.data)
+        ret["xtemplate"] = self.data["xtemplate"].to_counter()
+        return ret
@@ -54,15 +54,13 @@ def run_convert(cns_model, item, types, primary_keys, report = None):
         if template:
             px = template["refProperty"]
             cns_item[px] = v
-        else:
+        elif report is not None and report.should_check("warn_convert_cns"):
             bug = {
                 "category": "warn_convert_cns",
                 "description": "property not defined in schema",
                 "property": p
             }
-
-            if report is not None:
-                report.report_bug(bug)
+            report.report_bug(bug)
 
 
     if item.get("@id"):
@@ -147,7 +145,7 @@ def task_convert(args):
         cns_item = run_convert(loaded_schema, item, types, primary_keys, report)
         logging.info(json4debug(cns_item))
         #loaded_schema.run_validate(cns_item, report)
-    logging.info(json4debug(report.data))
+    logging.info(json4debug(report.export()))
 
 
 if __name__ == "__main__":
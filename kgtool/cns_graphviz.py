@@ -20,7 +20,7 @@ import copy
 
 from kgtool.core import *  # noqa
 from kgtool.stats import stat_kg_report_per_item
-from kgtool.cns_model import preload_schema, CnsSchema, template2definition4property
+from kgtool.cns_model import preload_schema, load_schema, CnsSchema, template2definition4property
 
 # global constants
 VERSION = 'v20180724'
@@ -414,9 +414,7 @@ def task_graphviz(args):
     #logging.info( "called task_graphviz" )
 
     filename = args["input_file"]
-    the_schema = CnsSchema()
-    the_schema.preloaded_schema_list = preload_schema(args)
-    the_schema.jsonld2mem4file(filename)
+    the_schema = load_schema(filename, args.get("schema_dir"), args.get("schema_cache_dir"))
 
     #validate if we can reproduce the same jsonld based on input
     jsonld_input = file2json(filename)
@@ -435,6 +433,7 @@ if __name__ == "__main__":
     optional_params = {
         '--input_file': 'input file',
         '--schema_dir': 'input schema',
+        '--schema_cache_dir': 'directory of built schema snapshots',
         '--output_file': 'output file',
         '--debug_dir': 'debug directory',
         '--option': 'debug directory',
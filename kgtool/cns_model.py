@@ -4,6 +4,10 @@
 
 import copy
 import glob
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 from difflib import unified_diff
 import urllib
 
@@ -30,23 +34,330 @@ cnSchema data loader
 
 
 
-def preload_schema(args=None):
-    schema_dir = args.get("schema_dir")
+def _preload_schema_dir(schema_dir):
     if not schema_dir:
         schema_dir = "cnschema"
+    return schema_dir
+
+
+def _read_schema_header(filename):
+    """
+        identifier and import of a schema file without decoding @graph:
+        top level keys are found by the indentation of the first key and
+        only their values are decoded; other layouts are parsed in full
+    """
+    with file2open(filename, "r", encoding="utf-8") as f:
+        text = f.read()
+
+    ret = None
+    match = re.match(r'\s*\{[ \t]*\r?\n([ \t]*)"', text)
+    if match:
+        decoder = json.JSONDecoder()
+        ret = {}
+        for key in ["identifier", "import"]:
+            match_key = re.search(u'\\n{}"{}"\\s*:\\s*'.format(match.group(1), key), text)
+            if match_key:
+                ret[key] = decoder.raw_decode(text, match_key.end())[0]
+    if not ret or not ret.get("identifier"):
+        jsonld = json_loads(text)
+        ret = {"identifier": jsonld.get("identifier"), "import": jsonld.get("import")}
+
+    schema_import = ret.get("import") or []
+    if not isinstance(schema_import, list):
+        schema_import = [schema_import]
+    return {"identifier": ret["identifier"], "import": schema_import}
+
+
+class CnsSchemaRegistry():
+    """
+        schemas of a schema dir, loaded on demand
+        * scan reads only the header (identifier, import) of each *.jsonld
+        * load builds a schema after the transitive closure of its imports,
+          each schema is built once and shared via preloaded_schema_list
+        * refresh drops everything built when a file is added, removed or
+          changed (size/mtime)
+    """
+    def __init__(self, schema_dir):
+        self.schema_dir = schema_dir
+        self.headers = {}
+        self.preloaded_schema_list = {}
+        self._file_stat = None
+        self._lock = threading.RLock()
+
+    def _get_file_stat(self):
+        ret = {}
+        for filename in glob.glob(u"{}/*.jsonld".format(self.schema_dir)):
+            stat = os.stat(filename)
+            ret[os.path.abspath(filename)] = (stat.st_size, stat.st_mtime)
+        return ret
+
+    def refresh(self):
+        with self._lock:
+            file_stat = self._get_file_stat()
+            if file_stat == self._file_stat:
+                return False
+            headers = {}
+            for filename in sorted(file_stat):
+                header = _read_schema_header(filename)
+                header["filename"] = filename
+                headers[header["identifier"]] = header
+            self.headers = headers
+            self.preloaded_schema_list = {}
+            self._file_stat = file_stat
+            return True
+
+    def get_import_closure(self, schema_identifier):
+        """
+            imports of the schema, transitive, dependencies first, self last;
+            imports outside the schema dir are left to CnsSchema.load_jsonld
+        """
+        ret = []
+        visiting = set()
+        visited = set()
+
+        def _visit(xid, path):
+            if xid in visited:
+                return
+            if xid in visiting:
+                raise Exception(u"schema import cycle {}".format(u" > ".join(path + [xid])))
+            visiting.add(xid)
+            for xid_import in self.headers[xid]["import"]:
+                if xid_import in self.headers:
+                    _visit(xid_import, path + [xid])
+            visiting.discard(xid)
+            visited.add(xid)
+            ret.append(xid)
+
+        _visit(schema_identifier, [])
+        return ret
 
-    filename_list = glob.glob(u"{}/*.jsonld".format(schema_dir))
+    def load(self, schema_identifier):
+        with self._lock:
+            for xid in self.get_import_closure(schema_identifier):
+                if xid not in self.preloaded_schema_list:
+                    self.preloaded_schema_list[xid] = self._build(self.headers[xid]["filename"])
+                    logging.info("loaded {}".format(xid))
+            return self.preloaded_schema_list[schema_identifier]
 
-    for filename in filename_list:
+    def _build(self, filename):
         loaded_schema = CnsSchema()
+        loaded_schema.schema_dir = self.schema_dir
+        loaded_schema.preloaded_schema_list = self.preloaded_schema_list
         loaded_schema.jsonld2mem4file(filename)
-        schema_identifier = loaded_schema.metadata["identifier"]
-        #logging.info(json4debug(loaded_schema.metadata))
-        loaded_schema.preloaded_schema_list[schema_identifier] = loaded_schema
-        logging.info("loaded {}".format(schema_identifier))
+        return loaded_schema
+
+    def load_file(self, filename):
+        """
+            the schema of a file, the shared one if the file is in the schema
+            dir, otherwise a new one built on the schemas it imports
+        """
+        with self._lock:
+            self.refresh()
+            header = _read_schema_header(filename)
+            registered = self.headers.get(header["identifier"])
+            if registered and registered["filename"] == os.path.abspath(filename):
+                return self.load(header["identifier"])
+
+            for xid in header["import"]:
+                if xid in self.headers:
+                    self.load(xid)
+            return self._build(filename)
+
+    def load_all(self):
+        with self._lock:
+            self.refresh()
+            for xid in sorted(self.headers):
+                self.load(xid)
+            return self.preloaded_schema_list
+
+
+# CnsSchemaRegistry of this process, keyed by schema dir
+_SCHEMA_REGISTRY = {}
+
+
+def get_schema_registry(schema_dir=None):
+    schema_dir = _preload_schema_dir(schema_dir)
+    key = os.path.abspath(schema_dir)
+    registry = _SCHEMA_REGISTRY.get(key)
+    if registry is None:
+        registry = CnsSchemaRegistry(schema_dir)
+        _SCHEMA_REGISTRY[key] = registry
+    registry.refresh()
+    return registry
+
+
+def preload_schema(args=None):
+    """
+        all schemas in schema_dir, identifier => CnsSchema; prefer
+        load_schema, which builds only the imports of the schema
+    """
+    schema_dir = _preload_schema_dir(args.get("schema_dir"))
+    if args.get("schema_cache_dir"):
+        return _load_snapshot(args["schema_cache_dir"], None, schema_dir)
+
+    ret = get_schema_registry(schema_dir).load_all()
+    logging.info(len(ret))
+    return ret
+
+
+def load_schema(schema_filename, schema_dir=None, cache_dir=None):
+    """
+        load schema_filename and the schemas it imports from schema_dir
+        (built once per process); with cache_dir, reuse a snapshot of the
+        built schema
+    """
+    if cache_dir:
+        return _load_snapshot(cache_dir, schema_filename, schema_dir)
 
-    logging.info(len(loaded_schema.preloaded_schema_list))
-    return loaded_schema.preloaded_schema_list
+    return get_schema_registry(schema_dir).load_file(schema_filename)
+
+
+"""
+schema snapshot: pickle of built CnsSchema objects (definitions and all
+indexes), saved in cache_dir as {key}.pickle
+ * key: snapshot format, VERSION, python major version, schema_filename
+   and schema_dir, so python2 and python3 keep separate snapshots
+ * sources: sha256 of every file the build read (schema_filename,
+   schema_dir/*.jsonld, imported schemas loaded on demand); the snapshot is
+   used only if all of them are unchanged and no file was added to
+   schema_dir, otherwise the schema is built again and the snapshot replaced
+"""
+
+SCHEMA_SNAPSHOT_FORMAT = 2
+
+
+def _file2sha256(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _find_schema_file(schema_identifier, schema_dir):
+    """
+        file of an imported schema, same search as CnsSchema.load_jsonld
+    """
+    for dirname in [schema_dir, "schema", "local/schema"]:
+        if dirname:
+            filename = "{}/{}.jsonld".format(dirname, schema_identifier)
+            if os.path.exists(filename):
+                return os.path.abspath(filename)
+    return None
+
+
+def _iter_schema_graph(schema_list):
+    """
+        all CnsSchema reachable via preloaded_schema_list and imported_schema
+    """
+    visited = set()
+    stack = list(schema_list)
+    while stack:
+        schema = stack.pop()
+        if id(schema) in visited:
+            continue
+        visited.add(id(schema))
+        yield schema
+        stack.extend(schema.preloaded_schema_list.values())
+        stack.extend(schema.imported_schema)
+
+
+def _schema_sources(schema_filename, schema_dir, schema_list=None):
+    """
+        [filenames, imports] of the schema files read by the build; imported
+        schemas are taken from the built schema_list
+    """
+    filenames = set(os.path.abspath(x) for x in glob.glob(u"{}/*.jsonld".format(schema_dir)))
+    if schema_filename:
+        filenames.add(os.path.abspath(schema_filename))
+    imports = {}
+    for schema in _iter_schema_graph(schema_list or []):
+        for schema_identifier in schema.metadata.get("import", []):
+            filename = _find_schema_file(schema_identifier, schema.schema_dir)
+            imports[schema_identifier] = [schema.schema_dir, filename]
+            if filename:
+                filenames.add(filename)
+    return [filenames, imports]
+
+
+def schema_source_files(schema_filename, schema_dir=None, loaded_schema=None):
+    """
+        files the schema was built from: schema_filename, the schema dir and
+        the schemas loaded_schema imports, e.g. to watch for changes
+    """
+    schema_list = [loaded_schema] if loaded_schema is not None else None
+    filenames, imports = _schema_sources(schema_filename, _preload_schema_dir(schema_dir), schema_list)
+    return sorted(filenames)
+
+
+def _snapshot_sources(schema_filename, schema_dir, schema_list=None):
+    """
+        [filename, sha256] of the schema files read by the build
+    """
+    filenames, imports = _schema_sources(schema_filename, schema_dir, schema_list)
+    return {
+        "files": sorted([filename, _file2sha256(filename)] for filename in filenames),
+        "imports": imports,
+    }
+
+
+def _snapshot_valid(snapshot, schema_dir):
+    sources = snapshot["sources"]
+    files = dict(sources["files"])
+    filenames = set(os.path.abspath(x) for x in glob.glob(u"{}/*.jsonld".format(schema_dir)))
+    if not filenames.issubset(files):
+        return False
+    # imports must resolve to the same files, e.g. after a cwd change
+    for schema_identifier, (import_dir, filename) in sources["imports"].items():
+        if _find_schema_file(schema_identifier, import_dir) != filename:
+            return False
+    for filename, sha256 in files.items():
+        if not os.path.exists(filename) or _file2sha256(filename) != sha256:
+            return False
+    return True
+
+
+def _load_snapshot(cache_dir, schema_filename, schema_dir):
+    """
+        the built schema (or preloaded schema list if schema_filename is
+        None) from the snapshot in cache_dir, build and save it on a miss
+    """
+    schema_dir = _preload_schema_dir(schema_dir)
+    key = json.dumps([
+        SCHEMA_SNAPSHOT_FORMAT, VERSION, sys.version_info[0],
+        os.path.abspath(schema_filename) if schema_filename else None,
+        os.path.abspath(schema_dir)])
+    filename = os.path.join(cache_dir, u"{}.pickle".format(hashlib.sha1(key.encode("utf-8")).hexdigest()))
+
+    if os.path.exists(filename):
+        try:
+            with open(filename, "rb") as f:
+                snapshot = pickle.load(f)
+            if snapshot.get("key") == key and _snapshot_valid(snapshot, schema_dir):
+                logging.info(u"loaded schema snapshot {}".format(filename))
+                return snapshot["schema"]
+        except Exception:
+            logging.exception(u"failed to load schema snapshot {}".format(filename))
+        logging.info(u"stale schema snapshot {}".format(filename))
+
+    if schema_filename:
+        schema = load_schema(schema_filename, schema_dir)
+        schema_list = [schema]
+    else:
+        schema = preload_schema({"schema_dir": schema_dir})
+        schema_list = schema.values()
+    snapshot = {
+        "key": key,
+        "sources": _snapshot_sources(schema_filename, schema_dir, schema_list),
+        "schema": schema,
+    }
+
+    # write to a temp file first, never leave a broken snapshot behind
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    filename_temp = u"{}.tmp{}".format(filename, os.getpid())
+    with open(filename_temp, "wb") as f:
+        pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename_temp, filename)
+    logging.info(u"saved schema snapshot {}".format(filename))
+    return schema
 
 
 def _extract_alias_list(cns_item):
@@ -57,6 +368,25 @@ def _extract_alias_list(cns_item):
     return sorted(list(set(ret)))
 
 
+def _extract_template_alias_list(template):
+    alias_list = []
+    alias_list.extend( json_get_list(template, "propertyAlternateName"))
+    alias = template.get("propertyNameZh")
+    if alias:
+        alias_list.append( alias )
+    alias = template.get("refProperty")
+    if alias:
+        alias_list.append( alias )
+    return alias_list
+
+
+def _inheritance_property(cns_item):
+    if "CnsProperty" in cns_item["@type"]:
+        return "rdfs:subPropertyOf"
+    else:
+        return "rdfs:subClassOf"
+
+
 def gen_range_validation_config(range_text, schema):
     temp = {"text": range_text, "python_type_value_list": [], "cns_range_entity": [], "cns_range_datastructure": []}
     for r in parse_list_value(range_text):
@@ -67,7 +397,7 @@ def gen_range_validation_config(range_text, schema):
         elif range_text.lower() in ["float"]:
             temp["python_type_value_list"].append(float)
             temp["python_type_value_list"].append(int)
-        elif "CnsDataStructure" in schema.index_inheritance["rdfs:subClassOf"].get(r, []):
+        elif schema.is_subclass(r, "CnsDataStructure"):
             temp["cns_range_datastructure"].append(range_text)
         else:
             temp["cns_range_entity"].append(range_text)
@@ -75,6 +405,19 @@ def gen_range_validation_config(range_text, schema):
     return temp
 
 
+VALIDATION_PLAN_CACHE_SIZE = 10000
+
+INHERITANCE_PROPERTY_LIST = ["rdfs:subClassOf", "rdfs:subPropertyOf"]
+
+# system alias => name, always in index_definition_alias
+SYSTEM_DEFINITION_ALIAS = collections.OrderedDict([
+    ["rdfs:domain", "domain"],
+    ["rdfs:range", "range"],
+    ["rdfs:subClassOf", "subClassOf"],
+    ["rdfs:subPropertyOf", "subPropertyOf"],
+])
+
+
 class CnsSchema:
     def __init__(self):
         self.report = CnsBugReport()
@@ -102,6 +445,10 @@ class CnsSchema:
         # index: 定义名称映射表  defintion alias => definition（property/class）
         self.index_definition_alias = {}
 
+        # index: alias => (definition, statedIn), first hit of alias in
+        # imported schemas (in self.imported_schema order), read only
+        self.index_imported_alias = {}
+
         # index: VALIDATION  class => template Object
         self.index_validate_template = collections.defaultdict(dict)
 
@@ -114,6 +461,24 @@ class CnsSchema:
         # index: subclass/subproperty inheritance  class/property to all its super ones
         self.index_inheritance = collections.defaultdict(dict)
 
+        # index: class => bit mask, class => bitset of itself and its super classes
+        self.index_class_mask = {}
+        self.index_class_ancestor_bits = {}
+
+        # cache: VALIDATION  @type tuple => compiled validation plan, see cns_validate
+        self.cache_validation_plan = LruCache(VALIDATION_PLAN_CACHE_SIZE)
+
+    def __getstate__(self):
+        # validation plans hold xtemplate key ids interned in this process
+        state = self.__dict__.copy()
+        state["index_imported_alias"] = dict(self.index_imported_alias)
+        del state["cache_validation_plan"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.index_imported_alias = frozen_dict(self.index_imported_alias)
+        self.cache_validation_plan = LruCache(VALIDATION_PLAN_CACHE_SIZE)
 
     def set_definition(self, item):
         assert "@id" in item
@@ -158,11 +523,14 @@ class CnsSchema:
             assert False # neither URL or local schema dir supplied
 
     def build(self):
+        self.cache_validation_plan.clear()
 
         self._complete_imported_schema_list()
 
         self._build_index_definition_alias()
+        self._build_index_imported_alias()
         self._build_index_inheritance()
+        self._build_index_class_reachability()
 
         self._complete_template_definition_reference()
 
@@ -206,9 +574,10 @@ class CnsSchema:
             # self depends on schema_identifier
             self._schema_dependency.add((self_id, schema_identifier))
 
-        # compute full imported schemas
+        # compute full imported schemas, sorted pairs give the same order in
+        # every run (set order depends on the string hash seed)
         if self._schema_dependency:
-            dg = DirectedGraph(self._schema_dependency)
+            dg = DirectedGraph(sorted(self._schema_dependency))
             st = dg.compute_subtree(include_self=False)
             assert self_id in st
             self.imported_schema = list(reversed([self.preloaded_schema_list[s] for s in st[self_id]]))
@@ -258,20 +627,36 @@ class CnsSchema:
         return sorted(list(set(ret)))
 
     def get_super_class(self, xtype):
+        return self.ancestors(xtype)
+
+    def ancestors(self, xtype):
+        """
+            xtype and all its super classes in preorder, None if undefined
+        """
         return self.index_inheritance["rdfs:subClassOf"].get(xtype)
 
+    def is_subclass(self, xtype, super_type):
+        """
+            xtype is super_type or a sub class of it
+        """
+        return bool(self.index_class_ancestor_bits.get(xtype, 0) & self.index_class_mask.get(super_type, 0))
+
+    def most_specific(self, types):
+        """
+            types that are not a super class of another type in types
+        """
+        parents = 0
+        for xtype in types:
+            bits = self.index_class_ancestor_bits.get(xtype)
+            if bits:
+                parents |= bits & ~self.index_class_mask[xtype]
+        return set(xtype for xtype in types if not parents & self.index_class_mask.get(xtype, 0))
+
     def get_main_types(self, types):
-        parents = set()
         for xtype in types:
-            ret = self.index_inheritance["rdfs:subClassOf"].get(xtype)
-            if ret:
-                parents.update(ret[1:])
-            elif xtype.startswith("rdf"):
-                pass
-            else:
+            if xtype not in self.index_class_mask and not xtype.startswith("rdf"):
                 logging.warn(xtype)
-        ret = set(types).difference(parents)
-        return ret
+        return self.most_specific(types)
 
     def get_best_template(self, types, p):
         for xtype in types:
@@ -293,16 +678,23 @@ class CnsSchema:
 
         return None
 
-    def _build_index_inheritance(self):
-        # list all direct class hierarchy pairs
-        plist = ["rdfs:subClassOf", "rdfs:subPropertyOf"]
+    def _collect_inheritance_arcs(self):
+        """
+            all direct class/property hierarchy pairs [sub, super] of the
+            imported schemas
+        """
         direct_sub = collections.defaultdict(list)
         for schema in self.imported_schema:
             for cns_item in schema.definition.values():
-                for p in plist:
+                for p in INHERITANCE_PROPERTY_LIST:
                     if p in cns_item:
                         for v in cns_item[p]:
                             direct_sub[p].append([cns_item["name"], v])
+        return direct_sub
+
+    def _build_index_inheritance(self):
+        # list all direct class hierarchy pairs
+        direct_sub = self._collect_inheritance_arcs()
 
         # logging.info(json4debug(direct_sub))
 
@@ -315,16 +707,27 @@ class CnsSchema:
         # complete with all definition
         for schema in self.imported_schema:
             for cns_item in schema.definition.values():
-                if "CnsProperty" in cns_item["@type"]:
-                    p = "rdfs:subPropertyOf"
-                else:
-                    p = "rdfs:subClassOf"
+                p = _inheritance_property(cns_item)
                 n = cns_item["name"]
                 if n not in self.index_inheritance[p]:
                     self.index_inheritance[p][n] = [n]
 
         # logging.info( json4debug(self.index_inheritance ))
 
+    def _build_index_class_reachability(self):
+        """
+            one bit per class; the bitset of a class has its own bit and the
+            bits of all its super classes, a subclass test is one AND
+        """
+        inheritance = self.index_inheritance["rdfs:subClassOf"]
+        self.index_class_mask = dict((xtype, 1 << idx) for idx, xtype in enumerate(inheritance))
+        self.index_class_ancestor_bits = {}
+        for xtype, ancestors in inheritance.items():
+            bits = 0
+            for ancestor in ancestors:
+                bits |= self.index_class_mask[ancestor]
+            self.index_class_ancestor_bits[xtype] = bits
+
     # def _build_index_range(self):
     #     # reset
     #     self.index_validate_range = {}
@@ -412,46 +815,52 @@ class CnsSchema:
         # build
         for schema in self.imported_schema:
             for template in schema.metadata["template"]:
-                class_definition = self.get_definition_by_alias(template["refClass"])
-                if not class_definition:
-                    bug = {
-                        "category" : "error_template_class_reference_undefined",
-                        "description" : "template refClass={} refProperty={}, missing class definition".format(template["refClass"], template["refProperty"]),
-                        "value": template
-                    }
-                    self.report.report_bug( bug)
-                    #logging.info(len(self.index_definition_alias))
-                    #logging.info(json4debug(bug))
-                    #assert False
-                    continue
+                self._complete_template(template)
 
-                #if template.get("propertyRange"):
-                if not template.get("propertySchema"):
-                    continue
+    def _complete_template(self, template):
+        """
+            fill missing property range/name of a property template from the
+            property definition
+        """
+        class_definition = self.get_definition_by_alias(template["refClass"])
+        if not class_definition:
+            bug = {
+                "category" : "error_template_class_reference_undefined",
+                "description" : "template refClass={} refProperty={}, missing class definition".format(template["refClass"], template["refProperty"]),
+                "value": template
+            }
+            self.report.report_bug( bug)
+            #logging.info(len(self.index_definition_alias))
+            #logging.info(json4debug(bug))
+            #assert False
+            return
 
-                #logging.info(template["name"])
+        #if template.get("propertyRange"):
+        if not template.get("propertySchema"):
+            return
 
-                property_definition = self.get_definition_by_alias(template["refProperty"])
-                if not property_definition:
-                    bug = {
-                        "category" : "error_template_property_reference_undefined",
-                        "description" : "template refClass={} refProperty={}, missing property definition".format(template["refClass"], template["refProperty"]),
-                        "value": template
-                    }
-                    self.report.report_bug( bug)
-                    continue
+        #logging.info(template["name"])
 
-                p = "propertyRange"
-                if not template.get(p):
-                    template[p] = property_definition["range"]
-                p = "propertyNameZh"
-                if not template.get(p):
-                    template["propertyNameZh"] = property_definition["nameZh"]
-                p = "propertyAlternateName"
-                if not template.get(p):
-                    template["propertyAlternateName"] = property_definition.get("alternateName",[])
-            #   template["category"] = "property-template"
+        property_definition = self.get_definition_by_alias(template["refProperty"])
+        if not property_definition:
+            bug = {
+                "category" : "error_template_property_reference_undefined",
+                "description" : "template refClass={} refProperty={}, missing property definition".format(template["refClass"], template["refProperty"]),
+                "value": template
+            }
+            self.report.report_bug( bug)
+            return
 
+        p = "propertyRange"
+        if not template.get(p):
+            template[p] = property_definition["range"]
+        p = "propertyNameZh"
+        if not template.get(p):
+            template["propertyNameZh"] = property_definition["nameZh"]
+        p = "propertyAlternateName"
+        if not template.get(p):
+            template["propertyAlternateName"] = property_definition.get("alternateName",[])
+    #   template["category"] = "property-template"
 
 
     def _build_index_template(self):
@@ -462,69 +871,71 @@ class CnsSchema:
         # build
         for schema in self.imported_schema:
             for template in schema.metadata["template"]:
-                # clean min/max cardinality
-
-                p = "minCardinality"
-                if p not in template or template[p] in ["",0,"0"]:
-                    template[p] = 0
-                elif template[p] in [0, 1, "0","1"]:
-                    template[p] = int(template[p])
-                elif isinstance(template[p], float):
-                    template[p] = int(template[p])
-                else:
-                    bug = {
-                        "category" : "warn_template_unexpected_value",
-                        "description" : "template has unexpected value,  {}={}".format(p, template[p]),
-                        "value": template
-                    }
-                    self.report.report_bug( bug)
-                    assert template[p] in [0, 1], template
-
-
-                p = "maxCardinality"
-                if p not in template:
-                    pass
-                elif template[p] in [1, "1"]:
-                    template[p] = int(template[p])
-                elif isinstance(template[p], float):
-                    template[p] = int(template[p])
-                elif template[p] == "":
-                    del template[p]
-                else:
-                    bug = {
-                        "category" : "warn_template_unexpected_value_{}".format(p),
-                        "description" : "template has unexpected value, {}={}".format(p, template[p]),
-                        "value": template
-                    }
-                    self.report.report_bug( bug)
-                    assert False, template
+                self._clean_template(template)
 
                 # build index for validation
-                template_validation = copy.deepcopy(template)
-                p = "propertyRange"
-                if template.get(p):
-                    template_validation[p] = gen_range_validation_config(template.get(p), self)
-
+                template_validation = self._gen_template_validation(template)
+                if template_validation:
                     d = template["refClass"]
                     rp = template["refProperty"]
                     self.index_validate_template[d][rp] = template_validation
 
+    def _clean_template(self, template):
+        """
+            clean min/max cardinality
+        """
+        p = "minCardinality"
+        if p not in template or template[p] in ["",0,"0"]:
+            template[p] = 0
+        elif template[p] in [0, 1, "0","1"]:
+            template[p] = int(template[p])
+        elif isinstance(template[p], float):
+            template[p] = int(template[p])
+        else:
+            bug = {
+                "category" : "warn_template_unexpected_value",
+                "description" : "template has unexpected value,  {}={}".format(p, template[p]),
+                "value": template
+            }
+            self.report.report_bug( bug)
+            assert template[p] in [0, 1], template
+
+
+        p = "maxCardinality"
+        if p not in template:
+            pass
+        elif template[p] in [1, "1"]:
+            template[p] = int(template[p])
+        elif isinstance(template[p], float):
+            template[p] = int(template[p])
+        elif template[p] == "":
+            del template[p]
+        else:
+            bug = {
+                "category" : "warn_template_unexpected_value_{}".format(p),
+                "description" : "template has unexpected value, {}={}".format(p, template[p]),
+                "value": template
+            }
+            self.report.report_bug( bug)
+            assert False, template
+
+    def _gen_template_validation(self, template):
+        """
+            validation config of a template, None if it has no property range
+        """
+        p = "propertyRange"
+        if template.get(p):
+            template_validation = copy.deepcopy(template)
+            template_validation[p] = gen_range_validation_config(template.get(p), self)
+            return template_validation
+
     def _build_index_property_alias(self):
         self.index_property_alias = collections.defaultdict(dict)
 
         # build alias
         for schema in self.imported_schema:
             for template in schema.metadata["template"]:
-                alias_list = []
-                alias_list.extend( json_get_list(template, "propertyAlternateName"))
-                alias = template.get("propertyNameZh")
-                if alias:
-                    alias_list.append( alias )
-                alias = template.get("refProperty")
-                if alias:
-                    alias_list.append( alias )
-
-                for alias in alias_list:
+                for alias in _extract_template_alias_list(template):
                     self.index_property_alias[alias][template["name"]] = template
 
         # validate
@@ -548,38 +959,17 @@ class CnsSchema:
         # collect alias from definition
         for schema in self.imported_schema:
             for cns_item in schema.definition.values():
-                # cns_item["statedIn"] = schema.metadata["name"]
-                cns_item["statedIn"] = schema.metadata["name"]
-
-                if "cns_schemaorg" == schema.metadata["name"]:
-                    if cns_item["@id"] in self.imported_schema[0].definition:
-                        # if definition is defined in cns_top, then
-                        # skip schemaorg's defintion
-                        continue
-
-                for alias in _extract_alias_list(cns_item):
+                for alias in self._extract_definition_alias_list(schema, cns_item):
                     map_name_item[alias].append(cns_item)
 
         # validate
         for alias, v in map_name_item.items():
-            if len(v) > 1:
-                #logging.info(json4debug(v))
-                bug = {
-                    "category": "error_definition_duplicated_name",
-                    "description": u"found alias=[{}] associated with more than one definitions [{}]".format(
-                        alias, u", ".join([x["name"] for x in v])),
-                    "value": v
-
-                }
-                self.report.report_bug( bug)
-                # assert len(v) == 1, alias
+            self._report_duplicated_alias(alias, v)
             self.index_definition_alias[alias] = v[0]
 
         # add system
-        self.index_definition_alias["rdfs:domain"] = {"name": "domain"}
-        self.index_definition_alias["rdfs:range"] = {"name": "range"}
-        self.index_definition_alias["rdfs:subClassOf"] = {"name": "subClassOf"}
-        self.index_definition_alias["rdfs:subPropertyOf"] = {"name": "subPropertyOf"}
+        for alias, name in SYSTEM_DEFINITION_ALIAS.items():
+            self.index_definition_alias[alias] = {"name": name}
     #    self.index_definition_alias["rdf:Property"] = {"name": "Property"}
     #    self.index_definition_alias["rdfs:Class"] = {"name": "Class"}
         # self.index_definition_alias["@graph"] = {"name":"subPropertyOf"}
@@ -589,6 +979,341 @@ class CnsSchema:
         # assert len(self.index_definition_alias)>4
 
 
+    def _extract_definition_alias_list(self, schema, cns_item):
+        """
+            alias of a definition of an imported schema, also sets statedIn
+        """
+        # cns_item["statedIn"] = schema.metadata["name"]
+        cns_item["statedIn"] = schema.metadata["name"]
+
+        if "cns_schemaorg" == schema.metadata["name"]:
+            if cns_item["@id"] in self.imported_schema[0].definition:
+                # if definition is defined in cns_top, then
+                # skip schemaorg's defintion
+                return []
+
+        return _extract_alias_list(cns_item)
+
+    def _report_duplicated_alias(self, alias, v):
+        if len(v) > 1:
+            #logging.info(json4debug(v))
+            bug = {
+                "category": "error_definition_duplicated_name",
+                "description": u"found alias=[{}] associated with more than one definitions [{}]".format(
+                    alias, u", ".join([x["name"] for x in v])),
+                "value": v
+
+            }
+            self.report.report_bug( bug)
+            # assert len(v) == 1, alias
+
+    def _build_index_imported_alias(self):
+        """
+            merge the alias index of every imported schema, keep the first
+            hit, so each schema's own precedence (e.g. cns_top over
+            cns_schemaorg) still applies
+        """
+        index = {}
+        for schema in self.imported_schema:
+            for alias, definition in schema.index_definition_alias.items():
+                if alias not in index:
+                    index[alias] = (definition, definition.get("statedIn"))
+        self.index_imported_alias = frozen_dict(index)
+
+    def resolve_alias(self, alias):
+        """
+            (definition, statedIn) of alias defined in any imported schema, or None
+        """
+        return self.index_imported_alias.get(alias)
+
+    def upsert_definition(self, item):
+        """
+            add or replace (by @id) a definition of this schema and patch the
+            affected index entries, without a full build
+        """
+        assert "@id" in item
+        self._update_definition(self.definition.get(item["@id"]), item)
+
+    def remove_definition(self, xid):
+        """
+            remove a definition of this schema and patch the affected index
+            entries, return the removed definition or None
+        """
+        cns_item = self.definition.get(xid)
+        if cns_item is not None:
+            self._update_definition(cns_item, None)
+        return cns_item
+
+    def upsert_template(self, template):
+        """
+            add or replace (by name) a template of this schema and patch the
+            affected index entries, without a full build
+        """
+        assert "name" in template
+        template_list = self.metadata["template"]
+        for idx, template_old in enumerate(template_list):
+            if template_old["name"] == template["name"]:
+                template_list[idx] = template
+                break
+        else:
+            template_old = None
+            template_list.append(template)
+
+        self._complete_template(template)
+        self._clean_template(template)
+        self._update_template([template_old, template])
+
+    def remove_template(self, name):
+        """
+            remove a template of this schema, return the removed template or None
+        """
+        template_list = self.metadata["template"]
+        for idx, template in enumerate(template_list):
+            if template["name"] == name:
+                del template_list[idx]
+                self._update_template([template])
+                return template
+
+    def _update_definition(self, item_old, item):
+        """
+            patch definition alias, inheritance and template indexes after
+            item_old (None if added) was replaced by item (None if removed)
+        """
+        changed = [x for x in [item_old, item] if x is not None]
+        if item is None:
+            del self.definition[item_old["@id"]]
+        else:
+            self.set_definition(item)
+
+        alias_set = set()
+        for cns_item in changed:
+            alias_set.update(_extract_alias_list(cns_item))
+        self._update_index_definition_alias(alias_set)
+
+        class_set = self._update_index_inheritance(changed)
+
+        # templates whose reference or range class changed
+        template_list = []
+        for schema in self.imported_schema:
+            for template in schema.metadata["template"]:
+                if template["refClass"] in alias_set or template["refProperty"] in alias_set:
+                    template_list.append(template)
+                elif class_set.intersection(parse_list_value(template.get("propertyRange") or "")):
+                    template_list.append(template)
+
+        alias_list = []
+        for template in template_list:
+            alias_list.extend(_extract_template_alias_list(template))
+            self._complete_template(template)
+        self._update_template(template_list, alias_list)
+
+    def _update_index_definition_alias(self, alias_set):
+        """
+            recompute alias entries of this schema, an alias defined by an
+            imported schema keeps its definition, as it comes first
+        """
+        self_name = self.metadata["name"]
+        alias_set = alias_set.difference(SYSTEM_DEFINITION_ALIAS)
+        map_name_item = collections.defaultdict(list)
+        for cns_item in self.definition.values():
+            for alias in self._extract_definition_alias_list(self, cns_item):
+                if alias in alias_set:
+                    map_name_item[alias].append(cns_item)
+
+        index_imported_alias = dict(self.index_imported_alias)
+        for alias in alias_set:
+            v = map_name_item[alias]
+            definition = self.index_definition_alias.get(alias)
+            if definition is not None and definition.get("statedIn") != self_name:
+                v.insert(0, definition)
+            self._report_duplicated_alias(alias, v)
+            if v:
+                self.index_definition_alias[alias] = v[0]
+            else:
+                self.index_definition_alias.pop(alias, None)
+
+            index_imported_alias.pop(alias, None)
+            for schema in self.imported_schema:
+                definition = schema.index_definition_alias.get(alias)
+                if definition is not None:
+                    index_imported_alias[alias] = (definition, definition.get("statedIn"))
+                    break
+        self.index_imported_alias = frozen_dict(index_imported_alias)
+
+    def _update_index_inheritance(self, changed):
+        """
+            recompute the inheritance of the changed definitions and of all
+            their sub classes/properties, return the classes whose super
+            classes changed
+        """
+        direct_sub = self._collect_inheritance_arcs()
+        direct_super = collections.defaultdict(lambda: collections.defaultdict(list))
+        node_set = collections.defaultdict(set)
+        for p in direct_sub:
+            for n, v in direct_sub[p]:
+                direct_super[p][n].append(v)
+                node_set[p].update([n, v])
+        for schema in self.imported_schema:
+            for cns_item in schema.definition.values():
+                node_set[_inheritance_property(cns_item)].add(cns_item["name"])
+
+        class_set = set()
+        for p in INHERITANCE_PROPERTY_LIST:
+            inheritance = self.index_inheritance[p]
+            name_set = set()
+            touched = set()
+            for cns_item in changed:
+                name_set.add(cns_item["name"])
+                touched.update(cns_item.get(p, []))
+            touched.update(name_set)
+
+            # names whose list has a changed name, the changed names included
+            affected = set(n for n, ancestors in inheritance.items() if name_set.intersection(ancestors))
+            affected.update(name_set)
+            removed = set(n for n in touched if n not in node_set[p])
+            affected.difference_update(removed)
+
+            update = {}
+            try:
+                for n in affected:
+                    self._merge_inheritance(n, direct_super[p], inheritance, affected, update, [])
+            except ValueError:
+                logging.warning(u"cycle in {}, rebuild inheritance".format(p))
+                self._build_index_inheritance()
+                self._build_index_class_reachability()
+                return set(self.index_class_mask)
+
+            for n in removed:
+                inheritance.pop(n, None)
+            inheritance.update(update)
+            if p == "rdfs:subClassOf":
+                class_set.update(removed)
+                class_set.update(update)
+
+        self._update_index_class_reachability(class_set)
+        return class_set
+
+    def _merge_inheritance(self, n, direct_super, inheritance, affected, update, path):
+        """
+            [n] merged with the lists of its direct super ones in order, the
+            same preorder as DirectedGraph.compute_subtree
+        """
+        if n in update:
+            return update[n]
+        if n not in affected:
+            if n not in inheritance:
+                # first used as a super class/property
+                update[n] = [n]
+                return update[n]
+            return inheritance[n]
+        if n in path:
+            raise ValueError(n)
+
+        path.append(n)
+        ret = [n]
+        seen = set(ret)
+        for v in direct_super.get(n, []):
+            for x in self._merge_inheritance(v, direct_super, inheritance, affected, update, path):
+                if x not in seen:
+                    seen.add(x)
+                    ret.append(x)
+        path.pop()
+        update[n] = ret
+        return ret
+
+    def _update_index_class_reachability(self, class_set):
+        inheritance = self.index_inheritance["rdfs:subClassOf"]
+        bit_next = max([0] + list(self.index_class_mask.values())).bit_length()
+        for xtype in class_set:
+            if xtype not in inheritance:
+                self.index_class_mask.pop(xtype, None)
+                self.index_class_ancestor_bits.pop(xtype, None)
+            elif xtype not in self.index_class_mask:
+                self.index_class_mask[xtype] = 1 << bit_next
+                bit_next += 1
+        for xtype in class_set:
+            if xtype in inheritance:
+                bits = 0
+                for ancestor in inheritance[xtype]:
+                    bits |= self.index_class_mask[ancestor]
+                self.index_class_ancestor_bits[xtype] = bits
+
+    def _update_template(self, template_list, alias_list=None):
+        """
+            recompute validation and property alias entries of the templates
+            (None skipped), alias_list has their alias before the change
+        """
+        template_list = [x for x in template_list if x is not None]
+        key_set = set((x["refClass"], x["refProperty"]) for x in template_list)
+        alias_set = set(alias_list or [])
+        for template in template_list:
+            alias_set.update(_extract_template_alias_list(template))
+
+        # last template of a key wins, see _build_index_template
+        template_validation_map = {}
+        index_property_alias = collections.defaultdict(dict)
+        for schema in self.imported_schema:
+            for template in schema.metadata["template"]:
+                key = (template["refClass"], template["refProperty"])
+                if key in key_set and template.get("propertyRange"):
+                    template_validation_map[key] = template
+                for alias in _extract_template_alias_list(template):
+                    if alias in alias_set:
+                        index_property_alias[alias][template["name"]] = template
+
+        for d, rp in key_set:
+            template = template_validation_map.get((d, rp))
+            if template:
+                self.index_validate_template[d][rp] = self._gen_template_validation(template)
+            elif rp in self.index_validate_template.get(d, {}):
+                del self.index_validate_template[d][rp]
+                if not self.index_validate_template[d]:
+                    del self.index_validate_template[d]
+
+        for alias in alias_set:
+            if alias in index_property_alias:
+                self.index_property_alias[alias] = index_property_alias[alias]
+            else:
+                self.index_property_alias.pop(alias, None)
+
+        self.cache_validation_plan.clear()
+        self._stat()
+
+    def check_consistency(self):
+        """
+            compare the indexes with a full build of a copy of this schema,
+            return the differences as [index, key, value, expected]; empty if
+            the incremental updates left the same indexes
+        """
+        expected = CnsSchema()
+        expected.schema_dir = self.schema_dir
+        expected.schema_urlprefix = self.schema_urlprefix
+        expected.preloaded_schema_list = dict((x.metadata["identifier"], x) for x in self.imported_schema[:-1])
+        expected.metadata = copy.deepcopy(self.metadata)
+        expected.definition = copy.deepcopy(self.definition)
+        expected.build()
+
+        def _class_ancestors(schema):
+            ret = {}
+            for xtype, bits in schema.index_class_ancestor_bits.items():
+                ret[xtype] = set(x for x, mask in schema.index_class_mask.items() if bits & mask)
+            return ret
+
+        ret = []
+        for name, value, value_expected in [
+                ["index_definition_alias", self.index_definition_alias, expected.index_definition_alias],
+                ["index_imported_alias", self.index_imported_alias, expected.index_imported_alias],
+                ["rdfs:subClassOf", self.index_inheritance["rdfs:subClassOf"], expected.index_inheritance["rdfs:subClassOf"]],
+                ["rdfs:subPropertyOf", self.index_inheritance["rdfs:subPropertyOf"], expected.index_inheritance["rdfs:subPropertyOf"]],
+                ["index_class_ancestor_bits", _class_ancestors(self), _class_ancestors(expected)],
+                ["index_validate_template", self.index_validate_template, expected.index_validate_template],
+                ["index_property_alias", self.index_property_alias, expected.index_property_alias]]:
+            for key in sorted(set(value).union(value_expected)):
+                # empty entries are left by defaultdict lookups
+                if value.get(key) != value_expected.get(key) and (value.get(key) or value_expected.get(key)):
+                    ret.append([name, key, value.get(key), value_expected.get(key)])
+        return ret
+
     def jsonld2mem4file(self, filename=None):
         # reset data
         jsonld = file2json(filename)
@@ -775,8 +1500,7 @@ def template2definition4property(cns_item_template):
 def task_import_schema(args):
     logging.info("enter")
     filename = args["input_file"]
-    loaded_schema = CnsSchema()
-    loaded_schema.jsonld2mem(filename)
+    loaded_schema = load_schema(filename, args.get("schema_dir"), args.get("schema_cache_dir"))
     logging.info(filename)
 
     # validate if we can reproduce the same jsonld based on input
@@ -805,6 +1529,49 @@ def task_import_schema(args):
 
 
 
+def task_benchmark_schema_load(args):
+    """
+        startup time of loading a schema: full build vs snapshot write
+        (cold) vs snapshot load (warm)
+    """
+    import tempfile
+    import shutil
+
+    filename = args["input_file"]
+    schema_dir = args.get("schema_dir")
+    repeat = int(args.get("limit") or 5)
+    cache_dir = args.get("schema_cache_dir") or tempfile.mkdtemp()
+
+    def _timer(func):
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+        return {"min_seconds": round(min(times), 4), "mean_seconds": round(sum(times) / len(times), 4)}
+
+    def _cold():
+        for snapshot_filename in glob.glob(os.path.join(cache_dir, "*.pickle")):
+            os.remove(snapshot_filename)
+        load_schema(filename, schema_dir, cache_dir)
+
+    ret = {
+        "input_file": filename,
+        "schema_dir": schema_dir,
+        "repeat": repeat,
+        "build": _timer(lambda: load_schema(filename, schema_dir)),
+        "snapshot_cold": _timer(_cold),
+        "snapshot_warm": _timer(lambda: load_schema(filename, schema_dir, cache_dir)),
+    }
+    ret["speedup"] = round(ret["build"]["min_seconds"] / max(ret["snapshot_warm"]["min_seconds"], 1e-6), 1)
+    ret["snapshot_bytes"] = sum(os.path.getsize(x) for x in glob.glob(os.path.join(cache_dir, "*.pickle")))
+    if not args.get("schema_cache_dir"):
+        shutil.rmtree(cache_dir)
+
+    logging.info(json4debug(ret))
+    return ret
+
+
 if __name__ == "__main__":
     logging.basicConfig(format='[%(levelname)s][%(asctime)s][%(module)s][%(funcName)s][%(lineno)s] %(message)s',
                         level=logging.INFO)
@@ -814,6 +1581,8 @@ if __name__ == "__main__":
         '--input_file': 'input file',
         '--schema_dir': 'input schema',
         '--debug_dir': 'debug directory',
+        '--schema_cache_dir': 'directory of built schema snapshots',
+        '--limit': 'number of runs for task_benchmark_schema_load',
     }
     main_subtask(__name__, optional_params=optional_params)
 
@@ -825,4 +1594,7 @@ if __name__ == "__main__":
 
     python kgtool/cns_model.py task_import_schema --input_file=local/cns_fund_public.jsonld --debug_dir=local/debug --schema_dir=schema
 
+    # task 2: startup time, full build vs schema snapshot
+    python kgtool/cns_model.py task_benchmark_schema_load --input_file=schema/cns_organization_v2.0.jsonld --schema_dir=schema
+
 """
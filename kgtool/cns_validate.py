@@ -16,11 +16,14 @@ import re
 import collections
 import glob
 import copy
+import itertools
 
 from kgtool.core import *  # noqa
 from kgtool.stats import stat_kg_report_per_item
 from kgtool.cns_convert import convert_cns_type_string
-from kgtool.cns_model import preload_schema, CnsSchema
+from kgtool.cns_model import preload_schema, load_schema, CnsSchema
+from kgtool.cns_common import CnsBugReport, XTemplateCounter, xtemplate_key_id, xtemplate_key2text
+from kgtool.jsons_index import IdHashSet, id2hash64
 
 # global constants
 VERSION = 'v20180724'
@@ -88,12 +91,13 @@ def run_validate(loaded_schema, cns_item, report):
     #check types
     types = cns_item.get("@type")
     if not types:
-        bug = {
-            "category": "warn_validate",
-            "description": "missing @type and no expected @type",
-            "item": cns_item
-        }
-        report.report_bug(bug)
+        if report.should_check("warn_validate"):
+            bug = {
+                "category": "warn_validate",
+                "description": "missing @type and no expected @type",
+                "item": cns_item
+            }
+            report.report_bug(bug)
         return report
 
     _rewrite_item(loaded_schema, cns_item, report)
@@ -110,6 +114,20 @@ def run_validate(loaded_schema, cns_item, report):
 
     return report
 
+
+def count_validate(loaded_schema, cns_item, report):
+    """
+        add the counters run_validate adds for an item known to have no
+        bug (see ValidationCache), without running the checks
+    """
+    report.data["stats"]["items_validate"] += 1
+
+    _count_cnslink(loaded_schema, cns_item, report)
+
+    _validate_template(loaded_schema, cns_item, cns_item["@type"], report, check=False)
+
+    return report
+
 SYSTEM_PROPERTY_LIST = ["@context","@vocab", "@graph", "@id", "@type"]
 def get_system_property():
     return SYSTEM_PROPERTY_LIST
@@ -121,13 +139,15 @@ def _rewrite_item(loaded_schema, cns_item, report):
 
     # rewrite type
     types = cns_item.get("@type")
+    flag_bug = report.should_check("warn_rewrite_item")
     if not isinstance(types, list):
-        bug = {
-            "category": "warn_rewrite_item",
-            "description": " @type got string value",
-            "item": cns_item
-        }
-        report.report_bug(bug)
+        if flag_bug:
+            bug = {
+                "category": "warn_rewrite_item",
+                "description": " @type got string value",
+                "item": cns_item
+            }
+            report.report_bug(bug)
 
         types = convert_cns_type_string(types)
         #rewrite type
@@ -140,21 +160,15 @@ def _rewrite_item(loaded_schema, cns_item, report):
     #remove undefined type
     types_new = []
     for xtype in types:
-        has_definition = False
-        for schema in loaded_schema.imported_schema:
-            the_definition = schema.get_definition_by_alias(xtype)
-            if the_definition:
-                has_definition =True
-                break
-
-        if not has_definition:
-            bug = {
-                "category": "warn_rewrite_item",
-                "description": "class not defined",
-                "class" : xtype,
-                #"item": cns_item
-            }
-            report.report_bug(bug)
+        if loaded_schema.resolve_alias(xtype) is None:
+            if flag_bug:
+                bug = {
+                    "category": "warn_rewrite_item",
+                    "description": "class not defined",
+                    "class" : xtype,
+                    #"item": cns_item
+                }
+                report.report_bug(bug)
         else:
             types_new.append(xtype)
     cns_item["@type"] = types_new
@@ -187,6 +201,8 @@ def _rewrite_item(loaded_schema, cns_item, report):
 
 
 def _validate_system_property(loaded_schema, cns_item, report):
+    if not report.should_check("warn_validate_system_property"):
+        return
 
     # system property
     types = cns_item["@type"]
@@ -203,33 +219,30 @@ def _validate_system_property(loaded_schema, cns_item, report):
 def _count_cnslink(loaded_schema, cns_item, report):
     types = cns_item["@type"]
     if "CnsLink" in types:
-        key_cnslink = u"cnslink_total"
-        report.data[XTEMPLATE][key_cnslink] += 1
+        report.data[XTEMPLATE].add_key(("cnslink", "total"))
 
         if not isinstance(cns_item["in"], dict):
-            key_cnslink = u"cnslink_{}".format(types[0])
-            report.data[XTEMPLATE][key_cnslink] += 1
+            report.data[XTEMPLATE].add_key(("cnslink", types[0]))
 
         else:
             main_type_in = cns_item["in"]["@type"][0]
             main_type_out = cns_item["out"]["@type"][0]
 
-            key_cnslink = u"cnslink_{}_{}_{}".format(main_type_in, types[0], main_type_out)
-            report.data[XTEMPLATE][key_cnslink] += 1
+            report.data[XTEMPLATE].add_key(("cnslink", main_type_in, types[0], main_type_out))
 
 
 
-def _validate_template(loaded_schema, cns_item, types, report):
-    # template validation
+def _validate_template(loaded_schema, cns_item, types, report, check=True):
+    # template validation, check=False only counts xtemplate keys
     validated_property = set()
 
-    if _validate_template_special(loaded_schema, cns_item, types, report, validated_property):
+    if _validate_template_special(loaded_schema, cns_item, types, report, validated_property, check):
         return
 
-    _validate_template_regular(loaded_schema, cns_item, types, report, validated_property)
+    _validate_template_regular(loaded_schema, cns_item, types, report, validated_property, check)
 
 
-def _validate_template_special(loaded_schema, cns_item, types, report, validated_property):
+def _validate_template_special(loaded_schema, cns_item, types, report, validated_property, check=True):
     #special case
     main_type = types[0]
     if "CnsLink" in types and re.search(r"^[a-z]", main_type):
@@ -245,53 +258,121 @@ def _validate_template_special(loaded_schema, cns_item, types, report, validated
             template = template_map.get(main_type)
 
             if template:
-                v = cns_item["out"]
-                range_actual = type(v)
-                range_config = template["propertyRange"]
-                type_actual = _validate_entity_ref(xtype, main_type, v, range_actual, range_config, report)
+                if check:
+                    v = cns_item["out"]
+                    range_actual = type(v)
+                    range_config = template["propertyRange"]
+                    type_actual = _validate_entity_ref(xtype, main_type, v, range_actual, range_config, report)
                 validated_property.add(main_type)
                 return True
 
 
-def _validate_template_regular(loaded_schema, cns_item, types, report, validated_property):
-    #regular validation
-    for idx, xtype in enumerate(types):
+"""
+validation plan: everything _validate_template_regular derives from @type,
+compiled once per distinct @type tuple and cached in
+loaded_schema.cache_validation_plan
+ * type_key_ids: ids of xtemplate keys ("type_all", xtype)
+ * steps: templates in validation order, one per (xtype, property), with
+   the ids of xtemplate keys ("cp", main_type, xtype, property)
+ * allowed_property: properties covered by a template or system property
+ * key_ids: all xtemplate key ids of the plan, plan_id: unique in process
+"""
+ValidationPlan = collections.namedtuple("ValidationPlan", [
+    "types", "main_type", "type_key_ids", "steps", "allowed_property", "key_ids", "plan_id"])
+
+# validate=False if the property was validated by an earlier template
+ValidationPlanStep = collections.namedtuple("ValidationPlanStep", [
+    "xtype", "property", "template", "cp_key_ids", "validate"])
+
+_VALIDATION_PLAN_ID = itertools.count()
+
+
+def compile_validation_plan(loaded_schema, types):
+    types = tuple(types)
+    main_type_list = loaded_schema.get_main_types(types)
+
+    type_key_ids = []
+    steps = []
+    validated_property = set()
+    for xtype in types:
         # only count main type's  template
-        key_c = u"type_all_{}".format(xtype)
-        report.data[XTEMPLATE][key_c] += 1
-        #if idx == 0:
-        #    key_c = u"type_first_{}".format(xtype)
-        #    report.data[XTEMPLATE][key_c] += 1
+        type_key_ids.append(xtemplate_key_id(("type_all", xtype)))
 
         #find templates
         template_map = loaded_schema.index_validate_template.get(xtype)
         if template_map is None or len(template_map)==0:
-            # bug = {
-            #     "category": "warn_validate_template",
-            #     "description": "no template found",
-            #     "class": xtype,
-            #     "item": cns_item,
-            # }
-            # report.report_bug(bug)
             continue
 
-
-        #validate one by one
         for template in template_map.values():
-            _validate_one_template(loaded_schema, types, cns_item, xtype, template, validated_property, report)
+            p = template["refProperty"]
 
-    #properties not validate by main template
+            # only count main type's  template
+            cp_key_ids = []
+            for main_type in sorted(main_type_list):
+                if xtype in main_type_list and xtype != main_type:
+                    continue
+                cp_key_ids.append(xtemplate_key_id(("cp", main_type, xtype, p)))
+
+            step = ValidationPlanStep(xtype, p, template, tuple(cp_key_ids), p not in validated_property)
+            validated_property.add(p)
+            steps.append(step)
+
+    allowed_property = frozenset(validated_property.union(get_system_property()))
+    main_type = types[0] if types else None
+    key_ids = list(type_key_ids)
+    for step in steps:
+        key_ids.extend(step.cp_key_ids)
+    return ValidationPlan(types, main_type, tuple(type_key_ids), tuple(steps), allowed_property, tuple(key_ids), next(_VALIDATION_PLAN_ID))
+
+
+def get_validation_plan(loaded_schema, types):
+    types = tuple(types)
+    plan = loaded_schema.cache_validation_plan.get(types)
+    if plan is None:
+        plan = compile_validation_plan(loaded_schema, types)
+        loaded_schema.cache_validation_plan.put(types, plan)
+    return plan
+
+
+def _validate_template_regular(loaded_schema, cns_item, types, report, validated_property, check=True):
+    #regular validation
+    plan = get_validation_plan(loaded_schema, types)
+
+    # count by key id, all keys of the plan show up in xtemplate
+    counts = report.data[XTEMPLATE].touch(plan.key_ids, plan.plan_id)
+    for key_id in plan.type_key_ids:
+        counts[key_id] += 1
 
-    all_property = set(cns_item.keys())
-    all_property = all_property.difference(get_system_property())
-    all_property = all_property.difference(validated_property)
-    c = types[0]
-    for p in all_property:
+    #validate one by one
+    for step in plan.steps:
+        if step.property in cns_item:
+            for key_id in step.cp_key_ids:
+                counts[key_id] += 1
+
+        if not step.validate:
+            continue
+        if check:
+            _validate_one_template(loaded_schema, cns_item, step.xtype, step.template, report)
+        elif step.property in cns_item:
+            _count_one_template(loaded_schema, cns_item, step.template, report)
+    validated_property.update(plan.allowed_property.difference(get_system_property()))
+
+    #properties not validate by main template
+    c = plan.main_type
+    flag_bug = check and report.should_check("warn_validate_template_regular")
+    for p in cns_item:
+        if p in plan.allowed_property:
+            continue
         if p.startswith("rdfs:"):
             continue
         #if p in ["in","out"]:
         #    continue
 
+        # not validated properties for main type
+        report.data[XTEMPLATE].add_key(("ucp", c, p))
+        if not flag_bug:
+            continue
+
         bug = {
             "category": "warn_validate_template_regular",
             "description": u"unable to find a template for property=[{}] based on classes defined in @type=[{}]".format(p, u", ".join(types)),
@@ -302,39 +383,19 @@ def _validate_template_regular(loaded_schema, cns_item, types, report, validated
         #logging.info(bug)
         report.report_bug(bug)
 
-        # not validated properties for main type
-        key_cp = u"ucp_{}_{}".format(c, p)
-        report.data[XTEMPLATE][key_cp] += 1
 
-
-def _validate_one_template(loaded_schema, types, cns_item, xtype, template, validated_property, report):
+def _validate_one_template(loaded_schema, cns_item, xtype, template, report):
     p = template["refProperty"]
 
-    # only count main type's  template
-    main_type_list = loaded_schema.get_main_types(types)
-    for main_type in main_type_list:
-        if xtype in main_type_list and xtype != main_type:
-            continue
-
-        key_cp = u"cp_{}_{}_{}".format(main_type, xtype, p)
-        if p in cns_item:
-            report.data[XTEMPLATE][key_cp] += 1
-        else:
-            report.data[XTEMPLATE][key_cp] += 0
-
-    if p in validated_property:
-        # validated, no need to be validated in other templates
-        return
-    else:
-        validated_property.add(p)
-
     #validate cardinality
     values = json_get_list(cns_item, p)
     card_actual = len(values)
     range_config = template["propertyRange"]
 
 
-    if len(range_config["python_type_value_list"])>0 or len(range_config["cns_range_datastructure"])>0:
+    if not report.should_check("warn_validate_template_regular"):
+        pass
+    elif len(range_config["python_type_value_list"])>0 or len(range_config["cns_range_datastructure"])>0:
         if card_actual < template["minCardinality"]:
             # logging.info(json4debug(template))
             # logging.info(json4debug(cns_item))
@@ -391,7 +452,7 @@ def _validate_one_template(loaded_schema, types, cns_item, xtype, template, vali
 
                 if v_types:
                     if len(v_types) == 1:
-                        v_types = loaded_schema.index_inheritance["rdfs:subClassOf"].get(v_types[0])
+                        v_types = loaded_schema.ancestors(v_types[0])
 
                     _validate_template(loaded_schema, v, v_types, report)
 
@@ -402,9 +463,31 @@ def _validate_one_template(loaded_schema, types, cns_item, xtype, template, vali
 
 
 
+def _count_one_template(loaded_schema, cns_item, template, report):
+    """
+        the xtemplate counts _validate_one_template adds for the nested
+        values of an item without bug
+    """
+    p = template["refProperty"]
+    if p in ["in","out"]:
+        return
+
+    for v in json_get_list(cns_item, p):
+        if type(v) != dict:
+            continue
+        if "@id" in v:
+            v_types = json_get_list(v, "@type")
+        else:
+            v_types = template["propertyRange"]["cns_range_datastructure"]
+            if len(v_types) == 1:
+                v_types = loaded_schema.ancestors(v_types[0])
+        if v_types:
+            _validate_template(loaded_schema, v, v_types, report, check=False)
+
+
 def _validate_datastructure(c, p, v, range_actual, range_config, report):
     types = range_config["cns_range_datastructure"]
-    if len(types) == 0:
+    if len(types) == 0 and report.should_check("warn_validate_datastructure"):
         bug = {
             "category": "warn_validate_datastructure",
             "description": "value range not specified as datastructure",
@@ -445,6 +528,9 @@ def _validate_datastructure(c, p, v, range_actual, range_config, report):
     #     report.report_bug(bug)
 
 def _validate_entity_ref(c, p, v, range_actual, range_config, report):
+    if not report.should_check("warn_validate_entity_ref"):
+        return
+
     xtype = json_get_list(v, "@type")
     if not xtype:
         bug = {
@@ -482,6 +568,9 @@ def _validate_datatype(c, p, v, range_actual, range_config, report):
         # do not validate system property
         return
 
+    if not report.should_check("warn_validate_datatype"):
+        return
+
     if not range_actual in range_config["python_type_value_list"]:
         bug = {
             "category": "warn_validate_datatype",
@@ -656,121 +745,515 @@ def iso8601_datetime_parse(datestr):
 
 
 
+"""
+referential integrity: two passes over the dataset
+1. collect the @id of every entity into an IdHashSet
+2. every CnsLink in/out and every nested {"@id": ...} must be a collected @id
+
+entities are the items of a json lines file, the items of a json file (a
+list, or @graph) or the json file itself. a nested object with @id is a
+reference, its own properties are not checked.
+"""
+_ID_TYPES = (str, type(u""))
+
+def _iter_entity(data):
+    if type(data) == dict:
+        data = data.get("@graph", [data])
+    if type(data) != list:
+        data = [data]
+    for cns_item in data:
+        if type(cns_item) == dict and "@id" in cns_item:
+            yield cns_item
+
+
+def _iter_ref(cns_item):
+    """
+        (property, referenced @id) of one entity
+    """
+    for p, v in cns_item.items():
+        if p in ["@context", "@id", "@type"]:
+            continue
+        if p in ["in", "out"] and isinstance(v, _ID_TYPES):
+            yield p, v
+            continue
+
+        stack = [v]
+        while stack:
+            v = stack.pop()
+            if type(v) == list:
+                stack.extend(reversed(v))
+            elif type(v) == dict:
+                if "@id" in v:
+                    yield p, v["@id"]
+                else:
+                    stack.extend(reversed(list(v.values())))
+
+
+def validate_ref(cns_item, id_set, report):
+    """
+        report references of one entity missing from id_set
+    """
+    if not report.should_check("warn_validate_ref"):
+        return
+
+    c = json_get_first_item(cns_item, "@type", "")
+    for p, xid in _iter_ref(cns_item):
+        report.data[XTEMPLATE].add_key(("ref", "total"))
+        if isinstance(xid, _ID_TYPES) and xid in id_set:
+            continue
+
+        bug = {
+            "category": "warn_validate_ref",
+            "description": "referenced @id not found",
+            "value": xid,
+            "@id": cns_item["@id"],
+            "class": c,
+            "property": p,
+        }
+        report.report_bug(bug)
+
+
+def _collect_id4shard(filename, shard):
+    """
+        64-bit hashes of entity @id in one shard of a json lines file
+    """
+    id_set = IdHashSet()
+    for line in file2iter4shard(filename, shard):
+        for entity in _iter_entity(json_loads(line)):
+            if isinstance(entity["@id"], _ID_TYPES):
+                id_set.add(entity["@id"])
+    id_set.freeze()
+    return id_set.hashes
+
+
+def collect_id(filename_list, option=None, workers=1, bloom_error_rate=None):
+    """
+        first pass of referential integrity check
+    """
+    id_set = IdHashSet(bloom_error_rate=bloom_error_rate)
+    for filename in filename_list:
+        if not os.path.exists(filename):
+            continue
+        if option == "jsons":
+            for hashes in file2iter4parallel(filename, _collect_id4shard, workers=workers):
+                id_set.add_hashes(hashes)
+        else:
+            for entity in _iter_entity(file2json(filename)):
+                if isinstance(entity["@id"], _ID_TYPES):
+                    id_set.add(entity["@id"])
+    id_set.freeze()
+    logging.info(u"collected {} @id".format(len(id_set)))
+    return id_set
+
+
+"""
+incremental validation: a json line whose item had no bug is kept in a
+ValidationCache file as a 64-bit hash of the line, next to the fingerprint
+of the schema. with the same schema, a later run only counts such an item
+(count_validate) and skips the checks of run_validate, the report and the
+entity listing are the same as a full run. items are only added while no
+bug budget skips checks
+"""
+VALIDATION_CACHE_FORMAT = 1
+
+def schema_fingerprint(loaded_schema):
+    """
+        hash of the schema and all its imported schemas, changes whenever a
+        definition, template or metadata changes
+    """
+    data = [VERSION, VALIDATION_CACHE_FORMAT]
+    for schema in sorted(loaded_schema.imported_schema, key=lambda x: x.metadata["identifier"]):
+        data.append([schema.metadata, schema.definition])
+    text = json.dumps(data, sort_keys=True, default=repr)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ValidationCache():
+    """
+        hashes of json lines without bug, for one schema fingerprint
+        * clean: IdHashSet loaded from filename, empty if the file is
+          missing or was written for another schema
+        * added: IdHashSet of lines found clean in this run, see save()
+        * stats: hit/miss counts
+    """
+    def __init__(self, filename, loaded_schema):
+        self.filename = filename
+        self.schema_key = schema_fingerprint(loaded_schema)
+        self.clean = IdHashSet()
+        self.added = IdHashSet()
+        self.stats = collections.Counter()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return self
+
+        with open(self.filename, "rb") as f:
+            header = json.loads(f.readline().decode("utf-8"))
+            if header.get("version") != VALIDATION_CACHE_FORMAT or header.get("schema") != self.schema_key:
+                logging.info(u"validate cache {} was written for another schema".format(self.filename))
+                return self
+            hashes = self.clean.hashes
+            hashes.fromfile(f, header["cnt"])
+        if header["byteorder"] != sys.byteorder:
+            hashes.byteswap()
+        return self
+
+    def validate(self, loaded_schema, line, cns_item, report):
+        """
+            count_validate an item whose line had no bug, run_validate
+            the others
+        """
+        line_hash = id2hash64(line)
+        if self.clean.contains_hash(line_hash):
+            self.stats["hit"] += 1
+            return count_validate(loaded_schema, cns_item, report)
+
+        self.stats["miss"] += 1
+        cnt_bug = report.cnt_bug
+        flag_check = not report.skip_category
+        run_validate(loaded_schema, cns_item, report)
+        if flag_check and report.cnt_bug == cnt_bug and not report.skip_category:
+            self.added.add_hash(line_hash)
+        return report
+
+    def pop_added(self):
+        """
+            sorted hashes of the lines added since the last call and the
+            hit/miss counts, returned by a worker
+        """
+        ret = [self.added.freeze().hashes, self.stats]
+        self.added = IdHashSet()
+        self.stats = collections.Counter()
+        return ret
+
+    def update(self, hashes, stats):
+        """
+            add the lines found clean by a worker
+        """
+        self.added.add_hashes(hashes)
+        self.stats.update(stats)
+
+    def save(self):
+        """
+            merge the added lines into the clean set, write it atomically
+        """
+        self.added.freeze()
+        self.clean.add_hashes(self.added.hashes)
+        self.clean.freeze()
+        self.added = IdHashSet()
+
+        header = {
+            "version": VALIDATION_CACHE_FORMAT,
+            "schema": self.schema_key,
+            "byteorder": sys.byteorder,
+            "cnt": len(self.clean),
+        }
+        filename_temp = u"{}.tmp{}".format(self.filename, os.getpid())
+        with open(filename_temp, "wb") as f:
+            f.write(json.dumps(header, sort_keys=True).encode("utf-8"))
+            f.write(b"\n")
+            self.clean.hashes.tofile(f)
+        os.rename(filename_temp, self.filename)
+
+
+def _validate_jsons_shard(filename, shard, loaded_schema, report, cache=None, id_set=None, lines=None):
+    """
+        validate json lines in one shard of filename, return entity listing
+        (appended to lines if given, e.g. an ExternalSorter)
+    """
+    if lines is None:
+        lines = []
+    for idx, line in enumerate(file2iter4shard(filename, shard)):
+        if idx % 10000 ==0:
+            logging.info(idx)
+            logging.info(json4debug(report.data["stats"]))
+        json_data = json_loads(line)
+        if cache is None:
+            run_validate(loaded_schema, json_data, report)
+        else:
+            cache.validate(loaded_schema, line, json_data, report)
+        if id_set is not None:
+            for entity in _iter_entity(json_data):
+                validate_ref(entity, id_set, report)
+        stat_kg_report_per_item(json_data, None, report.data["stats"])
+        flag_stop = report.end_item()
+
+        # collection entity listing
+        if "CnsLink" not in json_data["@type"]:
+            entity_simple = [
+                json_data["@type"][0],
+                json_data.get("name",""),
+                 "\""+u",".join(json_data.get("alternateName",[]))+"\""
+            ]
+            lines.append(u",".join(entity_simple))
+
+        if flag_stop:
+            break
+    return lines
+
+
+# schema loaded in this process, keyed by (schema_filename, schema_dir)
+_LOADED_SCHEMA = {}
+
+def load_schema4validate(schema_filename, schema_dir=None, cache_dir=None):
+    """
+        load the schema and the schemas in schema_dir once per process,
+        from a schema snapshot in cache_dir if given
+    """
+    key = (schema_filename, schema_dir)
+    loaded_schema = _LOADED_SCHEMA.get(key)
+    if loaded_schema is None:
+        loaded_schema = load_schema(schema_filename, schema_dir, cache_dir)
+        _LOADED_SCHEMA[key] = loaded_schema
+    return loaded_schema
+
+
+def _bug_report_options(args):
+    """
+        CnsBugReport options from command line args
+    """
+    ret = {}
+    if args.get("bug_sample_size"):
+        ret["sample_size"] = int(args["bug_sample_size"])
+    if args.get("bug_sample_mode"):
+        ret["sample_mode"] = args["bug_sample_mode"]
+    if args.get("bug_sample_bytes"):
+        ret["sample_bytes"] = int(args["bug_sample_bytes"])
+    if args.get("bug_detail_file"):
+        ret["detail_filename"] = args["bug_detail_file"]
+    for p in ["max_bugs", "max_bugs_per_category", "error_window"]:
+        if args.get(p):
+            ret[p] = int(args[p])
+    if args.get("max_error_rate"):
+        ret["max_error_rate"] = float(args["max_error_rate"])
+    return ret
+
+
+# id set loaded in this process, keyed by (filename, bloom_error_rate)
+_LOADED_ID_SET = {}
+
+def load_id_set4validate(filename, bloom_error_rate=None):
+    key = (filename, bloom_error_rate)
+    id_set = _LOADED_ID_SET.get(key)
+    if id_set is None:
+        id_set = IdHashSet(bloom_error_rate=bloom_error_rate).load(filename)
+        _LOADED_ID_SET.clear()
+        _LOADED_ID_SET[key] = id_set
+    return id_set
+
+
+# validation cache loaded in this process, keyed by filename
+_LOADED_VALIDATION_CACHE = {}
+
+def load_validation_cache4validate(filename, loaded_schema):
+    cache = _LOADED_VALIDATION_CACHE.get(filename)
+    if cache is None:
+        cache = ValidationCache(filename, loaded_schema)
+        _LOADED_VALIDATION_CACHE.clear()
+        _LOADED_VALIDATION_CACHE[filename] = cache
+    return cache
+
+
+def _validate_jsons_shard4worker(filename, shard, schema_filename, schema_dir, report_options, id_set_filename=None, bloom_error_rate=None, schema_cache_dir=None, detail_dir=None, cache_filename=None):
+    """
+        validate one shard in a worker process, return entity listing,
+        the partial report of this shard and the validation cache result
+        (see ValidationCache.pop_added); detailed bugs go to a shard file
+        in detail_dir, the parent appends it to the detail file
+    """
+    loaded_schema = load_schema4validate(schema_filename, schema_dir, schema_cache_dir)
+    id_set = None
+    if id_set_filename:
+        id_set = load_id_set4validate(id_set_filename, bloom_error_rate)
+    cache = None
+    if cache_filename:
+        cache = load_validation_cache4validate(cache_filename, loaded_schema)
+    report = CnsBugReport(seed=shard[0], **report_options)
+    if report_options.get("detail_filename"):
+        report.detail_filename = os.path.join(detail_dir, u"shard{}.jsons".format(shard[0]))
+    lines = _validate_jsons_shard(filename, shard, loaded_schema, report, cache, id_set)
+    report.close()
+    if cache is None:
+        return [lines, report, None]
+    return [lines, report, cache.pop_added()]
+
+
 def task_validate(args):
     logging.info( "called task_validate" )
     schema_filename = args.get("input_schema")
     if not schema_filename:
         schema_filename = "schema/cns_top.jsonld"
+    workers = int(args.get("workers") or 1)
 
-    preload_schema_list = preload_schema(args)
-    loaded_schema = CnsSchema()
-    loaded_schema.import_jsonld(schema_filename, preload_schema_list)
+    with profile_stage("load_schema"):
+        loaded_schema = load_schema4validate(schema_filename, args.get("schema_dir"), args.get("schema_cache_dir"))
 
 
     filepath = args["input_file"]
     filename_list = glob.glob(filepath)
-    report = init_report()
+    report_options = _bug_report_options(args)
+    report = CnsBugReport(**report_options)
+    if workers > 1 and "budget" in report.data:
+        # budgets are spent item by item in input order, a shard cannot
+        # know the bugs of the shards before it
+        logging.warning(u"bug budgets need serial validation, ignore --workers={}".format(workers))
+        workers = 1
 
     # init xtemplate
-    report.data[XTEMPLATE] = collections.Counter()
+    report.data[XTEMPLATE] = XTemplateCounter()
     for template in loaded_schema.metadata["template"]:
         d = template["refClass"]
         p = template["refProperty"]
-        key_cp = u"cp_{}_{}_{}".format(d, d, p)
-        report.data[XTEMPLATE][key_cp] += 0
-    logging.info(json4debug(report.data[XTEMPLATE]))
+        report.data[XTEMPLATE].add_key(("cp", d, d, p), 0)
+    logging.info(json4debug(report.data[XTEMPLATE].to_counter()))
 
     # init class path dependency
     for template in loaded_schema.metadata["template"]:
         d = template["refClass"]
         key_cp = u"parent_{}".format(d)
-        report.data[XTEMPLATE][key_cp] = loaded_schema.index_inheritance["rdfs:subClassOf"].get(d)
+        report.data[XTEMPLATE].extra[key_cp] = loaded_schema.ancestors(d)
 
     for definition in loaded_schema.definition.values():
         if "rdfs:Class" in definition["@type"]:
             d = definition["name"]
             key_cp = u"parent_{}".format(d)
-            report.data[XTEMPLATE][key_cp] = loaded_schema.index_inheritance["rdfs:subClassOf"].get(d)
+            report.data[XTEMPLATE].extra[key_cp] = loaded_schema.ancestors(d)
+
+    # referential integrity, first pass
+    id_set = None
+    id_set_filename = None
+    bloom_error_rate = None
+    if args.get("check_ref"):
+        if args["check_ref"] == "bloom":
+            bloom_error_rate = 0.01
+        with profile_stage("collect_id"):
+            id_set = collect_id(filename_list, args.get("option"), workers, bloom_error_rate)
+        if args.get("option") == "jsons" and workers > 1:
+            import tempfile
+            fd, id_set_filename = tempfile.mkstemp(suffix=".ids")
+            os.close(fd)
+            id_set.save(id_set_filename)
 
     #validate
-    lines = []
+    # entity listing is sorted on disk when it outgrows the buffer
+    output_dir = os.path.dirname(os.path.abspath(args["output_validate_entity"]))
+    lines = ExternalSorter(int(args.get("entity_sort_buffer") or 1000000), temp_dir=output_dir)
+
+    # detailed bugs of each worker go to a shard file, appended in file order
+    detail_dir = None
+    if args.get("option") == "jsons" and workers > 1 and report.detail_filename:
+        import tempfile
+        detail_dir = tempfile.mkdtemp(prefix=".bug_detail", dir=output_dir)
+
+    cache = None
+    if args.get("validate_cache") and args.get("option") == "jsons":
+        cache = ValidationCache(args["validate_cache"], loaded_schema)
 
     for filename in filename_list:
         logging.info(filename)
         if not os.path.exists(filename):
             continue
 
-        if args.get("option") == "jsons":
-            for idx, line in enumerate(file2iter(filename)):
-                if idx % 10000 ==0:
-                    logging.info(idx)
-                    logging.info(json4debug(report))
-                json_data = json.loads(line)
-                run_validate(loaded_schema, json_data, report)
-                stat_kg_report_per_item(json_data, None, report.data["stats"])
-
-                # collection entity listing
-                if "CnsLink" not in json_data["@type"]:
-                    entity_simple = [
-                        json_data["@type"][0],
-                        json_data.get("name",""),
-                         "\""+u",".join(json_data.get("alternateName",[]))+"\""
-                    ]
-                    lines.append(u",".join(entity_simple))
+        with profile_stage("validate"):
+            if args.get("option") == "jsons" and workers > 1:
+                # partial reports are merged in file order, same result as serial
+                # (reservoir samples are uniform but not the serial sample)
+                for lines_shard, report_shard, cache_shard in file2iter4parallel(filename, _validate_jsons_shard4worker, workers=workers, ordered=True, schema_filename=schema_filename, schema_dir=args.get("schema_dir"), report_options=report_options, id_set_filename=id_set_filename, bloom_error_rate=bloom_error_rate, schema_cache_dir=args.get("schema_cache_dir"), detail_dir=detail_dir, cache_filename=args.get("validate_cache")):
+                    lines.extend(lines_shard)
+                    report.merge(report_shard)
+                    if cache_shard:
+                        cache.update(*cache_shard)
+                    if detail_dir and os.path.exists(report_shard.detail_filename):
+                        os.remove(report_shard.detail_filename)
+                    if report.stop_reason:
+                        break
+
+            elif args.get("option") == "jsons":
+                # the shared report is updated in place, so shards run in this process
+                for _ in file2iter4parallel(filename, _validate_jsons_shard, workers=1, loaded_schema=loaded_schema, report=report, cache=cache, id_set=id_set, lines=lines):
+                    pass
 
-        else:
-            jsondata = file2json(filename)
-            run_validate(loaded_schema, jsondata, report)
+            else:
+                jsondata = file2json(filename)
+                run_validate(loaded_schema, jsondata, report)
+                if id_set is not None:
+                    for entity in _iter_entity(jsondata):
+                        validate_ref(entity, id_set, report)
+
+        if report.stop_reason:
+            break
+
+    if id_set_filename:
+        os.remove(id_set_filename)
+    if cache is not None:
+        cache.save()
+        logging.info(u"validate cache {} hit={} miss={} clean={}".format(cache.filename, cache.stats["hit"], cache.stats["miss"], len(cache.clean)))
+    if detail_dir:
+        # shard files left by workers after an early stop
+        import shutil
+        shutil.rmtree(detail_dir)
 
     #out
-    filename = args["output_validate_entity"]
-    logging.info(filename)
-    lines = sorted(lines)
+    with profile_stage("write_entity"):
+        filename = args["output_validate_entity"]
+        logging.info(filename)
 
-    fields = ["main_type","name","alternateName"]
-    lines.insert(0, u",".join(fields))
-    lines2file(lines, filename)
+        fields = ["main_type","name","alternateName"]
+        with lines:
+            lines2file(itertools.chain([u",".join(fields)], lines), filename)
 
     #display report
-    logging.info(json4debug(report))
+    report_data = report.export()
+    logging.info(json4debug(report_data))
 
     #write report csv
-    write_csv_report(args, report, loaded_schema)
+    with profile_stage("write_report"):
+        write_csv_report(args, report, loaded_schema)
+
+        filename = args["output_validate_report"].replace("csv","json")
+        logging.info(filename)
+        json2file(report_data, filename)
+    report.close()
+
+def _name_zh(loaded_schema, name):
+    definition = loaded_schema.get_definition_by_alias(name)
+    if definition is None:
+        return ""
+    return definition.get("nameZh", "")
 
-    filename = args["output_validate_report"].replace("csv","json")
-    logging.info(filename)
-    json2file(report, filename)
 
 def write_csv_report(args, report, loaded_schema):
     # generate output report
     lines = []
     fields = ["main_type","super_type","property","main_type_zh","super_type_zh","property_zh","count","coverage"]
     lines.append(u",".join(fields))
-    for k, cnt in report.data[XTEMPLATE].items():
-        if k.startswith("cp_"):
+    xtemplate = report.data[XTEMPLATE]
+    for key, cnt in xtemplate.key_items():
+        if key[0] == "cp":
             if cnt == 0:
                 #skip link
                 continue
 
-            temp = k.split("_")
-            total = report.data[XTEMPLATE]["type_all_{}".format(temp[1])]
-            if temp[1].startswith("rdf"):
+            main_type, super_type, p = key[1:]
+            total = xtemplate.get_key(("type_all", main_type))
+            if main_type.startswith("rdf"):
                 nameZh1 = ""
             else:
-                nameZh1 = loaded_schema.get_definition_by_alias(temp[1])["nameZh"]
+                nameZh1 = _name_zh(loaded_schema, main_type)
             row = [
                 #"main_type":
-                temp[1],
+                main_type,
                 #"super_type":
-                temp[2],
+                super_type,
                 #"property":
-                temp[3],
+                p,
                 #"main_type_zh":
                 nameZh1,
                 #"super_type_zh":
-                loaded_schema.get_definition_by_alias(temp[2])["nameZh"],
+                _name_zh(loaded_schema, super_type),
                 #"property_zh":
-                loaded_schema.get_definition_by_alias(temp[3])["nameZh"],
+                _name_zh(loaded_schema, p),
                 #"count":
                 "%d" % cnt,
                 #"coverage":
@@ -791,11 +1274,24 @@ if __name__ == "__main__":
     optional_params = {
         '--input_file': 'input file',
         '--schema_dir': 'input schema',
+        '--schema_cache_dir': 'directory of built schema snapshots, reused while the schema files are unchanged',
         '--input_schema': 'input schema',
         '--output_validate_report': 'output validation report',
         '--output_validate_entity': 'output validation entity list',
         '--debug_dir': 'debug directory',
         '--option': 'debug directory',
+        '--workers': 'number of worker processes for jsons input, ignored with a bug budget (--max_bugs, --max_bugs_per_category, --max_error_rate)',
+        '--bug_sample_size': 'number of sample bugs per bug key, default 1',
+        '--bug_sample_mode': 'first (default) or reservoir',
+        '--bug_sample_bytes': 'byte budget for all sample bugs',
+        '--bug_detail_file': 'write every bug to this json lines file',
+        '--validate_cache': 'file of json lines without bug, unchanged lines skip the checks in the next run (jsons)',
+        '--entity_sort_buffer': 'entity listing lines sorted in memory before spilling to a temp file, default 1000000',
+        '--max_bugs': 'stop validation after this many bugs',
+        '--max_bugs_per_category': 'skip the checks of a bug category after this many bugs',
+        '--max_error_rate': 'stop validation when the fraction of items with bugs in the window exceeds this',
+        '--error_window': 'number of recent items for --max_error_rate, default 1000',
+        '--check_ref': 'two-pass check that referenced @id exist in the input, "bloom" adds a bloom filter',
     }
     main_subtask(__name__, optional_params=optional_params)
 
@@ -808,5 +1304,10 @@ if __name__ == "__main__":
     python kgtool/cns_validate.py task_validate --input_file=schema/cns_schemaorg.jsonld  --debug_dir=local/debug --schema_dir=schema --output_validate_entity=local/temp/entity.csv --output_validate_report=local/temp/report.csv
 
     python kgtool/cns_validate.py task_validate --input_file=local/kg4ai_cn_1.0.1.jsondl --input_schema=local/schema/cns_kg4ai.jsonld --debug_dir=local/debug --schema_dir=schema --output_validate_entity=local/temp/entity.csv --output_validate_report=local/temp/report.csv
+    python kgtool/cns_validate.py task_validate --input_file=local/kg4ai_cn_1.0.1.jsondl --input_schema=local/schema/cns_kg4ai.jsonld --debug_dir=local/debug --schema_dir=schema --output_validate_entity=local/temp/entity.csv --output_validate_report=local/temp/report.csv --option=jsons --workers=8
+    python kgtool/cns_validate.py task_validate --input_file=local/kg4ai_cn_1.0.1.jsondl --input_schema=local/schema/cns_kg4ai.jsonld --debug_dir=local/debug --schema_dir=schema --output_validate_entity=local/temp/entity.csv --output_validate_report=local/temp/report.csv --option=jsons --check_ref=1
+    python kgtool/cns_validate.py task_validate --input_file=local/kg4ai_cn_1.0.1.jsondl --input_schema=local/schema/cns_kg4ai.jsonld --debug_dir=local/debug --schema_dir=schema --output_validate_entity=local/temp/entity.csv --output_validate_report=local/temp/report.csv --option=jsons --validate_cache=local/temp/validate_cache.bin
+    python kgtool/cns_validate.py task_validate --input_file=local/kg4ai_cn_1.0.1.jsondl --input_schema=local/schema/cns_kg4ai.jsonld --debug_dir=local/debug --schema_dir=schema --output_validate_entity=local/temp/entity.csv --output_validate_report=local/temp/report.csv --option=jsons --max_bugs_per_category=10000 --max_error_rate=0.5
+    python kgtool/cns_validate.py task_validate --input_file=local/kg4ai_cn_1.0.1.jsondl --input_schema=local/schema/cns_kg4ai.jsonld --debug_dir=local/debug --schema_dir=schema --output_validate_entity=local/temp/entity.csv --output_validate_report=local/temp/report.csv --option=jsons --workers=8 --schema_cache_dir=local/schema_cache
 
 """
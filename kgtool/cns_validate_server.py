@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Li Ding
+
+# base packages
+import os
+import sys
+import json
+import logging
+import time
+import threading
+import collections
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+
+from kgtool.core import *  # noqa
+from kgtool.cns_common import CnsBugReport
+from kgtool.cns_model import load_schema, schema_source_files
+from kgtool.cns_validate import run_validate
+
+# global constants
+VERSION = 'v20181101'
+CONTEXTS = [os.path.basename(__file__), VERSION]
+
+"""
+long running validation service, the schema is loaded once and kept warm
+
+HTTP (TCP or Unix socket), one thread per connection, validation runs in a
+process pool (or in the request thread with workers=1)
+ * POST /validate   json lines in the body, one item per line; returns
+   {"items": [{"line", "@id", "bugs"} or {"line", "error"}], "report": {...}}
+   where line is the line number in the body (blank lines skipped) and
+   report is the CnsBugReport data of the batch
+ * GET /stats       request/item counters, latency and throughput
+ * GET /health      schema version and files
+schema files (input_schema, schema_dir/*.jsonld and the imported schemas)
+are polled every reload_interval seconds, a change loads the schema again and
+swaps the pool; batches running on the old pool finish there, the last one
+closes it. a request body is limited to max_body_bytes
+"""
+
+MAX_BODY_BYTES = 64 * 1024 * 1024
+
+# schema used by server workers, set by _init_worker
+_WORKER_SCHEMA = {}
+
+
+def _init_worker(schema_filename, schema_dir):
+    # not load_schema4validate, its schema of the process is never reloaded
+    _WORKER_SCHEMA["schema"] = load_schema(schema_filename, schema_dir)
+
+
+class _ItemBugReport(CnsBugReport):
+    """
+        CnsBugReport that also keeps a copy of the bugs of the current item
+    """
+    def __init__(self):
+        CnsBugReport.__init__(self)
+        self.item_bugs = []
+
+    def report_bug(self, bug):
+        # copy now, the item in the bug may be rewritten later
+        self.item_bugs.append(json_loads(json_dumps(bug)))
+        CnsBugReport.report_bug(self, bug)
+
+
+def _validate_lines4worker(numbered_lines, loaded_schema=None):
+    """
+        run_validate [line number, json line] pairs on one report, return
+        the per line results and the report
+    """
+    if loaded_schema is None:
+        loaded_schema = _WORKER_SCHEMA["schema"]
+    report = _ItemBugReport()
+    items = []
+    for line_number, line in numbered_lines:
+        try:
+            cns_item = json_loads(line)
+        except ValueError:
+            cns_item = None
+        if not isinstance(cns_item, dict):
+            items.append({"line": line_number, "error": "invalid json object"})
+            continue
+        report.item_bugs = []
+        run_validate(loaded_schema, cns_item, report)
+        items.append({"line": line_number, "@id": cns_item.get("@id"), "bugs": report.item_bugs})
+    report.item_bugs = []
+    return [items, report]
+
+
+class _PoolHandle():
+    """
+        worker pool and the number of batches using it; a retired pool is
+        closed by its last user
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.users = 0
+        self.retired = False
+
+
+class ServerStats():
+    """
+        counters of the validation service, latency of the most recent
+        requests in a bounded window
+    """
+    def __init__(self, window=1000):
+        self.time_start = time.time()
+        self.counter = collections.Counter()
+        self.latency = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add_request(self, cnt_item, latency, error=False):
+        with self._lock:
+            self.counter["requests"] += 1
+            self.counter["items"] += cnt_item
+            if error:
+                self.counter["errors"] += 1
+            self.latency.append([time.time(), latency, cnt_item])
+
+    def add(self, name, cnt=1):
+        with self._lock:
+            self.counter[name] += cnt
+
+    def report(self):
+        with self._lock:
+            ret = dict(self.counter)
+            latency = list(self.latency)
+        uptime = time.time() - self.time_start
+        ret["uptime"] = uptime
+        ret["items_per_second"] = ret.get("items", 0) / uptime if uptime > 0 else 0
+        if latency:
+            values = sorted([x[1] for x in latency])
+            ret["latency"] = {
+                "count": len(values),
+                "mean": sum(values) / len(values),
+                "p50": values[int(0.5 * (len(values) - 1))],
+                "p99": values[int(0.99 * (len(values) - 1))],
+                "max": values[-1],
+            }
+            duration = time.time() - latency[0][0] + latency[0][1]
+            if duration > 0:
+                ret["latency"]["items_per_second"] = sum([x[2] for x in latency]) / duration
+        return ret
+
+
+class ValidationService():
+    """
+        warm schema plus worker pool, validate batches of json lines
+    """
+    def __init__(self, schema_filename, schema_dir=None, workers=1, chunk_size=100):
+        self.schema_filename = schema_filename
+        self.schema_dir = schema_dir
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.stats = ServerStats()
+
+        self._lock = threading.Lock()
+        self._pool_handle = None
+        self._schema_files = [self.schema_filename]
+        self._schema_mtime = None
+        self.loaded_schema = None
+        self.reload()
+
+    def schema_files(self):
+        """
+            files the loaded schema was built from, imported schemas included
+        """
+        return self._schema_files
+
+    def _get_schema_mtime(self, filenames=None):
+        if filenames is None:
+            filenames = self.schema_files()
+        return [[filename, os.path.getmtime(filename)] for filename in filenames if os.path.exists(filename)]
+
+    def reload(self):
+        """
+            load the schema (and a new pool), swap them in when ready
+        """
+        # mtime before loading, a file changed meanwhile is loaded again
+        schema_mtime_before = dict(self._get_schema_mtime())
+        loaded_schema = load_schema(self.schema_filename, self.schema_dir)
+        schema_files = schema_source_files(self.schema_filename, self.schema_dir, loaded_schema)
+        schema_mtime = [[filename, schema_mtime_before.get(filename, mtime)] for filename, mtime in self._get_schema_mtime(schema_files)]
+        pool_handle = None
+        if self.workers > 1:
+            import multiprocessing
+            pool_handle = _PoolHandle(multiprocessing.Pool(self.workers, _init_worker, (self.schema_filename, self.schema_dir)))
+
+        with self._lock:
+            pool_handle_old = self._pool_handle
+            self._pool_handle = pool_handle
+            self.loaded_schema = loaded_schema
+            self._schema_files = schema_files
+            self._schema_mtime = schema_mtime
+        # running batches finish on the old pool
+        self._retire_pool(pool_handle_old)
+        logging.info(u"loaded schema {}".format(self.schema_filename))
+
+    def _retire_pool(self, pool_handle):
+        if pool_handle is None:
+            return
+        with self._lock:
+            pool_handle.retired = True
+            flag_close = pool_handle.users == 0
+        if flag_close:
+            pool_handle.pool.close()
+            pool_handle.pool.join()
+
+    def _release_pool(self, pool_handle):
+        with self._lock:
+            pool_handle.users -= 1
+            flag_close = pool_handle.retired and pool_handle.users == 0
+        if flag_close:
+            pool_handle.pool.close()
+            pool_handle.pool.join()
+
+    def check_reload(self):
+        """
+            reload if schema files changed, return True if reloaded
+        """
+        if self._get_schema_mtime() == self._schema_mtime:
+            return False
+        try:
+            self.reload()
+        except Exception:
+            logging.exception(u"failed to reload schema, keep the loaded one")
+            self.stats.add("reload_errors")
+            # do not retry until the files change again
+            self._schema_mtime = self._get_schema_mtime()
+            return False
+        self.stats.add("reloads")
+        return True
+
+    def validate_lines(self, lines):
+        """
+            validate json lines, return per item bugs and the batch report
+        """
+        numbered_lines = [[idx, line] for idx, line in enumerate(lines) if line.strip()]
+        with self._lock:
+            pool_handle = self._pool_handle
+            if pool_handle is not None:
+                pool_handle.users += 1
+            loaded_schema = self.loaded_schema
+
+        if pool_handle is None:
+            items, report = _validate_lines4worker(numbered_lines, loaded_schema)
+        else:
+            try:
+                chunks = [numbered_lines[idx:idx + self.chunk_size] for idx in range(0, len(numbered_lines), self.chunk_size)]
+                results = pool_handle.pool.map(_validate_lines4worker, chunks)
+            finally:
+                self._release_pool(pool_handle)
+            # partial reports merged in line order, same as one report
+            items = []
+            report = CnsBugReport()
+            for items_chunk, report_chunk in results:
+                items.extend(items_chunk)
+                report.merge(report_chunk)
+        return {"items": items, "report": report.export()}
+
+    def close(self):
+        with self._lock:
+            pool_handle = self._pool_handle
+            self._pool_handle = None
+        self._retire_pool(pool_handle)
+
+
+class ValidationRequestHandler(BaseHTTPRequestHandler):
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/stats":
+            self._send_json(service.stats.report())
+        elif self.path == "/health":
+            self._send_json({"version": VERSION, "schema": service.schema_files()})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        service = self.server.service
+        if self.path != "/validate":
+            self._send_json({"error": "not found"}, 404)
+            return
+
+        time_start = time.time()
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0 or length > self.server.max_body_bytes:
+            service.stats.add_request(0, time.time() - time_start, error=True)
+            self._send_json({"error": u"Content-Length must be 0 to {} bytes".format(self.server.max_body_bytes)}, 413)
+            return
+
+        try:
+            lines = self.rfile.read(length).decode("utf-8").splitlines()
+            ret = service.validate_lines(lines)
+        except Exception as e:
+            logging.exception(u"failed to validate")
+            service.stats.add_request(0, time.time() - time_start, error=True)
+            self._send_json({"error": u"{}".format(e)}, 500)
+            return
+        service.stats.add_request(len(ret["items"]), time.time() - time_start)
+        self._send_json(ret)
+
+    def log_message(self, format, *args):
+        # client_address is empty on a unix socket
+        logging.debug(format % args)
+
+
+class ValidationHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ValidationUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def start_validation_server(service, host="127.0.0.1", port=8765, unix_socket=None, reload_interval=2, max_body_bytes=MAX_BODY_BYTES):
+    """
+        start serving in background threads, return the server; stop with
+        server.shutdown() and service.close()
+    """
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ValidationUnixServer(unix_socket, ValidationRequestHandler)
+    else:
+        server = ValidationHTTPServer((host, port), ValidationRequestHandler)
+    server.service = service
+    server.max_body_bytes = max_body_bytes
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    if reload_interval:
+        def _watch():
+            while server.service is not None:
+                time.sleep(reload_interval)
+                service.check_reload()
+        thread = threading.Thread(target=_watch)
+        thread.daemon = True
+        thread.start()
+
+    logging.info(u"validation server on {}".format(unix_socket or server.server_address))
+    return server
+
+
+def task_validate_server(args):
+    schema_filename = args.get("input_schema") or "schema/cns_top.jsonld"
+    service = ValidationService(schema_filename, args.get("schema_dir"), workers=int(args.get("workers") or 1))
+    server = start_validation_server(service,
+        host=args.get("host") or "127.0.0.1",
+        port=int(args.get("port") or 8765),
+        unix_socket=args.get("unix_socket"),
+        reload_interval=float(args.get("reload_interval") or 2),
+        max_body_bytes=int(args.get("max_body_bytes") or MAX_BODY_BYTES))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.service = None
+        service.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='[%(levelname)s][%(asctime)s][%(module)s][%(funcName)s][%(lineno)s] %(message)s', level=logging.INFO)
+    logging.getLogger("requests").setLevel(logging.WARNING)
+
+    optional_params = {
+        '--input_schema': 'input schema',
+        '--schema_dir': 'input schema',
+        '--host': 'listen address, default 127.0.0.1',
+        '--port': 'listen port, default 8765',
+        '--unix_socket': 'listen on this unix socket instead of host/port',
+        '--workers': 'number of worker processes',
+        '--reload_interval': 'seconds between checks of schema file changes, default 2',
+        '--max_body_bytes': 'largest request body, default 64MB',
+    }
+    main_subtask(__name__, optional_params=optional_params)
+
+"""
+    python kgtool/cns_validate_server.py task_validate_server --input_schema=schema/cns_organization_v2.0.jsonld --schema_dir=schema --workers=4
+    curl -s --data-binary @local/kg4ai_cn_1.0.1.jsondl http://127.0.0.1:8765/validate
+    curl -s http://127.0.0.1:8765/stats
+
+    python kgtool/cns_validate_server.py task_validate_server --input_schema=schema/cns_organization_v2.0.jsonld --schema_dir=schema --unix_socket=local/validate.sock
+    curl -s --unix-socket local/validate.sock --data-binary @local/kg4ai_cn_1.0.1.jsondl http://localhost/validate
+"""
@@ -16,6 +16,14 @@ import argparse
 import re
 import collections
 import decimal
+import io
+import threading
+import contextlib
+from json.encoder import encode_basestring_ascii as _json_encode_basestring_ascii
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
 # global constants
 VERSION = 'v20180305'
@@ -30,7 +38,9 @@ def main_subtask(module_name, method_prefixs=["task_"], optional_params={}):
     """
     parser = argparse.ArgumentParser(description="")
     parser.add_argument('method_name', help='')
-    for optional_param_key, optional_param_help in optional_params.items():
+    optional_params_all = dict(PROFILE_PARAMS)
+    optional_params_all.update(optional_params)
+    for optional_param_key, optional_param_help in optional_params_all.items():
         parser.add_argument(optional_param_key,
                             required=False,
                             help=optional_param_help)
@@ -50,19 +60,24 @@ def main_subtask(module_name, method_prefixs=["task_"], optional_params={}):
             # http://stackoverflow.com/questions/17734618/dynamic-method-call-in-python-2-7-using-strings-of-method-names
             the_method = getattr(sys.modules[module_name], args.method_name)
             if the_method:
-                if vars(args).get("cprofile"):
-                    import cProfile, pstats, StringIO
-                    pr = cProfile.Profile()
-                    pr.enable()
+                profilers = [x.strip() for x in (vars(args).get("profile") or "").split(",") if x.strip()]
+                if vars(args).get("cprofile") and "cprofile" not in profilers:
+                    profilers.append("cprofile")
 
+                if profilers:
+                    profiler = TaskProfiler(profilers, output=vars(args).get("profile_output"))
+                    profiler.start()
                     the_method(args=vars(args))
-
-                    pr.disable()
-                    s = StringIO.StringIO()
-                    sortby = 'cumulative'
-                    ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-                    ps.print_stats()
-                    print (s.getvalue())
+                    profiler.stop()
+
+                    ret = profiler.report(args.method_name, module_name)
+                    if vars(args).get("cprofile"):
+                        profiler.print_cprofile()
+                    if profiler.output:
+                        json2file(ret, profiler.output)
+                        logging.info(u"profile {}".format(profiler.output))
+                    else:
+                        logging.info(json4debug(ret))
                 else:
                     the_method(args=vars(args))
 
@@ -74,6 +89,193 @@ def main_subtask(module_name, method_prefixs=["task_"], optional_params={}):
     logging.info("unsupported")
 
 
+###############
+#  profiling
+PROFILE_PARAMS = {
+    '--profile': 'comma separated profilers: cprofile,tracemalloc,timer',
+    '--profile_output': 'profile report json file, cprofile stats go to {profile_output}.pstats',
+}
+
+
+class StageTimer():
+    """
+        wall clock and cpu seconds per stage, library code wraps its phases
+
+            with profile_stage("validate"):
+                ...
+
+        nested stages are named by path, e.g. "validate/rewrite"
+    """
+    def __init__(self):
+        self.enabled = False
+        self.stages = collections.OrderedDict()
+        self._path = []
+
+    def reset(self):
+        self.stages = collections.OrderedDict()
+        self._path = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        self._path.append(name)
+        key = u"/".join(self._path)
+        start_wall = time.time()
+        start_cpu = _cpu_time()
+        try:
+            yield
+        finally:
+            stat = self.stages.get(key)
+            if stat is None:
+                stat = {"count": 0, "wall": 0.0, "cpu": 0.0}
+                self.stages[key] = stat
+            stat["count"] += 1
+            stat["wall"] += time.time() - start_wall
+            stat["cpu"] += _cpu_time() - start_cpu
+            self._path.pop()
+
+    def report(self):
+        ret = collections.OrderedDict()
+        for key, stat in self.stages.items():
+            ret[key] = {
+                "count": stat["count"],
+                "wall": round(stat["wall"], 6),
+                "cpu": round(stat["cpu"], 6),
+            }
+        return ret
+
+
+def _cpu_time():
+    if hasattr(time, "process_time"):
+        return time.process_time()
+    return time.clock()
+
+
+PROFILE_TIMER = StageTimer()
+
+
+def profile_stage(name):
+    """
+        time a stage with the process wide timer, no-op unless --profile=timer
+    """
+    return PROFILE_TIMER.stage(name)
+
+
+class TaskProfiler():
+    """
+        run selected profilers around one task and collect a json report
+        * cprofile: top functions by cumulative time, full stats dumped to
+          {output}.pstats for pstats/snakeviz
+        * tracemalloc: peak memory and top allocation lines (python3 only)
+        * timer: stages recorded by profile_stage
+    """
+    PROFILER_LIST = ["cprofile", "tracemalloc", "timer"]
+
+    def __init__(self, profilers, output=None, top=30):
+        for name in profilers:
+            if name not in self.PROFILER_LIST:
+                raise Exception("unsupported profiler {}, expect {}".format(name, self.PROFILER_LIST))
+        self.profilers = profilers
+        self.output = output
+        self.top = top
+
+        self._cprofile = None
+        self._tracemalloc = None
+        self.result = {}
+
+    def start(self):
+        self.result = {}
+        if "timer" in self.profilers:
+            PROFILE_TIMER.reset()
+            PROFILE_TIMER.enabled = True
+
+        if "tracemalloc" in self.profilers:
+            try:
+                import tracemalloc
+                self._tracemalloc = tracemalloc
+                tracemalloc.start()
+            except ImportError:
+                logging.warning("tracemalloc is not available")
+
+        if "cprofile" in self.profilers:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+
+        self._start_wall = time.time()
+        self._start_cpu = _cpu_time()
+        if self._cprofile:
+            self._cprofile.enable()
+
+    def stop(self):
+        if self._cprofile:
+            self._cprofile.disable()
+
+        self.result["wall"] = round(time.time() - self._start_wall, 6)
+        self.result["cpu"] = round(_cpu_time() - self._start_cpu, 6)
+
+        if "timer" in self.profilers:
+            PROFILE_TIMER.enabled = False
+            self.result["stages"] = PROFILE_TIMER.report()
+
+        if self._tracemalloc:
+            snapshot = self._tracemalloc.take_snapshot()
+            current, peak = self._tracemalloc.get_traced_memory()
+            self._tracemalloc.stop()
+            top = []
+            for stat in snapshot.statistics("lineno")[:self.top]:
+                frame = stat.traceback[0]
+                top.append({
+                    "location": u"{}:{}".format(frame.filename, frame.lineno),
+                    "size": stat.size,
+                    "count": stat.count,
+                })
+            self.result["tracemalloc"] = {
+                "current": current,
+                "peak": peak,
+                "top": top,
+            }
+
+        if self._cprofile:
+            import pstats
+            ps = pstats.Stats(self._cprofile)
+            top = []
+            for func, stat in ps.stats.items():
+                cc, nc, tt, ct, callers = stat
+                top.append({
+                    "function": u"{}:{}({})".format(*func),
+                    "ncalls": nc,
+                    "tottime": round(tt, 6),
+                    "cumtime": round(ct, 6),
+                })
+            top = sorted(top, key=lambda x: (-x["cumtime"], x["function"]))
+            self.result["cprofile"] = {"top": top[:self.top]}
+            if self.output:
+                filename = u"{}.pstats".format(self.output)
+                ps.dump_stats(filename)
+                self.result["cprofile"]["dump_file"] = filename
+
+    def print_cprofile(self, sortby='cumulative'):
+        if self._cprofile:
+            import pstats
+            pstats.Stats(self._cprofile, stream=sys.stdout).sort_stats(sortby).print_stats()
+
+    def report(self, task=None, module=None):
+        ret = collections.OrderedDict()
+        ret["task"] = task
+        ret["module"] = module
+        ret["argv"] = sys.argv[1:]
+        ret["python"] = sys.version.split()[0]
+        ret["timestamp"] = datetime.datetime.now().isoformat()[0:19]
+        ret["profilers"] = self.profilers
+        for key in ["wall", "cpu", "stages", "cprofile", "tracemalloc"]:
+            if key in self.result:
+                ret[key] = self.result[key]
+        return ret
+
+
 ###############
 #  file utilities
 
@@ -90,6 +292,230 @@ def file2abspath(filename, this_file=__file__):
         os.path.join(os.path.dirname(os.path.abspath(this_file)), filename))
 
 
+####################################
+# json codec
+
+# objects used to check that a backend reads and writes json exactly like
+# the stdlib json module (sort_keys=True)
+JSON_CODEC_PROBE = [
+    {"name": "张三", "@type": ["Person", "Thing"], "url": "http://cnschema.org/a/b",
+     "age": 30, "height": 1.75, "ratio": 1e-07, "big": 100000.0, "id": 9223372036854775807,
+     "flag": True, "none": None, "text": "tab\t \"quote\" \\ \u2028 \U0001f600",
+     "nested": {"b": [], "a": {}, "c": [{"z": 1, "y": [0.1, -0.5]}]}},
+    ["a", 1, -1, 0.0, False],
+    "text",
+]
+
+# integers with 19+ digits may overflow 64 bits, which some backends
+# silently read as float. the regex only runs on text with 19+ digits,
+# counted by deleting the digits of its utf-8 bytes
+JSON_REGEX_BIGINT = re.compile(b"[0-9]{19}")
+JSON_BIGINT_DIGITS = b"0123456789"
+
+
+def _json_has_bigint(text):
+    if isinstance(text, bytes):
+        data = text
+    else:
+        data = text.encode("utf-8")
+    if len(data) - len(data.translate(None, JSON_BIGINT_DIGITS)) < 19:
+        return False
+    return JSON_REGEX_BIGINT.search(data) is not None
+
+
+def _json_dumps_stdlib(data, ensure_ascii=False):
+    return json.dumps(data, ensure_ascii=ensure_ascii, sort_keys=True)
+
+
+def _json_backend_list():
+    """
+        available json backends, fastest first: [name, loads, dumps, bigint_safe]
+    """
+    backends = []
+    try:
+        import orjson
+
+        def _dumps(data, ensure_ascii=False):
+            return orjson.dumps(data, option=orjson.OPT_SORT_KEYS).decode("utf-8")
+        backends.append(["orjson", orjson.loads, _dumps, False])
+    except ImportError:
+        pass
+
+    try:
+        import ujson
+
+        def _dumps(data, ensure_ascii=False):
+            return ujson.dumps(data, ensure_ascii=ensure_ascii, sort_keys=True, escape_forward_slashes=False)
+        backends.append(["ujson", ujson.loads, _dumps, False])
+    except ImportError:
+        pass
+
+    backends.append(["json", json.loads, _json_dumps_stdlib, True])
+    return backends
+
+
+def _json_backend_check(backend):
+    """
+        return [loads_ok, dumps_ok], whether the backend gives exactly the
+        same result as the stdlib json module on JSON_CODEC_PROBE
+    """
+    name, loads, dumps, bigint_safe = backend
+    loads_ok = True
+    dumps_ok = True
+    for data in JSON_CODEC_PROBE:
+        for ensure_ascii in [True, False]:
+            text = _json_dumps_stdlib(data, ensure_ascii)
+            try:
+                if loads(text) != data:
+                    loads_ok = False
+            except Exception:
+                loads_ok = False
+
+            try:
+                if dumps(data, ensure_ascii) != text:
+                    dumps_ok = False
+            except Exception:
+                dumps_ok = False
+    return [loads_ok, dumps_ok]
+
+
+class JsonCodec():
+    """
+        json loads/dumps using the fastest available backend
+        (orjson, ujson), falling back to the stdlib json module.
+
+        a backend is used for loads/dumps only if it passes the probe check,
+        so parsed values and canonical output (sort_keys=True) stay the same
+        as stdlib json, and so do hashes from any2sha1/any2sha256.
+        orjson and ujson write compact separators, so dumps stays on stdlib
+        json; loads uses the fast backend.
+        set environment variable KGTOOL_JSON_BACKEND=json to force stdlib.
+    """
+    def __init__(self, backend_name=None):
+        self.loads_name = "json"
+        self._loads = json.loads
+        self._loads_bigint_safe = True
+        self.dumps_name = "json"
+        self._dumps = _json_dumps_stdlib
+
+        for backend in _json_backend_list():
+            name, loads, dumps, bigint_safe = backend
+            if backend_name and name != backend_name:
+                continue
+
+            loads_ok, dumps_ok = _json_backend_check(backend)
+            if loads_ok and self.loads_name == "json":
+                self.loads_name = name
+                self._loads = loads
+                self._loads_bigint_safe = bigint_safe
+            if dumps_ok and self.dumps_name == "json":
+                self.dumps_name = name
+                self._dumps = dumps
+
+    def loads(self, text):
+        """
+            parse json text; if the backend fails or may lose integer
+            precision, parse again with stdlib json
+        """
+        if not self._loads_bigint_safe and _json_has_bigint(text):
+            return json.loads(text)
+        try:
+            return self._loads(text)
+        except ValueError:
+            return json.loads(text)
+
+    def dumps(self, data, ensure_ascii=False):
+        """
+            canonical json string, same as json.dumps(data, sort_keys=True)
+        """
+        return self._dumps(data, ensure_ascii)
+
+
+JSON_CODEC = JsonCodec(os.environ.get("KGTOOL_JSON_BACKEND"))
+
+
+def json_loads(text):
+    return JSON_CODEC.loads(text)
+
+
+def json_dumps(data, ensure_ascii=False):
+    return JSON_CODEC.dumps(data, ensure_ascii)
+
+
+####################################
+# compressed file
+
+COMPRESSION_EXTENSION = {
+    ".gz": "gzip",
+    ".bz2": "bz2",
+    ".xz": "xz",
+}
+
+COMPRESSION_MAGIC = [
+    [b"\x1f\x8b", "gzip"],
+    [b"BZh", "bz2"],
+    [b"\xfd7zXZ\x00", "xz"],
+]
+
+
+def file2compression(filename, mode="r"):
+    """
+        detect compression of a file: gzip, bz2, xz or None
+        * use file extension first
+        * for existing file opened for read, check magic bytes
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in COMPRESSION_EXTENSION:
+        return COMPRESSION_EXTENSION[ext]
+
+    if mode.startswith("r") and os.path.isfile(filename):
+        with open(filename, "rb") as f:
+            head = f.read(6)
+        for magic, compression in COMPRESSION_MAGIC:
+            if head.startswith(magic):
+                return compression
+
+    return None
+
+
+def _open_compressed(filename, mode, compression):
+    """
+        open a compressed file in binary mode, data is (de)compressed
+        block by block while streaming
+    """
+    mode = mode.replace("b", "").replace("t", "") + "b"
+    if compression == "gzip":
+        import gzip
+        return gzip.open(filename, mode)
+    elif compression == "bz2":
+        import bz2
+        return bz2.BZ2File(filename, mode)
+    elif compression == "xz":
+        try:
+            import lzma
+        except ImportError:
+            from backports import lzma
+        return lzma.open(filename, mode)
+    else:
+        raise Exception("unsupported compression {}".format(compression))
+
+
+def file2open(filename, mode="r", encoding='utf-8'):
+    """
+        open a text file like codecs.open, transparently decompress
+        gzip/bz2/xz input and compress output named *.gz, *.bz2, *.xz
+    """
+    compression = file2compression(filename, mode)
+    if compression is None:
+        return codecs.open(filename, mode, encoding=encoding)
+
+    f = _open_compressed(filename, mode, compression)
+    if mode.startswith("r"):
+        return codecs.getreader(encoding)(f)
+    else:
+        return codecs.getwriter(encoding)(f)
+
+
 ####################################
 # read from file
 
@@ -97,8 +523,8 @@ def file2json(filename, encoding='utf-8'):
     """
         save a line
     """
-    with codecs.open(filename, "r", encoding=encoding) as f:
-        return json.load(f)
+    with file2open(filename, "r", encoding=encoding) as f:
+        return json_loads(f.read())
 
 
 def file2iter(filename, encoding='utf-8', comment_prefix="#",
@@ -106,9 +532,7 @@ def file2iter(filename, encoding='utf-8', comment_prefix="#",
     """
         json stream parsing or line parsing
     """
-    ret = list()
-    visited = set()
-    with codecs.open(filename, encoding=encoding) as f:
+    with file2open(filename, encoding=encoding) as f:
         for line in f:
             line = line.strip()
             # skip empty line
@@ -122,6 +546,115 @@ def file2iter(filename, encoding='utf-8', comment_prefix="#",
             yield line
 
 
+def file2shards(filename, shard_count=1):
+    """
+        split a file into newline-aligned byte ranges [start, end),
+        each range can be read independently by file2iter4shard.
+        compressed file cannot be split, it is always one shard.
+    """
+    size = os.path.getsize(filename)
+    if file2compression(filename):
+        return [[0, size]]
+
+    shard_count = max(1, min(shard_count, size))
+
+    boundaries = [0]
+    with open(filename, "rb") as f:
+        for idx in range(1, shard_count):
+            offset = size * idx // shard_count
+            if offset <= boundaries[-1]:
+                continue
+            # move to the start of the first line after offset-1
+            f.seek(offset - 1)
+            f.readline()
+            offset = f.tell()
+            if offset >= size:
+                break
+            if offset > boundaries[-1]:
+                boundaries.append(offset)
+    boundaries.append(size)
+
+    return [[boundaries[idx], boundaries[idx + 1]]
+            for idx in range(len(boundaries) - 1)]
+
+
+def file2iter4shard(filename, shard, encoding='utf-8', comment_prefix="#",
+                    skip_empty_line=True):
+    """
+        same as file2iter, only read lines within the byte range of shard
+    """
+    start, end = shard
+    if file2compression(filename):
+        assert start == 0
+        for line in file2iter(filename, encoding, comment_prefix, skip_empty_line):
+            yield line
+        return
+
+    with open(filename, "rb") as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+
+            line = line.decode(encoding).strip()
+            # skip empty line
+            if skip_empty_line and len(line) == 0:
+                continue
+
+            # skip comment line
+            if comment_prefix and line.startswith(comment_prefix):
+                continue
+
+            yield line
+
+
+def _run_shard_func(task):
+    shard_func, filename, shard, kwargs = task
+    return shard_func(filename, shard, **kwargs)
+
+
+def file2iter4parallel(filename, shard_func, workers=1, ordered=True,
+                       shard_count=None, **kwargs):
+    """
+        split filename into shards, call shard_func(filename, shard, **kwargs)
+        on each shard using a process pool, yield the per-shard results.
+        * shard_func must be a module level function (picklable)
+        * ordered=True yields results in file order, otherwise yields results
+          as soon as they are ready
+        * workers<=1 runs all shards in the current process
+    """
+    workers = max(1, workers or 1)
+    if shard_count is None:
+        shard_count = workers * 4 if workers > 1 else 1
+
+    tasks = [[shard_func, filename, shard, kwargs]
+             for shard in file2shards(filename, shard_count)]
+
+    if workers == 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield _run_shard_func(task)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(min(workers, len(tasks)))
+    try:
+        if ordered:
+            results = pool.imap(_run_shard_func, tasks)
+        else:
+            results = pool.imap_unordered(_run_shard_func, tasks)
+        for result in results:
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
 ####################################
 # write to file
 
@@ -129,7 +662,7 @@ def json2file(data, filename, encoding='utf-8'):
     """
         write json in canonical json format
     """
-    with codecs.open(filename, "w", encoding=encoding) as f:
+    with file2open(filename, "w", encoding=encoding) as f:
         json.dump(data, f, ensure_ascii=False, indent=4, sort_keys=True)
 
 
@@ -137,7 +670,7 @@ def lines2file(lines, filename, encoding='utf-8'):
     """
         write json stream, write lines too
     """
-    with codecs.open(filename, "w", encoding=encoding) as f:
+    with file2open(filename, "w", encoding=encoding) as f:
         for line in lines:
             f.write(line)
             f.write("\n")
@@ -145,12 +678,273 @@ def lines2file(lines, filename, encoding='utf-8'):
 
 def items2file(items, filename, encoding='utf-8', modifier='w'):
     """
-        json array to file, canonical json format
+        json array to file, canonical json format, written in place (use
+        ItemWriter for a temp file plus rename and fsync)
+    """
+    with ItemWriter(filename, encoding=encoding, modifier=modifier, atomic=False) as writer:
+        writer.write_items(items)
+
+
+class ItemWriter():
+    """
+        write items to a file as canonical json lines (same as items2file)
+        * items are serialized in batches and written through a large buffer
+        * background=True writes batches in a thread, so encoding the next
+          batch overlaps with disk I/O
+        * in "w" mode the output goes to a temp file, which is renamed into
+          place by close(); a failed job (exception inside with) removes the
+          temp file and never leaves a half-written output
+        * fsync_every=N flushes and fsyncs every N items
+        * close() fsyncs the output if atomic or fsync_every, special files
+          (pipes, /dev/stdout) are never fsynced
     """
-    with codecs.open(filename, modifier, encoding=encoding) as f:
+    def __init__(self, filename, encoding='utf-8', modifier='w',
+                 batch_size=1000, buffer_size=1024 * 1024, background=False,
+                 atomic=True, fsync_every=0):
+        self.filename = filename
+        self.encoding = encoding
+        self.batch_size = batch_size
+        self.fsync_every = fsync_every
+
+        # append and special files (e.g. /dev/stdout) are written in place
+        if modifier.startswith("a"):
+            atomic = False
+        elif os.path.exists(filename) and not os.path.isfile(filename):
+            atomic = False
+
+        if atomic:
+            dirname, basename = os.path.split(os.path.abspath(filename))
+            self.filename_output = os.path.join(
+                dirname, u".{}.tmp{}".format(basename, os.getpid()))
+        else:
+            self.filename_output = filename
+
+        compression = file2compression(filename, modifier)
+        if compression:
+            self._file = _open_compressed(self.filename_output, modifier, compression)
+        else:
+            self._file = io.open(self.filename_output, modifier.replace("b", "") + "b",
+                                 buffering=buffer_size)
+
+        # fsync fails on pipes and character devices
+        self._flag_fsync = (atomic or fsync_every) and os.path.isfile(self.filename_output)
+
+        self.cnt_item = 0
+        self._batch = []
+        self._cnt_item_fsync = 0
+        self._closed = False
+
+        self._queue = None
+        self._thread = None
+        self._thread_error = None
+        if background:
+            self._queue = Queue.Queue(maxsize=8)
+            self._thread = threading.Thread(target=self._run_background)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run_background(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            if self._thread_error is not None:
+                continue
+            try:
+                self._write_bytes(*task)
+            except Exception as e:
+                self._thread_error = e
+
+    def _write_bytes(self, data, flag_fsync):
+        self._file.write(data)
+        if flag_fsync:
+            self._fsync()
+
+    def _fsync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _check_background(self):
+        if self._thread_error is not None:
+            raise self._thread_error
+
+    def write(self, item):
+        self._batch.append(item)
+        if len(self._batch) >= self.batch_size:
+            self.flush_batch()
+
+    def write_items(self, items):
         for item in items:
-            f.write(u"{}\n".format(json.dumps(
-                item, ensure_ascii=False, sort_keys=True)))
+            self.write(item)
+
+    def write_file(self, filename, chunk_size=1024 * 1024):
+        """
+            append the bytes of an uncompressed json lines file (e.g. written
+            by another ItemWriter) after the items written so far
+        """
+        self.flush_batch()
+        with io.open(filename, "rb") as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                if self._queue is not None:
+                    self._check_background()
+                    self._queue.put([data, False])
+                else:
+                    self._write_bytes(data, False)
+
+    def flush_batch(self):
+        """
+            serialize buffered items, hand them over to the file (or thread)
+        """
+        if not self._batch:
+            return
+
+        lines = [json_dumps(item) for item in self._batch]
+        lines.append(u"")
+        data = u"\n".join(lines).encode(self.encoding)
+
+        self.cnt_item += len(self._batch)
+        self._cnt_item_fsync += len(self._batch)
+        self._batch = []
+
+        flag_fsync = False
+        if self.fsync_every and self._cnt_item_fsync >= self.fsync_every:
+            flag_fsync = self._flag_fsync
+            self._cnt_item_fsync = 0
+
+        if self._queue is not None:
+            self._check_background()
+            self._queue.put([data, flag_fsync])
+        else:
+            self._write_bytes(data, flag_fsync)
+
+    def _stop_background(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """
+            write everything, fsync, move the temp file into place
+        """
+        if self._closed:
+            return
+        try:
+            try:
+                self.flush_batch()
+            finally:
+                self._stop_background()
+            self._check_background()
+            self._file.close()
+            if self._flag_fsync:
+                # the compressed stream is complete only after close
+                fd = os.open(self.filename_output, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        except:
+            self.abort()
+            raise
+
+        self._closed = True
+        if self.filename_output != self.filename:
+            os.rename(self.filename_output, self.filename)
+
+    def abort(self):
+        """
+            stop writing, remove the temp file
+        """
+        if self._closed:
+            return
+        self._batch = []
+        self._closed = True
+        try:
+            self._stop_background()
+            self._file.close()
+        except Exception as e:
+            # already failing, keep the error that made us abort
+            logging.warning(u"abort {}: {}".format(self.filename, e))
+        if self.filename_output != self.filename and os.path.exists(self.filename_output):
+            os.remove(self.filename_output)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ExternalSorter():
+    """
+        sort more lines than fit in memory, same order as sorted(lines)
+        * append() buffers up to buffer_size lines, a full buffer is sorted
+          and spilled to a temp file (a run) as json strings, so lines may
+          contain newline
+        * iterating k-way merges the runs and the buffer, equal lines keep
+          their order of arrival like sorted()
+        * close() removes the runs
+    """
+    def __init__(self, buffer_size=1000000, temp_dir=None):
+        self.buffer_size = buffer_size
+        self.temp_dir = temp_dir
+        self.cnt_line = 0
+        self._buffer = []
+        self._runs = []
+
+    def append(self, line):
+        self._buffer.append(line)
+        self.cnt_line += 1
+        if len(self._buffer) >= self.buffer_size:
+            self._spill()
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def _spill(self):
+        import tempfile
+        fd, filename = tempfile.mkstemp(suffix=".sortrun", dir=self.temp_dir)
+        os.close(fd)
+        self._runs.append(filename)
+        self._buffer.sort()
+        items2file(self._buffer, filename)
+        self._buffer = []
+
+    def _iter_run(self, filename):
+        with io.open(filename, "rb") as f:
+            for line in f:
+                yield json_loads(line.decode("utf-8"))
+
+    def __iter__(self):
+        self._buffer.sort()
+        if not self._runs:
+            return iter(self._buffer)
+
+        import heapq
+        logging.info(u"merge {} lines from {} runs".format(self.cnt_line, len(self._runs)))
+        runs = [self._iter_run(filename) for filename in self._runs]
+        runs.append(iter(self._buffer))
+        return heapq.merge(*runs)
+
+    def close(self):
+        for filename in self._runs:
+            if os.path.exists(filename):
+                os.remove(filename)
+        self._runs = []
+        self._buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 ####################################
@@ -172,6 +966,106 @@ def json_get(json_object, property_path, default=None):
     return temp.get(property_path[-1], default)
 
 
+class JsonPathProjector():
+    """
+        compile many property paths once, then get all their values from
+        each item in a single walk, same result as json_get(item, path, default)
+
+        property_paths: list of paths, a path is a list of fields or a dotted
+        string, e.g. ["father", "name"] or "father.name"
+
+        projector = JsonPathProjector(["name", "father.name", "father.birthPlace.name"])
+        for row in projector.project_items(items):   # row is a tuple
+            ...
+    """
+    def __init__(self, property_paths, default=None):
+        self.default = default
+        self.property_paths = []
+        self.columns = []
+        for path in property_paths:
+            if not isinstance(path, list):
+                path = path.split(".")
+            assert path
+            self.property_paths.append(path)
+            self.columns.append(u".".join(path))
+
+        # prefix tree, node = {field: [leaf column indices, child node, all column indices in subtree]}
+        root = {}
+        for idx, path in enumerate(self.property_paths):
+            node = root
+            for depth, field in enumerate(path):
+                if field not in node:
+                    node[field] = [[], {}, []]
+                entry = node[field]
+                entry[2].append(idx)
+                if depth == len(path) - 1:
+                    entry[0].append(idx)
+                node = entry[1]
+
+        self._tree = self._compile(root)
+
+    def _compile(self, node):
+        return tuple([(field, tuple(leaf), self._compile(child) if child else None, tuple(subtree))
+                      for field, (leaf, child, subtree) in node.items()])
+
+    def _walk(self, tree, temp, row):
+        if not isinstance(temp, dict):
+            # invalid path
+            for field, leaf, child, subtree in tree:
+                for idx in subtree:
+                    row[idx] = None
+            return
+
+        default = self.default
+        for field, leaf, child, subtree in tree:
+            if leaf:
+                v = temp.get(field, default)
+                for idx in leaf:
+                    row[idx] = v
+            if child:
+                self._walk(child, temp.get(field, {}), row)
+
+    def project(self, json_object):
+        """
+            tuple of values, one per property path
+        """
+        row = [None] * len(self.property_paths)
+        self._walk(self._tree, json_object, row)
+        return tuple(row)
+
+    def project_items(self, items):
+        for item in items:
+            yield self.project(item)
+
+    def project_columns(self, items):
+        """
+            columnar batch, {dotted path: [values]}, one value per item
+        """
+        columns = [[] for _ in self.property_paths]
+        for item in items:
+            row = self.project(item)
+            for idx, v in enumerate(row):
+                columns[idx].append(v)
+
+        ret = collections.OrderedDict()
+        for idx, column in enumerate(self.columns):
+            ret[column] = columns[idx]
+        return ret
+
+    def iter_columns(self, items, batch_size=10000):
+        """
+            columnar batches of at most batch_size items
+        """
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield self.project_columns(batch)
+                batch = []
+        if batch:
+            yield self.project_columns(batch)
+
+
 def json_get_list(json_object, p):
     v = json_object.get(p, [])
     if isinstance(v, list):
@@ -243,6 +1137,83 @@ def json4debug(json_data, sort_keys=True):
     return json.dumps(json_data, ensure_ascii=False, indent=4, sort_keys=sort_keys, default=_json_convert_default)
 
 
+####################################
+# cache
+
+class LruCache():
+    """
+        bounded cache that keeps recently used entries, counts hit/miss
+        entries live in two generations of max_size/2: a hit in the old
+        generation moves the entry to the new one, when the new generation
+        is full the old one is dropped. cheaper than a linked list LRU,
+        a hit is one dict lookup
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.generation_size = max(1, max_size // 2)
+        self.cnt_hit = 0
+        self.cnt_miss = 0
+        self._data = {}
+        self._old = {}
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            try:
+                value = self._old.pop(key)
+            except KeyError:
+                self.cnt_miss += 1
+                return default
+            self._set(key, value)
+        self.cnt_hit += 1
+        return value
+
+    def _set(self, key, value):
+        if len(self._data) >= self.generation_size:
+            self._old = self._data
+            self._data = {}
+        self._data[key] = value
+
+    def put(self, key, value):
+        if key in self._data:
+            self._data[key] = value
+        else:
+            self._old.pop(key, None)
+            self._set(key, value)
+
+    def clear(self):
+        self._data = {}
+        self._old = {}
+
+    @property
+    def stats(self):
+        return collections.Counter({"hit": self.cnt_hit, "miss": self.cnt_miss})
+
+    def hit_rate(self):
+        total = self.cnt_hit + self.cnt_miss
+        if total == 0:
+            return 0.0
+        return 1.0 * self.cnt_hit / total
+
+    def __len__(self):
+        return len(self._data) + len(self._old)
+
+    def __contains__(self, key):
+        return key in self._data or key in self._old
+
+
+def frozen_dict(data):
+    """
+        read only view of a dict (a plain dict copy in python2)
+    """
+    try:
+        from types import MappingProxyType
+    except ImportError:
+        return dict(data)
+    return MappingProxyType(dict(data))
+
+
 ####################################
 # data conversion
 
@@ -295,23 +1266,29 @@ def any2unicode(data):
         return data
 
 
+try:
+    _TEXT_TYPE = unicode
+except NameError:
+    _TEXT_TYPE = str
+
+
 def any2text(any):
     """
         convert anything to text string (utf-8)
         make it faster when the input is text, unicode, list of text
         reduce usage of json.dumps
     """
-    if isinstance(any, unicode):
+    if isinstance(any, _TEXT_TYPE):
         text = any.encode('utf-8')
-    elif isinstance(any, str):
+    elif isinstance(any, bytes):
         text = any
     elif isinstance(any, list):
         try:
             text = u'___'.join( any ).encode("utf-8")
         except:
-            text = json.dumps(any, sort_keys=True)
+            text = json_dumps(any, ensure_ascii=True).encode("utf-8")
     else:
-        text = json.dumps(any, sort_keys=True)
+        text = json_dumps(any, ensure_ascii=True).encode("utf-8")
 
     return text
 
@@ -322,8 +1299,7 @@ def any2sha1(text):
         it into canonical json string.
     """
     assert text
-    temp = any2text(text)
-    return hashlib.sha1(temp).hexdigest()
+    return CANONICAL_HASHER["sha1"].hash(text)
 
 def any2sha256(text):
     """
@@ -331,13 +1307,259 @@ def any2sha256(text):
         it into canonical json string.
     """
     assert text
-    temp = any2text(text)
-    return hashlib.sha256(temp).hexdigest()
+    return CANONICAL_HASHER["sha256"].hash(text)
+
+
+class CanonicalHasher():
+    """
+        hash anything the same way as any2sha1/any2sha256 (hash of any2text),
+        without the json.dumps round trip per call:
+        * json values are encoded piece by piece (same bytes as
+          json.dumps(sort_keys=True)) straight into the hashlib object, the
+          full json text is never built; encoded strings are memoized
+        * streaming=False encodes the whole value with a reused C json
+          encoder first, faster for small items on python3, but it holds
+          the full text
+        * the hash of a top level list of strings (e.g. the primary keys
+          from gen_cns_link_default_primary_key) goes to a LRU cache, hashes
+          of other values are not memoized
+        * empty input is hashed like any other value
+    """
+    def __init__(self, algorithm="sha256", cache_size=100000, streaming=True):
+        self.algorithm = algorithm
+        self.cache_size = cache_size
+        self.cache = LruCache(cache_size)
+        self.streaming = streaming
+        self._encoded = {}
+        self._encoder = json.JSONEncoder(sort_keys=True, ensure_ascii=True)
+
+    def hash(self, data):
+        if isinstance(data, _TEXT_TYPE):
+            return hashlib.new(self.algorithm, data.encode("utf-8")).hexdigest()
+        elif isinstance(data, bytes):
+            return hashlib.new(self.algorithm, data).hexdigest()
+        elif isinstance(data, list):
+            try:
+                key = tuple(data)
+                ret = self.cache.get(key)
+                if ret is None:
+                    text = u'___'.join(data).encode("utf-8")
+                    ret = hashlib.new(self.algorithm, text).hexdigest()
+                    self.cache.put(key, ret)
+                return ret
+            except Exception:
+                pass
+
+        if self.streaming:
+            h = hashlib.new(self.algorithm)
+            self._encode(data, h.update)
+            return h.hexdigest()
+        text = self._encoder.encode(data).encode("ascii")
+        return hashlib.new(self.algorithm, text).hexdigest()
+
+    def hash_items(self, items, workers=1, chunksize=1000):
+        """
+            list of hashes, one per item; workers>1 uses a process pool
+        """
+        if workers <= 1:
+            return [self.hash(item) for item in items]
+
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        try:
+            tasks = [[self.algorithm, item] for item in items]
+            ret = pool.map(_canonical_hash_task, tasks, chunksize)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return ret
+
+    def _encode(self, data, out):
+        """
+            feed json.dumps(data, sort_keys=True) to out, piece by piece
+        """
+        xtype = type(data)
+        if xtype is _TEXT_TYPE or xtype is str:
+            ret = self._encoded.get(data)
+            if ret is None:
+                if len(self._encoded) >= self.cache_size:
+                    self._encoded.clear()
+                ret = _json_encode_basestring_ascii(data).encode("ascii")
+                self._encoded[data] = ret
+            out(ret)
+        elif xtype is list or xtype is tuple:
+            out(b"[")
+            first = True
+            for v in data:
+                if first:
+                    first = False
+                else:
+                    out(b", ")
+                self._encode(v, out)
+            out(b"]")
+        elif xtype is dict:
+            keys = sorted(data)
+            if not all([type(k) in _JSON_TEXT_TYPES for k in keys]):
+                # non-text keys, let json decide
+                out(json_dumps(data, ensure_ascii=True).encode("ascii"))
+                return
+            out(b"{")
+            first = True
+            for k in keys:
+                if first:
+                    first = False
+                else:
+                    out(b", ")
+                self._encode(k, out)
+                out(b": ")
+                self._encode(data[k], out)
+            out(b"}")
+        elif data is None:
+            out(b"null")
+        elif data is True:
+            out(b"true")
+        elif data is False:
+            out(b"false")
+        elif xtype in _JSON_INT_TYPES:
+            out(str(data).encode("ascii"))
+        elif xtype is float and data == data and data not in _JSON_FLOAT_INF:
+            out(repr(data).encode("ascii"))
+        else:
+            # anything unusual, let json decide (including raising TypeError)
+            out(json_dumps(data, ensure_ascii=True).encode("ascii"))
+
+
+_JSON_TEXT_TYPES = set([_TEXT_TYPE, str])
+_JSON_INT_TYPES = set([int, type(2 ** 64)])
+_JSON_FLOAT_INF = set([float("inf"), float("-inf")])
+
+CANONICAL_HASHER = {
+    "sha1": CanonicalHasher("sha1"),
+    "sha256": CanonicalHasher("sha256"),
+}
+
+
+def _canonical_hash_task(task):
+    algorithm, data = task
+    return CANONICAL_HASHER[algorithm].hash(data)
+
+
+def any2sha1_batch(items, workers=1):
+    """
+        any2sha1 for a list of items, empty items are hashed too
+    """
+    return CANONICAL_HASHER["sha1"].hash_items(items, workers)
+
+
+def any2sha256_batch(items, workers=1):
+    """
+        any2sha256 for a list of items, empty items are hashed too
+    """
+    return CANONICAL_HASHER["sha256"].hash_items(items, workers)
 
 
 ####################################
 # string parser
-def parse_list_value(value, regex=r"[，,、；;／/]"):
+REGEX_LIST_SEPARATOR = r"[，,、；;／/]"
+
+
+class ValueNormalizer():
+    """
+        parse_list_value / normalize_value with precompiled patterns and
+        LRU caches of results keyed by the input string, the same category
+        strings, alias lists and range texts repeat millions of times
+        * stats(): cache hit rate
+        is_empty_string is not cached, strip() is cheaper than a lookup
+    """
+    def __init__(self, cache_size=100000):
+        self.cache_list = LruCache(cache_size)
+        self.cache_value = LruCache(cache_size)
+        self._regex = {}
+        self._regex_empty = re.compile(r"^[\-\.\s]*$")
+
+    def _compile(self, regex):
+        ret = self._regex.get(regex)
+        if ret is None:
+            ret = re.compile(regex)
+            self._regex[regex] = ret
+        return ret
+
+    def parse_list_value(self, value, regex=REGEX_LIST_SEPARATOR):
+        vtype = type(value)
+
+        if vtype in [list]:
+            return [ x.strip() for x in value if x != u'' ]
+        elif isinstance(value, (str, _TEXT_TYPE)):
+            if regex == REGEX_LIST_SEPARATOR:
+                key = value
+            else:
+                key = (regex, value)
+            ret = self.cache_list.get(key)
+            if ret is None:
+                ret = tuple([ x.strip() for x in self._compile(regex).split(value) if x != u'' ])
+                self.cache_list.put(key, ret)
+            # callers may modify the list
+            return list(ret)
+        else:
+            assert False
+
+    def _normalize_string(self, v):
+        v = v.strip()
+        if len(v) == 0:
+            return None
+        elif v in ["null","none"]:
+            return None
+        elif self._regex_empty.search(v):
+            return None
+        return v
+
+    def normalize_value(self, v, option="list2sample"):
+        if v is None:
+            return None
+        xtype = type( v )
+        if xtype in [str]:
+            ret = self.cache_value.get(v, self)
+            if ret is self:
+                ret = self._normalize_string(v)
+                self.cache_value.put(v, ret)
+            return ret
+        elif xtype in [ float, int ]:
+            return "%1.0d" % v
+        elif xtype in [dict, list]:
+            if len(v) == 0:
+                return None
+            else:
+                return v
+        return v
+
+    def is_empty_string(self, text):
+        if text is None:
+            return True
+
+        if isinstance(text, str):
+            if text.strip() == "":
+                return True
+        return False
+
+    def stats(self):
+        ret = {}
+        for name, cache in [["parse_list_value", self.cache_list], ["normalize_value", self.cache_value]]:
+            ret[name] = {
+                "hit": cache.cnt_hit,
+                "miss": cache.cnt_miss,
+                "hit_rate": round(cache.hit_rate(), 4),
+                "size": len(cache),
+            }
+        return ret
+
+
+VALUE_NORMALIZER = ValueNormalizer()
+
+
+def parse_list_value(value, regex=REGEX_LIST_SEPARATOR):
 #    return parseListValue(value, regex)
 #
 #def parseListValue(value, regex=r"[，,、；;／/]"):
@@ -345,25 +1567,10 @@ def parse_list_value(value, regex=r"[，,、；;／/]"):
         parse unicode string into a list
         if the input is not unicode or list, raise exception
     """
-    vtype = type(value)
-
-    if isinstance(value, str):
-        ret = re.split(regex, value)
-    elif vtype in [list]:
-        ret = value
-    else:
-        assert False
-
-    return [ x.strip() for x in ret if x != u'' ]
+    return VALUE_NORMALIZER.parse_list_value(value, regex)
 
 def is_empty_string(text):
-    if text is None:
-        return True
-
-    if isinstance(text, str):
-        if text.strip() == "":
-            return True
-    return False
+    return VALUE_NORMALIZER.is_empty_string(text)
 
 ####################################
 # object processor
@@ -398,48 +1605,91 @@ def normalize_value(v, option="list2sample"):
         otherwise will return the full list
 
     """
-    if v is None:
-        return None
-    xtype = type( v )
-    if xtype in [ float, int ]:
-        return "%1.0d" % v
-    elif xtype in [dict, list]:
-        if len(v) == 0:
-            return None
+    return VALUE_NORMALIZER.normalize_value(v, option)
+
+
+FLAT_KEY_CACHE_SIZE = 100000
+_FLAT_KEY_CACHE = {}
+
+
+def _flat_key(key, k):
+    """
+        dotted key path, cached since the same paths repeat across items
+    """
+    ret = _FLAT_KEY_CACHE.get((key, k))
+    if ret is None:
+        if len(_FLAT_KEY_CACHE) >= FLAT_KEY_CACHE_SIZE:
+            _FLAT_KEY_CACHE.clear()
+        if key:
+            ret = u"{}.{}".format(key, k)
         else:
-            return v
-    elif xtype in [str]:
-        v = v.strip()
-        if len(v) == 0:
-            return None
-        elif v in ["null","none"]:
-            return None
-        elif re.search(r"^[\-\.\s]*$",v):
-            return None
-    return v
+            ret = k
+        _FLAT_KEY_CACHE[(key, k)] = ret
+    return ret
 
 
 def item2flatstr(key, item, ret, option="list2sample"):
-    item = normalize_value(item, option= option)
+    """
+        flatten nested dict into ret, dotted key path => value
+        values are normalized by normalize_value, non-empty lists are
+        serialized as json; iterative, deep items do not hit recursion limit
+    """
+    normalize = VALUE_NORMALIZER.normalize_value
+    item = normalize(item, option)
     if item is None:
         return
 
-    xtype = type(item)
-    if xtype in [dict]:
-        for k, v in item.items():
-            if key:
-                keynew = u"{}.{}".format(key, k)
+    stack = [(key, item)]
+    while stack:
+        key, item = stack.pop()
+        xtype = type(item)
+        if xtype is dict:
+            # reversed, so keys are visited in the same order as dict items
+            for k, v in reversed(list(item.items())):
+                v = normalize(v, option)
+                if v is not None:
+                    stack.append((_flat_key(key, k), v))
+        elif xtype is list:
+            if len(item) == 0:
+                ret[key] = ""
             else:
-                keynew = k
-            item2flatstr(keynew, v, ret, option)
-    elif xtype in [list]:
-        if len(item) == 0:
-            ret[key] = ""
+                ret[key] = json_dumps(item)
         else:
-            ret[key] = json.dumps(item, sort_keys=True, ensure_ascii = False)
-    else:
-        ret[key] = item
+            ret[key] = item
+
+    return ret
+
+
+def items2flatcolumns(items, option="list2sample", default=""):
+    """
+        flatten a list of items into columns, dotted key path => list of
+        values aligned with items, missing values are filled with default
+        columns are ordered by first appearance
+    """
+    items = list(items)
+    ret = collections.OrderedDict()
+    for idx, item in enumerate(items):
+        row = item2flatstr("", item, collections.OrderedDict(), option=option)
+        if not row:
+            continue
+        for key, value in row.items():
+            column = ret.get(key)
+            if column is None:
+                column = [default] * len(items)
+                ret[key] = column
+            column[idx] = value
+    return ret
 
+
+def flatcolumns2rows(columns):
+    """
+        convert columns back to rows, e.g. for json2excel(rows, list(columns), filename)
+    """
+    cnt_row = max([len(column) for column in columns.values()] or [0])
+    ret = [{} for idx in range(cnt_row)]
+    for key, column in columns.items():
+        for idx, value in enumerate(column):
+            ret[idx][key] = value
     return ret
 
 
@@ -460,6 +1710,59 @@ def validateJsonDump(item):
             logging.info(type(item))
 
 
+####################################
+# benchmark
+
+def task_benchmark_json(args):
+    """
+        compare json backends (loads and canonical dumps) on a json lines file
+    """
+    max_lines = int(args.get("limit") or 100000)
+    lines = []
+    for line in file2iter(args["filename"]):
+        lines.append(line)
+        if len(lines) >= max_lines:
+            break
+
+    items = [json.loads(line) for line in lines]
+    expected = [_json_dumps_stdlib(item) for item in items]
+
+    ret = {
+        "filename": args["filename"],
+        "lines": len(lines),
+        "codec_loads": JSON_CODEC.loads_name,
+        "codec_dumps": JSON_CODEC.dumps_name,
+        "backends": {},
+    }
+    for backend in _json_backend_list():
+        name, loads, dumps, bigint_safe = backend
+        loads_ok, dumps_ok = _json_backend_check(backend)
+
+        cnt_error = 0
+        start = time.time()
+        for line in lines:
+            try:
+                loads(line)
+            except ValueError:
+                cnt_error += 1
+        time_loads = time.time() - start
+
+        start = time.time()
+        output = [dumps(item) for item in items]
+        time_dumps = time.time() - start
+
+        ret["backends"][name] = {
+            "probe_loads": loads_ok,
+            "probe_dumps": dumps_ok,
+            "loads_seconds": round(time_loads, 4),
+            "loads_errors": cnt_error,
+            "dumps_seconds": round(time_dumps, 4),
+            "dumps_identical": output == expected,
+        }
+
+    logging.info(json4debug(ret))
+    return ret
+
 
 if __name__ == "__main__":
     logging.basicConfig(format='[%(levelname)s][%(asctime)s][%(module)s][%(funcName)s][%(lineno)s] %(message)s', level=logging.INFO)
@@ -467,7 +1770,8 @@ if __name__ == "__main__":
 
     optional_params = {
         '--filename': 'input filename',
-        '--outdir': 'output dir'
+        '--outdir': 'output dir',
+        '--limit': 'max number of lines',
     }
     main_subtask(__name__, optional_params=optional_params)
 
@@ -475,4 +1779,8 @@ if __name__ == "__main__":
 
     python kgtool/core.py task_download2summary --filename=local/public/eastmoney/price_eastmoney/normal/price_eastmoney_tzzh_all_20170918full.json
 
+    python kgtool/core.py task_benchmark_json --filename=local/jsons/kg.jsons --limit=100000
+
+    python kgtool/core.py task_benchmark_json --filename=local/jsons/kg.jsons --profile=cprofile,tracemalloc,timer --profile_output=local/output/benchmark_json.profile.json
+
 """
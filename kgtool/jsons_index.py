@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Li Ding
+
+# base packages
+import os
+import sys
+import json
+import logging
+import hashlib
+import struct
+import array
+import bisect
+import mmap
+import math
+import heapq
+
+from kgtool.core import *  # noqa
+
+# global constants
+VERSION = 'v20181018'
+CONTEXTS = [os.path.basename(__file__), VERSION]
+
+"""
+sidecar offset index for random access into a json lines (.jsons) file
+
+the index is saved next to the file as {filename}.idx
+ * header: one json line, records source file size/mtime for invalidation
+ * line number => byte offset, array of uint64, line number is counted
+   the same way as file2iter (skip empty and comment lines)
+ * @id => byte offset, two parallel uint64 arrays sorted by 64-bit @id hash
+
+lookups binary search the arrays and read the line from a mmap of the file
+
+IdHashSet is the in-memory counterpart for membership tests, a sorted array
+of 64-bit @id hashes (8 bytes per id), optionally fronted by a BloomFilter
+"""
+
+INDEX_FORMAT_VERSION = 1
+
+
+def _array_uint64():
+    """
+        array of unsigned 64-bit integers, "Q" is not available in python2
+    """
+    try:
+        ret = array.array("Q")
+    except ValueError:
+        ret = array.array("L")
+    assert ret.itemsize == 8
+    return ret
+
+
+def id2hash64(xid):
+    """
+        64-bit hash of an @id
+    """
+    if not isinstance(xid, bytes):
+        xid = xid.encode("utf-8")
+    return struct.unpack("<Q", hashlib.md5(xid).digest()[:8])[0]
+
+
+class BloomFilter():
+    """
+        bloom filter over 64-bit hashes, probes are derived from the two
+        32-bit halves of the hash (double hashing)
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.probes = max(1, int(round(math.log(2) * self.size / capacity)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, id_hash):
+        h1 = id_hash & 0xffffffff
+        h2 = (id_hash >> 32) | 1
+        for idx in range(self.probes):
+            yield (h1 + idx * h2) % self.size
+
+    def add_hash(self, id_hash):
+        for pos in self._positions(id_hash):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def contains_hash(self, id_hash):
+        for pos in self._positions(id_hash):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class IdHashSet():
+    """
+        compact set of @id for membership tests, about 8 bytes per id
+        * add/add_hashes collect hashes, sorted in runs of chunk_size
+        * freeze merges the runs into one sorted array without duplicates,
+          peak memory is about 16 bytes per id
+        * `xid in id_set` is a binary search, two ids colliding on the 64-bit
+          hash are taken as equal
+        bloom_error_rate adds a bloom filter (about 10 bits per id at 1%)
+        checked before the binary search
+    """
+    def __init__(self, bloom_error_rate=None, chunk_size=1000000):
+        self.bloom_error_rate = bloom_error_rate
+        self.chunk_size = chunk_size
+        self.bloom = None
+        self.hashes = _array_uint64()
+        self._runs = []
+        self._pending = _array_uint64()
+
+    def add(self, xid):
+        self.add_hash(id2hash64(xid))
+
+    def add_hash(self, id_hash):
+        self._pending.append(id_hash)
+        if len(self._pending) >= self.chunk_size:
+            self._sort_pending()
+
+    def add_hashes(self, hashes):
+        self._pending.extend(hashes)
+        if len(self._pending) >= self.chunk_size:
+            self._sort_pending()
+
+    def _sort_pending(self):
+        run = _array_uint64()
+        run.extend(sorted(self._pending))
+        self._runs.append(run)
+        self._pending = _array_uint64()
+
+    def freeze(self):
+        """
+            merge everything added so far, must be called before lookups
+        """
+        if len(self._pending) > 0:
+            self._sort_pending()
+        runs = self._runs
+        if len(self.hashes) > 0:
+            runs.append(self.hashes)
+
+        hashes = _array_uint64()
+        prev = None
+        for id_hash in heapq.merge(*runs):
+            if id_hash != prev:
+                hashes.append(id_hash)
+                prev = id_hash
+        self.hashes = hashes
+        self._runs = []
+        self._build_bloom()
+        return self
+
+    def _build_bloom(self):
+        self.bloom = None
+        if self.bloom_error_rate:
+            self.bloom = BloomFilter(len(self.hashes), self.bloom_error_rate)
+            for id_hash in self.hashes:
+                self.bloom.add_hash(id_hash)
+
+    def contains_hash(self, id_hash):
+        if self.bloom is not None and not self.bloom.contains_hash(id_hash):
+            return False
+        idx = bisect.bisect_left(self.hashes, id_hash)
+        return idx < len(self.hashes) and self.hashes[idx] == id_hash
+
+    def __contains__(self, xid):
+        return self.contains_hash(id2hash64(xid))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def save(self, filename):
+        """
+            raw sorted array in native byte order, for worker processes
+            on the same machine
+        """
+        with open(filename, "wb") as f:
+            self.hashes.tofile(f)
+
+    def load(self, filename):
+        hashes = _array_uint64()
+        with open(filename, "rb") as f:
+            hashes.fromfile(f, os.path.getsize(filename) // hashes.itemsize)
+        self.hashes = hashes
+        self._runs = []
+        self._pending = _array_uint64()
+        self._build_bloom()
+        return self
+
+
+def _sort_id_entries(id_hashes, id_offsets):
+    """
+        sorted copy of parallel hash/offset arrays, by hash then offset
+    """
+    order = sorted(range(len(id_hashes)), key=lambda idx: (id_hashes[idx], id_offsets[idx]))
+    run_hashes = _array_uint64()
+    run_offsets = _array_uint64()
+    run_hashes.extend(id_hashes[idx] for idx in order)
+    run_offsets.extend(id_offsets[idx] for idx in order)
+    return run_hashes, run_offsets
+
+
+def _iter_id_entries(id_hashes, id_offsets):
+    for idx in range(len(id_hashes)):
+        yield id_hashes[idx], id_offsets[idx]
+
+
+class JsonsIndex():
+    """
+        @id entries are collected in parallel uint64 arrays, sorted in runs
+        of chunk_size and merged, the same way as IdHashSet, about 32 bytes
+        per id at peak; an @id that is not a string is skipped with a warning
+    """
+    def __init__(self, filename, index_filename=None, comment_prefix="#", chunk_size=1000000):
+        self.filename = filename
+        self.index_filename = index_filename or u"{}.idx".format(filename)
+        self.comment_prefix = comment_prefix
+        self.chunk_size = chunk_size
+
+        self.line_offsets = _array_uint64()
+        self.id_hashes = _array_uint64()
+        self.id_offsets = _array_uint64()
+
+        self._file = None
+        self._mmap = None
+
+    def _source_stat(self):
+        stat = os.stat(self.filename)
+        return {"source_size": stat.st_size, "source_mtime": stat.st_mtime}
+
+    def build(self):
+        """
+            scan the file once, write the sidecar index
+        """
+        if file2compression(self.filename):
+            raise Exception("cannot index compressed file {}".format(self.filename))
+
+        source_stat = self._source_stat()
+        comment_prefix = self.comment_prefix.encode("utf-8") if self.comment_prefix else None
+
+        line_offsets = _array_uint64()
+        runs = []
+        pending_hashes = _array_uint64()
+        pending_offsets = _array_uint64()
+        cnt_id_skipped = 0
+        with open(self.filename, "rb") as f:
+            offset = 0
+            for line in iter(f.readline, b""):
+                line_offset = offset
+                offset += len(line)
+
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                if comment_prefix and line.startswith(comment_prefix):
+                    continue
+
+                line_offsets.append(line_offset)
+
+                try:
+                    item = json_loads(line.decode("utf-8"))
+                except ValueError:
+                    continue
+                if not isinstance(item, dict) or not item.get("@id"):
+                    continue
+                xid = item["@id"]
+                if not isinstance(xid, (bytes, type(u""))):
+                    if cnt_id_skipped == 0:
+                        logging.warning(u"skip @id that is not a string, offset={} @id={}".format(line_offset, xid))
+                    cnt_id_skipped += 1
+                    continue
+
+                pending_hashes.append(id2hash64(xid))
+                pending_offsets.append(line_offset)
+                if len(pending_hashes) >= self.chunk_size:
+                    runs.append(_sort_id_entries(pending_hashes, pending_offsets))
+                    pending_hashes = _array_uint64()
+                    pending_offsets = _array_uint64()
+
+        if len(pending_hashes) > 0:
+            runs.append(_sort_id_entries(pending_hashes, pending_offsets))
+        if cnt_id_skipped:
+            logging.warning(u"skipped {} @id that are not a string".format(cnt_id_skipped))
+
+        if len(runs) == 1:
+            id_hashes, id_offsets = runs[0]
+        else:
+            id_hashes = _array_uint64()
+            id_offsets = _array_uint64()
+            for id_hash, line_offset in heapq.merge(*[_iter_id_entries(*run) for run in runs]):
+                id_hashes.append(id_hash)
+                id_offsets.append(line_offset)
+
+        header = {
+            "version": INDEX_FORMAT_VERSION,
+            "byteorder": sys.byteorder,
+            "cnt_line": len(line_offsets),
+            "cnt_id": len(id_hashes),
+        }
+        header.update(source_stat)
+
+        # write to a temp file first, never leave a broken index behind
+        filename_temp = u"{}.tmp{}".format(self.index_filename, os.getpid())
+        with open(filename_temp, "wb") as f:
+            f.write(json.dumps(header, sort_keys=True).encode("utf-8"))
+            f.write(b"\n")
+            line_offsets.tofile(f)
+            id_hashes.tofile(f)
+            id_offsets.tofile(f)
+        os.rename(filename_temp, self.index_filename)
+
+        self.line_offsets = line_offsets
+        self.id_hashes = id_hashes
+        self.id_offsets = id_offsets
+        logging.info(u"built index {} lines={} ids={}".format(
+            self.index_filename, header["cnt_line"], header["cnt_id"]))
+
+    def load(self):
+        """
+            load the sidecar index, return False if it is missing or stale
+        """
+        if not os.path.exists(self.index_filename):
+            return False
+
+        with open(self.index_filename, "rb") as f:
+            header = json.loads(f.readline().decode("utf-8"))
+            if header.get("version") != INDEX_FORMAT_VERSION:
+                return False
+
+            source_stat = self._source_stat()
+            for p, v in source_stat.items():
+                if header.get(p) != v:
+                    logging.info(u"stale index {} {}".format(self.index_filename, p))
+                    return False
+
+            line_offsets = _array_uint64()
+            id_hashes = _array_uint64()
+            id_offsets = _array_uint64()
+            line_offsets.fromfile(f, header["cnt_line"])
+            id_hashes.fromfile(f, header["cnt_id"])
+            id_offsets.fromfile(f, header["cnt_id"])
+
+        if header["byteorder"] != sys.byteorder:
+            for x in [line_offsets, id_hashes, id_offsets]:
+                x.byteswap()
+
+        self.line_offsets = line_offsets
+        self.id_hashes = id_hashes
+        self.id_offsets = id_offsets
+        return True
+
+    def open(self, rebuild=True):
+        """
+            load the index (rebuild if stale), then mmap the source file
+        """
+        if not self.load():
+            if not rebuild:
+                raise Exception("missing or stale index {}".format(self.index_filename))
+            self.build()
+
+        self.close()
+        self._file = open(self.filename, "rb")
+        if os.path.getsize(self.filename) > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.line_offsets)
+
+    def _read_line(self, offset):
+        if self._mmap is None:
+            self.open()
+        end = self._mmap.find(b"\n", offset)
+        if end < 0:
+            end = len(self._mmap)
+        return self._mmap[offset:end].decode("utf-8").strip()
+
+    def get_line(self, line_number):
+        """
+            line_number is the index of the line in file2iter(filename)
+        """
+        return self._read_line(self.line_offsets[line_number])
+
+    def get_item(self, line_number):
+        return json_loads(self.get_line(line_number))
+
+    def get_items_by_id(self, xid):
+        """
+            all items having the @id, in file order
+        """
+        id_hash = id2hash64(xid)
+        idx = bisect.bisect_left(self.id_hashes, id_hash)
+        offsets = []
+        while idx < len(self.id_hashes) and self.id_hashes[idx] == id_hash:
+            offsets.append(self.id_offsets[idx])
+            idx += 1
+
+        ret = []
+        for offset in sorted(offsets):
+            item = json_loads(self._read_line(offset))
+            # skip hash collision
+            if item.get("@id") == xid:
+                ret.append(item)
+        return ret
+
+    def get_item_by_id(self, xid):
+        ret = self.get_items_by_id(xid)
+        if ret:
+            return ret[0]
+        return None
+
+
+def task_jsons_index(args):
+    """
+        build (or refresh) the sidecar index of a json lines file
+    """
+    index = JsonsIndex(args["input_file"])
+    if not index.load():
+        index.build()
+    logging.info(u"lines={} ids={}".format(len(index.line_offsets), len(index.id_hashes)))
+
+
+def task_jsons_lookup(args):
+    """
+        print items by @id (--id) or line number (--line), comma separated
+    """
+    with JsonsIndex(args["input_file"]) as index:
+        items = []
+        if args.get("id"):
+            for xid in args["id"].split(","):
+                items.extend(index.get_items_by_id(xid.strip()))
+        if args.get("line"):
+            for line_number in args["line"].split(","):
+                items.append(index.get_item(int(line_number)))
+
+    for item in items:
+        print(json4debug(item))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='[%(levelname)s][%(asctime)s][%(module)s][%(funcName)s][%(lineno)s] %(message)s', level=logging.INFO)
+    logging.getLogger("requests").setLevel(logging.WARNING)
+
+    optional_params = {
+        '--input_file': 'input json lines file',
+        '--id': 'comma separated @id list',
+        '--line': 'comma separated line numbers',
+    }
+    main_subtask(__name__, optional_params=optional_params)
+
+"""
+    python kgtool/jsons_index.py task_jsons_index --input_file=local/jsons/kg.jsons
+    python kgtool/jsons_index.py task_jsons_lookup --input_file=local/jsons/kg.jsons --id=022858de-f892-373a-bb0f-668c8e50d16f
+    python kgtool/jsons_index.py task_jsons_lookup --input_file=local/jsons/kg.jsons --line=0,100
+"""
@@ -55,6 +55,7 @@ def stat_table(items, unique_fields, value_fields=[], printCounter=True, MAX_UNI
     if printCounter:
         logging.info(json.dumps(counter, ensure_ascii=False,
                                 indent=4, sort_keys=True))
+        logging.info(json4debug(VALUE_NORMALIZER.stats()))
 
     return counter
 
@@ -89,7 +90,7 @@ def stat_json_path(json_data, key, wm):
                 wm["unique"][key] += 1
 
 
-def stat_sample(items):
+def stat_sample(items, option="list2sample"):
     ret = {"stat": collections.Counter() }
     if not type(items) == list:
         raise Exception("expect list of items")
@@ -221,33 +222,41 @@ def stat_kg_pattern_entity(entity, counter, level):
             key = u"range_{}_{}".format(p, entity_range)
             counter[key] += 1
 
+def _stat_kg_pattern_shard(filename, shard):
+    counter = collections.Counter()
+    for line in file2iter4shard(filename, shard):
+        if not line:
+            continue
+        key = "_meta_lines"
+        counter[key]+=1
+        if counter[key] % 10000 == 0:
+            logging.info(json4debug(counter))
+
+        #logging.info(line)
+        try:
+            item = json_loads(line)
+        except:
+            counter[u"warn_skip_lines"] += 1
+            counter[u"warn_skip_lines_{}".format(os.path.basename(filename))] +=1
+            continue
+        else:
+            counter = stat_kg_pattern(item, counter)
+    return counter
+
 def task_stat_kg_pattern(args):
     print("called task_stat_kg_pattern")
     logging.info(args)
     filenames = glob.glob(args["filepath"])
     logging.info(filenames)
+    workers = int(args.get("workers") or 1)
     counter = collections.Counter()
     counter["_meta_timestamp"] = datetime.datetime.now().isoformat()[0:19]
     for filename in filenames:
         key = "_meta_files"
         counter[key]+=1
-        for line in file2iter(filename):
-            if not line:
-                continue
-            key = "_meta_lines"
-            counter[key]+=1
-            if counter[key] % 10000 == 0:
-                logging.info(json4debug(counter))
-
-            #logging.info(line)
-            try:
-                item = json.loads(line)
-            except:
-                counter[u"warn_skip_lines"] += 1
-                counter[u"warn_skip_lines_{}".format(os.path.basename(filename))] +=1
-                continue
-            else:
-                counter = stat_kg_pattern(item, counter)
+        with profile_stage("stat"):
+            for counter_shard in file2iter4parallel(filename, _stat_kg_pattern_shard, workers=workers, ordered=False):
+                counter.update(counter_shard)
 
     # print result
     logging.info(json4debug(counter))
@@ -364,49 +373,91 @@ def stat_kg_summary(list_entity, list_relation, dirname, max_sample = 5, flag_ma
     return report
 
 
-def task_stat_json_path(args):
-    logging.info(args)
-    filenames = glob.glob(args["filepath"])
-
-    wm = {
+def _stat_json_path_init():
+    return {
         "count":collections.Counter(),
         "unique":collections.Counter(),
         "sample": collections.defaultdict(list),
         "distribution": collections.defaultdict(dict),
     }
 
+def _stat_json_path_shard(filename, shard):
+    wm = _stat_json_path_init()
+    for line in file2iter4shard(filename, shard):
+        if not line:
+            continue
+
+        key = "_items"
+        wm["count"][key]+=1
+        if wm["count"][key] % 10000 == 0:
+            logging.info(json4debug(wm["count"]))
+
+        try:
+            item = json_loads(line)
+            stat_json_path(item, "", wm)
+        except:
+            wm["count"][u"warn_skip_lines"] += 1
+            wm["count"][u"warn_skip_lines_{}".format(os.path.basename(filename))] +=1
+    return wm
+
+def stat_json_path_merge(wm, wm_shard):
+    """
+        merge the stat_json_path result of a later shard into wm,
+        samples and distribution keep the same caps as stat_json_path.
+        count and sample are the same as a serial run; unique is the size
+        of the merged value set, a value seen by several shards counts
+        once. a distribution stops counting once full, so its counts are
+        only approximate when the shard also filled its own distribution.
+    """
+    wm["count"].update(wm_shard["count"])
+
+    if "sample" in wm:
+        for key, values in wm_shard["sample"].items():
+            sample = wm["sample"][key]
+            sample.extend(values[:max(0, wm.get("MAX_SAMPLE", 3) - len(sample))])
+
+    if "distribution" in wm:
+        for key, values in wm_shard["distribution"].items():
+            distribution = wm["distribution"][key]
+            if len(distribution) >= wm.get("MAX_UNIQUE", 10):
+                continue
+            for v, cnt in values.items():
+                if v in distribution:
+                    distribution[v] += cnt
+                elif len(distribution) < wm.get("MAX_UNIQUE", 10):
+                    distribution[v] = cnt
+            wm["unique"][key] = len(distribution)
+
+    return wm
+
+def task_stat_json_path(args):
+    logging.info(args)
+    filenames = glob.glob(args["filepath"])
+    workers = int(args.get("workers") or 1)
+
+    wm = _stat_json_path_init()
+
     if args.get("option") == "jsons":
         for filename in filenames:
             key = "_meta_files"
             wm["count"][key]+=1
-            for line in file2iter(filename):
-                if not line:
-                    continue
-
-                key = "_items"
-                wm["count"][key]+=1
-                if wm["count"][key] % 10000 == 0:
-                    logging.info(json4debug(wm["count"]))
-
-                try:
-                    item = json.loads(line)
-                    stat_json_path(item, "", wm)
-                except:
-                    wm["count"][u"warn_skip_lines"] += 1
-                    wm["count"][u"warn_skip_lines_{}".format(os.path.basename(filename))] +=1
+            with profile_stage("stat"):
+                for wm_shard in file2iter4parallel(filename, _stat_json_path_shard, workers=workers, ordered=True):
+                    stat_json_path_merge(wm, wm_shard)
     else:
         for filename in filenames:
             key = "_meta_files"
             wm["count"][key]+=1
 
-            item = file2json(filename)
+            with profile_stage("stat"):
+                item = file2json(filename)
 
-            key = "_items"
-            wm["count"][key]+=1
-            if wm["count"][key] % 10000 == 0:
-                logging.info(json4debug(wm["count"]))
+                key = "_items"
+                wm["count"][key]+=1
+                if wm["count"][key] % 10000 == 0:
+                    logging.info(json4debug(wm["count"]))
 
-            stat_json_path(item, "", wm)
+                stat_json_path(item, "", wm)
 
     if "distribution" in wm:
         del wm["sample"]
@@ -439,6 +490,7 @@ if __name__ == "__main__":
         '--output': 'output filename',
         '--option': 'json jsons',
         '--cprofile': 'cprofile',
+        '--workers': 'number of worker processes for jsons input',
     }
     main_subtask(__name__, optional_params=optional_params)
 
@@ -452,5 +504,7 @@ if __name__ == "__main__":
     python kgtool/stats.py task_stat_json_path --filepath=schema/*.jsonld --option=json --output=local/output/test_stat_json_path.json
 
     python kgtool/stats.py task_stat_json_path --filepath=local/jsons/*.jsons --option=jsons --output=local/output/test_stat_json_path.json --cprofile=yes
+    python kgtool/stats.py task_stat_json_path --filepath=local/jsons/*.jsons --option=jsons --output=local/output/test_stat_json_path.json --profile=cprofile,timer --profile_output=local/output/test_stat_json_path.profile.json
+    python kgtool/stats.py task_stat_json_path --filepath=local/jsons/*.jsons --option=jsons --output=local/output/test_stat_json_path.json --workers=8
 
 """
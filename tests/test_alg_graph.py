@@ -35,6 +35,43 @@ class CoreTestCase(unittest.TestCase):
         logging.info(json.dumps(subtree, indent=4))
         assert subtree=={0: [0, 1, 4], 1: [1, 4], 2: [2, 1, 4, 3], 3: [3], 4: [4]}
 
+        # multi-inheritance, shared ancestors listed once in preorder
+        dg = DirectedGraph([["a", "b"], ["a", "c"], ["b", "d"], ["c", "d"], ["d", "e"], ["c", "f"]])
+        subtree = dg.compute_subtree()
+        assert subtree["a"] == ["a", "b", "d", "e", "c", "f"]
+        assert subtree["c"] == ["c", "d", "e", "f"]
+        subtree = dg.compute_subtree(include_self=False)
+        assert dict(subtree) == {"a": ["b", "d", "e", "c", "f"], "b": ["d", "e"], "c": ["d", "e", "f"], "d": ["e"]}
+
+    def test_compute_subtree_random(self):
+        def _preorder(dg, node):
+            ret = []
+            visited = set([node])
+            stack = [iter(dg.nodes[node])]
+            while stack:
+                child = next(stack[-1], None)
+                if child is None:
+                    stack.pop()
+                elif child not in visited:
+                    visited.add(child)
+                    ret.append(child)
+                    stack.append(iter(dg.nodes[child]))
+            return ret
+
+        for seed in range(20):
+            dg = DirectedGraph(gen_random_dag(200, max_parent=4, seed=seed))
+            subtree = dg.compute_subtree()
+            for node in dg.nodes:
+                assert subtree[node] == [node] + _preorder(dg, node)
+
+    def test_compute_subtree_cycle(self):
+        dg = DirectedGraph([[0, 1], [1, 2], [2, 1], [2, 3], [4, 4]])
+        assert dg.find_cycles() == [[1, 2], [4]]
+        subtree = dg.compute_subtree()
+        assert dict(subtree) == {0: [0, 1, 2, 3], 1: [1, 2, 3], 2: [2, 1, 3], 3: [3], 4: [4]}
+        self.assertRaises(ValueError, dg.compute_subtree, allow_cycle=False)
+        assert DirectedGraph([[0, 1]]).find_cycles() == []
+
 
 
 if __name__ == '__main__':
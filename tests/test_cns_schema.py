@@ -3,6 +3,8 @@
 # Path hack
 import os
 import sys
+import shutil
+import tempfile
 sys.path.insert(0, os.path.abspath('.'))
 sys.path.insert(0, os.path.abspath('..'))
 
@@ -36,6 +38,177 @@ class CoreTestCase(unittest.TestCase):
         logging.info(ret)
         assert ret != None
 
+    def test_resolve_alias(self):
+        the_schema = self.loaded_schema_org
+        definition, stated_in = the_schema.resolve_alias("Company")
+        assert definition["name"] == "Company"
+        assert stated_in == "cns_organization"
+        assert the_schema.resolve_alias("Thing")[1] == "cns_top"
+        assert the_schema.resolve_alias("rdfs:domain")[0]["name"] == "domain"
+        assert the_schema.resolve_alias("NotDefinedClass") is None
+
+        # same first hit as looking up every imported schema in order
+        for schema in the_schema.imported_schema:
+            for alias in schema.index_definition_alias:
+                expected = None
+                for schema_imported in the_schema.imported_schema:
+                    expected = schema_imported.get_definition_by_alias(alias)
+                    if expected:
+                        break
+                assert the_schema.resolve_alias(alias)[0] is expected, alias
+
+    def test_schema_snapshot(self):
+        dirname = tempfile.mkdtemp()
+        schema_dir = os.path.join(dirname, "schema")
+        cache_dir = os.path.join(dirname, "cache")
+        os.makedirs(schema_dir)
+        for name in ["cns_top_v2.0", "cns_place_v2.0", "cns_organization_v2.0"]:
+            shutil.copy(file2abspath("../schema/{}.jsonld".format(name)), schema_dir)
+        filename = os.path.join(schema_dir, "cns_organization_v2.0.jsonld")
+        expected = self.loaded_schema_org
+
+        cnt_build = collections.Counter()
+        build = CnsSchema.build
+        def _build(schema):
+            cnt_build["build"] += 1
+            build(schema)
+        CnsSchema.build = _build
+        try:
+            # cold run writes the snapshot, warm run does not build
+            for cnt in [True, False]:
+                cnt_build.clear()
+                actual = load_schema(filename, schema_dir, cache_dir)
+                assert bool(cnt_build["build"]) == cnt
+                assert json.dumps(actual.export_debug(), sort_keys=True, default=repr) == json.dumps(expected.export_debug(), sort_keys=True, default=repr)
+                assert actual.resolve_alias("Company")[1] == "cns_organization"
+                assert actual.imported_schema[-1] is actual
+
+                item = {"@id": "1", "name": "a", "@type": ["Company", "Organization", "Thing"], "foo": "x"}
+                reports = []
+                for loaded_schema in [actual, expected]:
+                    report = CnsBugReport()
+                    run_validate(loaded_schema, dict(item), report)
+                    reports.append(json_dumps(report.export()))
+                assert reports[0] == reports[1]
+            assert len(os.listdir(cache_dir)) == 1
+
+            # changed content or a new schema file builds again
+            with open(filename, "ab") as f:
+                f.write(b"\n")
+            cnt_build.clear()
+            load_schema(filename, schema_dir, cache_dir)
+            assert cnt_build["build"] > 0
+            shutil.copy(file2abspath("../schema/cns_person_v2.0.jsonld"), schema_dir)
+            cnt_build.clear()
+            load_schema(filename, schema_dir, cache_dir)
+            assert cnt_build["build"] > 0
+            cnt_build.clear()
+            load_schema(filename, schema_dir, cache_dir)
+            assert cnt_build["build"] == 0
+        finally:
+            CnsSchema.build = build
+            shutil.rmtree(dirname)
+
+    def test_schema_registry(self):
+        dirname = tempfile.mkdtemp()
+        for name in ["cns_top_v2.0", "cns_place_v2.0", "cns_organization_v2.0", "cns_person_v2.0", "cns_top_v2.3", "cns_meta_v2.1"]:
+            shutil.copy(file2abspath("../schema/{}.jsonld".format(name)), dirname)
+        filename = os.path.join(dirname, "cns_organization_v2.0.jsonld")
+        try:
+            registry = get_schema_registry(dirname)
+            assert registry.headers["cns_place_v2.0"]["import"] == ["cns_top_v2.0"]
+            assert registry.get_import_closure("cns_organization_v2.0") == ["cns_top_v2.0", "cns_place_v2.0", "cns_organization_v2.0"]
+
+            # only the imports are built, once per process
+            actual = load_schema(filename, dirname)
+            assert sorted(registry.preloaded_schema_list) == ["cns_organization_v2.0", "cns_place_v2.0", "cns_top_v2.0"]
+            assert load_schema(filename, dirname) is actual
+            assert [x.metadata["identifier"] for x in actual.imported_schema][-1] == "cns_organization_v2.0"
+            assert json.dumps(actual.export_debug(), sort_keys=True, default=repr) == json.dumps(self.loaded_schema_org.export_debug(), sort_keys=True, default=repr)
+
+            # a changed file drops the built schemas
+            mtime = os.path.getmtime(filename) + 10
+            os.utime(filename, (mtime, mtime))
+            assert load_schema(filename, dirname) is not actual
+
+            registry.headers["cns_top_v2.0"]["import"] = ["cns_organization_v2.0"]
+            self.assertRaises(Exception, registry.get_import_closure, "cns_organization_v2.0")
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_class_reachability(self):
+        the_schema = self.loaded_schema_org
+        inheritance = the_schema.index_inheritance["rdfs:subClassOf"]
+        assert the_schema.is_subclass("Company", "Organization")
+        assert the_schema.is_subclass("Company", "Company")
+        assert not the_schema.is_subclass("Organization", "Company")
+        assert not the_schema.is_subclass("NotDefinedClass", "Thing")
+        assert the_schema.ancestors("Company")[0] == "Company"
+        assert the_schema.ancestors("NotDefinedClass") is None
+
+        # same answers as the inheritance lists
+        for xtype, ancestors in inheritance.items():
+            for super_type in inheritance:
+                assert the_schema.is_subclass(xtype, super_type) == (super_type in ancestors)
+
+        types = ["Company", "Organization", "Thing", "Person", "NotDefinedClass"]
+        assert the_schema.most_specific(types) == set(["Company", "Person", "NotDefinedClass"])
+        assert the_schema.most_specific(["Thing"]) == set(["Thing"])
+
+    def test_incremental_update(self):
+        the_schema = self.loaded_schema_org
+        assert the_schema.check_consistency() == []
+
+        # template edit and a new template on a new property
+        template = dict(the_schema.metadata["template"][0])
+        template["propertyRange"] = "Text"
+        template["propertyAlternateName"] = [u"测试别名"]
+        the_schema.upsert_template(template)
+        assert the_schema.index_property_alias[u"测试别名"][template["name"]] is template
+        d, rp = template["refClass"], template["refProperty"]
+        assert the_schema.index_validate_template[d][rp]["propertyRange"]["text"] == "Text"
+        the_schema.upsert_template({"name": "Club_clubMember", "refClass": "Club", "refProperty": "clubMember",
+                                    "propertySchema": "cns_organization", "minCardinality": "1"})
+        assert the_schema.check_consistency() == []
+
+        # new property and classes complete the template
+        the_schema.upsert_definition({"@id": "http://cnschema.org/clubMember", "@type": ["rdf:Property", "CnsProperty"],
+                                      "name": "clubMember", "nameZh": u"会员", "range": "Person"})
+        the_schema.upsert_definition({"@id": "http://cnschema.org/Club", "@type": ["rdfs:Class", "CnsClass"],
+                                      "name": "Club", "alternateName": [u"俱乐部"], "rdfs:subClassOf": ["Organization"]})
+        the_schema.upsert_definition({"@id": "http://cnschema.org/ChessClub", "@type": ["rdfs:Class", "CnsClass"],
+                                      "name": "ChessClub", "rdfs:subClassOf": ["Club"]})
+        assert the_schema.check_consistency() == []
+        assert the_schema.get_definition_by_alias(u"俱乐部")["name"] == "Club"
+        assert the_schema.resolve_alias(u"俱乐部")[1] == "cns_organization"
+        assert the_schema.ancestors("ChessClub")[:3] == ["ChessClub", "Club", "Organization"]
+        assert the_schema.is_subclass("ChessClub", "Thing")
+        assert the_schema.get_best_template(["Club"], "clubMember")["propertyRange"]["text"] == "Person"
+
+        # move a class, the sub classes follow
+        the_schema.upsert_definition({"@id": "http://cnschema.org/Club", "@type": ["rdfs:Class", "CnsClass"],
+                                      "name": "Club", "rdfs:subClassOf": ["CnsDataStructure"]})
+        assert the_schema.check_consistency() == []
+        assert not the_schema.is_subclass("ChessClub", "Organization")
+        assert the_schema.get_definition_by_alias(u"俱乐部") is None
+
+        # remove
+        assert the_schema.remove_template("Club_clubMember")["refClass"] == "Club"
+        assert the_schema.remove_definition("http://cnschema.org/Club")["name"] == "Club"
+        assert the_schema.remove_definition("http://cnschema.org/clubMember")
+        assert the_schema.remove_definition("not-defined") is None
+        assert the_schema.ancestors("ChessClub") == ["ChessClub", "Club"]
+        assert the_schema.check_consistency() == []
+
+        # a cycle falls back to a full inheritance build
+        the_schema.upsert_definition({"@id": "http://cnschema.org/Club", "@type": ["rdfs:Class", "CnsClass"],
+                                      "name": "Club", "rdfs:subClassOf": ["ChessClub"]})
+        assert the_schema.check_consistency() == []
+
+        # the checker finds a stale index
+        the_schema.index_inheritance["rdfs:subClassOf"]["ChessClub"] = ["ChessClub"]
+        assert the_schema.check_consistency()[0][:2] == ["rdfs:subClassOf", "ChessClub"]
+
     def test_get_all_property(self):
         ret = self.loaded_schema.get_all_property()
         logging.info(ret)
@@ -94,7 +267,7 @@ class CoreTestCase(unittest.TestCase):
 
         #assert False
         if len(report.data["bugs_sample"]) != 3:
-            logging.info(json4debug(report.data))
+            logging.info(json4debug(report.export()))
             assert False, len(report.data["bugs_sample"])
 
     def test_run_convert2(self):
@@ -115,7 +288,7 @@ class CoreTestCase(unittest.TestCase):
         report = CnsBugReport()
         cns_item = run_convert(loaded_schema, item, types, primary_keys, report)
         #logging.info(json4debug(cns_item))
-        logging.info(json4debug(report.data))
+        logging.info(json4debug(report.export()))
 
         assert "changeCategory" in cns_item
 
@@ -199,7 +372,7 @@ class CoreTestCase(unittest.TestCase):
         entities.append( cns_item_link )
 
         logging.info(json4debug(entities))
-        logging.info(json4debug(report.data))
+        logging.info(json4debug(report.export()))
         assert cns_item_link["@id"] == "b11ab8dbd506a271791a4a5813e2684fa592377399fe239a1b21edf304b9f312"
         assert cns_item_in["@id"] == "b6a7801587af217eba42da036c2659696f6153aff2d7df14e39f74e6f2672fef"
         assert cns_item_out["@id"] == "09cd7eb1132c9de9cef0bd0c3b534586220f8c7f72186f1db0404da1a725301a"
@@ -268,7 +441,7 @@ class CoreTestCase(unittest.TestCase):
             run_validate(self.loaded_schema, cns_item, report)
 
         if len(report.data["bugs_sample"]) != 3:  #类未定义1,  属性值域错误2
-            logging.info(json4debug(report.data))
+            logging.info(json4debug(report.export()))
             assert False, len(report.data["bugs_sample"])
 
     def test_normalize_value(self):
@@ -401,7 +574,7 @@ class CoreTestCase(unittest.TestCase):
                     "saicRegistrationCapital": {"text":u"1000万", "value":"10000"}}
         report = CnsBugReport()
         run_validate(self.loaded_schema_org, input, report)
-        logging.info(json4debug(report.data))
+        logging.info(json4debug(report.export()))
         assert len(report.data["bugs_sample"])== 2
         #assert False
         input = {   "@id":"111",
@@ -409,7 +582,7 @@ class CoreTestCase(unittest.TestCase):
                     "saicRegistrationCapital": {"text":u"1000万", "value":10000.0}}
         report = CnsBugReport()
         run_validate(self.loaded_schema_org, input, report)
-        logging.info(json4debug(report.data))
+        logging.info(json4debug(report.export()))
         assert len(report.data["bugs_sample"])== 1
 
     def test_run_validate_3(self):
@@ -419,7 +592,7 @@ class CoreTestCase(unittest.TestCase):
                     "out": "334"}
         report = CnsBugReport()
         run_validate(self.loaded_schema_org, input, report)
-        logging.info(json4debug(report.data))
+        logging.info(json4debug(report.export()))
         assert len(report.data["bugs_sample"])== 1
 
         input = {   "@id":"123",
@@ -429,7 +602,7 @@ class CoreTestCase(unittest.TestCase):
                     "out": "334"}
         report = CnsBugReport()
         run_validate(self.loaded_schema_org, input, report)
-        logging.info(json4debug(report.data))
+        logging.info(json4debug(report.export()))
         assert len(report.data["bugs_sample"])== 0
 
     def test_run_validate_2(self):
@@ -447,7 +620,7 @@ class CoreTestCase(unittest.TestCase):
 
         #assert False
         if len(report.data["bugs_sample"]) > 0:
-            logging.info(json4debug(report.data))
+            logging.info(json4debug(report.export()))
             assert False, len(report.data["bugs_sample"])
 
 
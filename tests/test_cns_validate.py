@@ -15,6 +15,7 @@ from kgtool.core import *  # noqa
 from kgtool.cns_convert import *  # noqa
 from kgtool.cns_model import *  # noqa
 from kgtool.cns_validate import *  # noqa
+from kgtool.cns_common import *  # noqa
 
 
 class CoreTestCase(unittest.TestCase):
@@ -51,14 +52,15 @@ class CoreTestCase(unittest.TestCase):
 
         report = self.loaded_schema_org.report
         run_validate_recursive(self.loaded_schema_org, input, report)
-        logging.info(json4debug(report.data))
-        assert report.data["xtemplate"]["cp_Person_Thing_name"] == 2
-        assert report.data["xtemplate"]["type_all_Person"] == 2
-        assert report.data["xtemplate"]["cp_Thing_Thing_name"] == 1
+        logging.info(json4debug(report.export()))
+        xtemplate = report.export()["xtemplate"]
+        assert xtemplate["cp_Person_Thing_name"] == 2
+        assert xtemplate["type_all_Person"] == 2
+        assert xtemplate["cp_Thing_Thing_name"] == 1
 
         # two different main type should not co-exist
-        assert not "cp_Person_Organization_city" in report.data["xtemplate"]
-        assert "cp_Organization_Organization_city" in report.data["xtemplate"]
+        assert not "cp_Person_Organization_city" in xtemplate
+        assert "cp_Organization_Organization_city" in xtemplate
 
 
     def test_validate_null(self):
@@ -71,7 +73,312 @@ class CoreTestCase(unittest.TestCase):
 
         report = self.loaded_schema_org.report
         run_validate_recursive(self.loaded_schema_org, input, report)
-        logging.info(json4debug(report.data))
+        logging.info(json4debug(report.export()))
         assert len(report.data["bugs_sample"])==1
         assert report.data["stats"]["warn_validate_datatype | range value datatype mismatch | CnsTag | name"]==0
         assert report.data["stats"]["warn_validate_template_regular | minCardinality | CnsTag | name"] == 1
+
+    def test_validation_plan(self):
+        types = ["Organization", "Thing", "Person"]
+        plan = get_validation_plan(self.loaded_schema_org, types)
+        assert plan is get_validation_plan(self.loaded_schema_org, tuple(types))
+        assert plan.main_type == "Organization"
+        assert plan.type_key_ids == tuple([xtemplate_key_id(("type_all", x)) for x in types])
+        assert "name" in plan.allowed_property
+        assert "@id" in plan.allowed_property
+
+        # each property is validated by the first template only
+        validated = [step.property for step in plan.steps if step.validate]
+        assert len(validated) == len(set(validated))
+        assert xtemplate_key_id(("cp", "Organization", "Organization", "city")) in plan.key_ids
+
+        # same counts from a cached plan
+        item = {"@id": "123", "name": "a", "@type": types, "foo": "x"}
+        report1 = CnsBugReport()
+        run_validate(self.loaded_schema_org, copy.deepcopy(item), report1)
+        report2 = CnsBugReport()
+        run_validate(self.loaded_schema_org, copy.deepcopy(item), report2)
+        assert report1.export()["xtemplate"] == report2.export()["xtemplate"]
+        assert report1.data["xtemplate"].get_key(("ucp", "Organization", "foo")) == 1
+
+        # rebuild drops compiled plans
+        self.loaded_schema_org.build()
+        assert plan is not get_validation_plan(self.loaded_schema_org, types)
+
+    def test_xtemplate_counter(self):
+        counter = XTemplateCounter()
+        key_id = xtemplate_key_id(("cp", "A_B", "Thing", "p_q"))
+        counts = counter.touch([key_id], "plan")
+        counts[key_id] += 2
+        counter.touch([key_id], "plan")[key_id] += 1
+        counter.add_key(("type_all", "A_B"), 3)
+        counter.add_key(("ucp", "A_B", "x"), 0)
+        counter.extra["parent_A_B"] = ["Thing"]
+        assert counter.get_key(("cp", "A_B", "Thing", "p_q")) == 3
+        assert counter.get_key(("ucp", "A_B", "x")) == 0
+        assert counter.get_key(("ucp", "A_B", "y"), None) is None
+        assert sorted(counter.key_items()) == [[("cp", "A_B", "Thing", "p_q"), 3], [("type_all", "A_B"), 3], [("ucp", "A_B", "x"), 0]]
+        assert counter.to_counter() == {"cp_A_B_Thing_p_q": 3, "type_all_A_B": 3, "ucp_A_B_x": 0, "parent_A_B": ["Thing"]}
+
+        # the array grows to the largest key id touched, not all keys
+        assert len(counter.counts) == max([xtemplate_key_id(key) for key, cnt in counter.key_items()]) + 1
+
+        # key tuples survive pickle, key ids are interned again
+        import pickle
+        counter.add_key(("type_all", "A_B"))
+        counter = pickle.loads(pickle.dumps(counter))
+        assert counter.get_key(("type_all", "A_B")) == 4
+        assert counter.extra == {"parent_A_B": ["Thing"]}
+
+        # string keys of a loaded report are merged into extra
+        counter.merge({"type_all_A_B": 1, "parent_A_B": ["x"]})
+        assert counter.to_counter()["type_all_A_B"] == 5
+        assert counter.extra["parent_A_B"] == ["Thing"]
+
+        # csv columns come from the key tuple, not split("_")
+        filename = file2abspath("test_xtemplate_counter.csv")
+        report = CnsBugReport()
+        report.data["xtemplate"] = counter
+        write_csv_report({"output_validate_report": filename}, report, self.loaded_schema_org)
+        lines = list(file2iter(filename))
+        os.remove(filename)
+        assert u"A_B,Thing,p_q,,事物,,3,0.75" in lines, lines
+
+    def test_report_merge(self):
+        items = [
+            {"@id": "1", "name": "a", "@type": ["Organization", "Thing"], "foo": "x"},
+            {"@id": "2", "name": "b", "@type": ["Person", "Thing"], "foo": "y"},
+            {"@id": "3", "name": None, "@type": ["CnsTag", "Thing"]},
+            {"@id": "4", "name": "c", "@type": ["Organization", "Thing"], "foo": "z"},
+        ]
+
+        report = CnsBugReport()
+        for item in copy.deepcopy(items):
+            run_validate(self.loaded_schema_org, item, report)
+
+        # partial reports merged in input order
+        report_merged = CnsBugReport()
+        report_merged.data["xtemplate"].extra["parent_Thing"] = ["Thing"]
+        for shard in [items[:1], items[1:3], items[3:]]:
+            report_shard = CnsBugReport()
+            for item in copy.deepcopy(shard):
+                run_validate(self.loaded_schema_org, item, report_shard)
+            report_merged.merge(report_shard)
+
+        assert report_merged.data["xtemplate"].extra.pop("parent_Thing") == ["Thing"]
+        assert json_dumps(report.export()) == json_dumps(report_merged.export())
+        assert report_merged.data["bugs_sample"]["warn_validate_template_regular | unable to find a template for property=[foo] based on classes defined in @type=[Organization, Thing] | Organization | foo"]["value"]["@id"] == "1"
+
+    def test_report_sample(self):
+        def _bug(idx):
+            return {"category": "c", "description": "d", "property": "p", "value": {"idx": idx, "text": "x" * 100}}
+
+        report = CnsBugReport(sample_size=3)
+        for idx in range(10):
+            report.report_bug(_bug(idx))
+        assert [x["value"]["idx"] for x in report.data["bugs_sample"]["c | d |  | p"]] == [0, 1, 2]
+
+        # reservoir: uniform sample, same seed same sample
+        samples = []
+        for seed in [1, 1, 2]:
+            report = CnsBugReport(sample_size=3, sample_mode="reservoir", seed=seed)
+            for idx in range(100):
+                report.report_bug(_bug(idx))
+            samples.append([x["value"]["idx"] for x in report.data["bugs_sample"]["c | d |  | p"]])
+            assert report.data["stats"]["c | d |  | p"] == 100
+            assert len(samples[-1]) == 3
+        assert samples[0] == samples[1]
+        assert samples[0] != samples[2]
+
+        # snapshot is not affected by later changes of the bug
+        report = CnsBugReport()
+        bug = _bug(0)
+        report.report_bug(bug)
+        bug["value"]["idx"] = 1
+        assert report.data["bugs_sample"]["c | d |  | p"]["value"]["idx"] == 0
+
+        # byte budget
+        report = CnsBugReport(sample_bytes=500)
+        for idx in range(5):
+            bug = _bug(idx)
+            bug["class"] = "c{}".format(idx)
+            report.report_bug(bug)
+        assert report.cnt_sample_truncated == 3
+        assert "value" in report.data["bugs_sample"]["c | d | c0 | p"]
+        assert report.data["bugs_sample"]["c | d | c4 | p"] == {"category": "c", "description": "d", "class": "c4", "property": "p"}
+
+        # merged samples equal to ours by value are charged once
+        for sample_mode in ["first", "reservoir"]:
+            report = CnsBugReport(sample_size=3, sample_mode=sample_mode, sample_bytes=10000)
+            report_shard = CnsBugReport(sample_size=3)
+            report.report_bug(_bug(0))
+            report_shard.report_bug(_bug(0))
+            cnt_sample_bytes = report.cnt_sample_bytes
+            report.merge(report_shard)
+            assert len(report.data["bugs_sample"]["c | d |  | p"]) == 2
+            assert report.cnt_sample_bytes == 2 * cnt_sample_bytes
+
+    def test_report_budget(self):
+        def _bug(category):
+            return {"category": category, "description": "d", "class": "c", "property": "p"}
+
+        report = CnsBugReport(max_bugs_per_category=2)
+        for idx in range(3):
+            report.report_bug(_bug("a"))
+        report.report_bug(_bug("b"))
+        assert report.data["stats"]["a | d | c | p"] == 2
+        assert report.data["budget"] == {"stop_reason": None, "skip_category": ["a"]}
+        assert not report.end_item()
+
+        # checks of an exhausted category are skipped
+        item = {"@id": "1", "name": "a", "@type": ["Organization", "Thing"], "foo": "x"}
+        report = CnsBugReport(max_bugs_per_category=1)
+        report.skip_category.add("warn_validate_template_regular")
+        run_validate(self.loaded_schema_org, item, report)
+        assert report.cnt_bug == 0
+        assert report.data["xtemplate"].get_key(("ucp", "Organization", "foo")) == 1
+
+        item = {"name": "a", "@type": ["Foo", "Organization", "Thing"]}
+        report = CnsBugReport()
+        report.skip_category.update(["warn_rewrite_item", "warn_validate_system_property"])
+        assert not report.should_check("warn_rewrite_item")
+        run_validate(self.loaded_schema_org, item, report)
+        assert report.cnt_bug == 0
+        assert item["@type"] == ["Organization", "Thing"]
+
+        report = CnsBugReport(max_bugs=3)
+        for idx in range(3):
+            report.report_bug(_bug("a"))
+        assert report.end_item()
+        assert report.data["budget"]["stop_reason"] == "max_bugs"
+
+        report = CnsBugReport(max_error_rate=0.5, error_window=4)
+        for flag_bug in [1, 0, 1, 0, 1]:
+            if flag_bug:
+                report.report_bug(_bug("a"))
+            assert not report.end_item()
+        report.report_bug(_bug("a"))
+        assert report.end_item()
+        assert report.stop_reason == "max_error_rate"
+
+        # merged shards share the budget
+        report = CnsBugReport(max_bugs_per_category=3)
+        report_shard = CnsBugReport()
+        for idx in range(3):
+            report_shard.report_bug(_bug("a"))
+        report.merge(report_shard)
+        assert "a" in report.skip_category
+
+    def test_task_validate_budget(self):
+        import shutil
+        import tempfile
+        temp_dir = tempfile.mkdtemp()
+        filename = os.path.join(temp_dir, "items.jsons")
+        items = []
+        for idx in range(40):
+            item = {"@id": str(idx), "name": "n{}".format(idx), "@type": ["Organization", "Thing"]}
+            if idx % 3:
+                item["foo"] = "x"
+            items.append(json_dumps(item))
+        lines2file(items, filename)
+
+        # a budget runs serially, workers give the same report
+        reports = []
+        for workers in [1, 2]:
+            filename_report = os.path.join(temp_dir, "report{}.csv".format(workers))
+            args = {"input_file": filename, "input_schema": "schema/cns_organization_v2.0.jsonld", "schema_dir": "schema",
+                    "option": "jsons", "workers": workers, "max_bugs": 5,
+                    "output_validate_report": filename_report,
+                    "output_validate_entity": os.path.join(temp_dir, "entity{}.csv".format(workers))}
+            task_validate(args)
+            reports.append(file2json(filename_report.replace("csv", "json")))
+        assert reports[0]["budget"]["stop_reason"] == "max_bugs"
+        assert reports[0]["stats"]["_cnt_entity_template_Organization_name"] < 40
+        assert reports[0] == reports[1]
+        shutil.rmtree(temp_dir)
+
+    def test_report_detail_file(self):
+        filename = file2abspath("test_report_detail_file.jsons")
+        report = CnsBugReport(detail_filename=filename)
+        report_shard = CnsBugReport()
+        report_shard.data["flag_detail"] = True
+        for idx in range(3):
+            report.report_bug({"category": "c", "description": "d", "value": idx})
+            report_shard.report_bug({"category": "c", "description": "d", "value": idx + 3})
+        report.merge(report_shard)
+
+        # a worker report writes its own shard file, appended on merge
+        filename_shard = file2abspath("test_report_detail_file.shard.jsons")
+        report_shard = CnsBugReport(detail_filename=filename_shard)
+        for idx in range(3):
+            report_shard.report_bug({"category": "c", "description": "d", "value": idx + 6})
+        report_shard.close()
+        report.merge(report_shard)
+        report.close()
+
+        assert report.data["bugs"] == []
+        assert [json.loads(line)["value"] for line in file2iter(filename)] == list(range(9))
+
+        report = CnsBugReport()
+        report.data["flag_detail"] = True
+        report.merge(report_shard)
+        assert [bug["value"] for bug in report.data["bugs"]] == list(range(6, 9))
+        os.remove(filename)
+        os.remove(filename_shard)
+
+    def test_validation_cache(self):
+        filename = file2abspath("test_validation_cache.bin")
+        items = [
+            {"@id": "1", "name": "a", "@type": ["Company", "Organization", "Thing"]},
+            {"@id": "2", "name": "b", "@type": ["Organization", "Thing"], "foo": "x"},
+            {"@id": "3", "name": "c", "@type": ["CnsLink"], "in": {"@id": "1", "@type": ["Organization", "Thing"]}, "out": {"@id": "2", "@type": ["Person", "Thing"]}},
+            {"@id": "4", "name": "d"},
+        ]
+        lines = [json_dumps(item) for item in items]
+
+        if os.path.exists(filename):
+            os.remove(filename)
+        report = CnsBugReport()
+        cnt_clean = 0
+        for line in lines:
+            cnt_bug = report.cnt_bug
+            run_validate(self.loaded_schema_org, json_loads(line), report)
+            cnt_clean += report.cnt_bug == cnt_bug
+
+        # cold run keeps the lines without bug, warm run only counts them
+        for cnt_hit in [0, cnt_clean]:
+            cache = ValidationCache(filename, self.loaded_schema_org)
+            report_cached = CnsBugReport()
+            for line in lines:
+                cache.validate(self.loaded_schema_org, line, json_loads(line), report_cached)
+            cache.save()
+            assert cache.stats["hit"] == cnt_hit
+            assert len(cache.clean) == cnt_clean
+            assert json_dumps(report_cached.export()) == json_dumps(report.export())
+
+        # lines of another schema are not reused
+        cache = ValidationCache(filename, self.loaded_schema)
+        assert len(cache.clean) == 0
+        cache.validate(self.loaded_schema, lines[0], json_loads(lines[0]), CnsBugReport())
+        assert cache.stats["miss"] == 1
+        os.remove(filename)
+
+    def test_validate_ref(self):
+        items = [
+            {"@id": "1", "name": "a", "@type": ["Organization", "Thing"], "tag": [{"@id": "2"}, {"@id": "9"}]},
+            {"@id": "2", "name": "b", "@type": ["Organization", "Thing"]},
+            {"@id": "3", "@type": ["ShareholderRole", "CnsLink", "Thing"], "in": {"@id": "1"}, "out": "8"},
+        ]
+        filename = file2abspath("test_validate_ref.jsons")
+        items2file(items, filename)
+        id_set = collect_id([filename], "jsons")
+        os.remove(filename)
+        assert len(id_set) == 3
+
+        report = CnsBugReport()
+        for item in items:
+            validate_ref(item, id_set, report)
+        assert report.data["xtemplate"].get_key(("ref", "total")) == 4
+        assert report.data["stats"]["warn_validate_ref | referenced @id not found | Organization | tag"] == 1
+        assert report.data["stats"]["warn_validate_ref | referenced @id not found | ShareholderRole | out"] == 1
+        assert report.data["bugs_sample"]["warn_validate_ref | referenced @id not found | ShareholderRole | out"]["value"] == "8"
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Path hack
+import os
+import sys
+import shutil
+import tempfile
+import time
+sys.path.insert(0, os.path.abspath('..'))
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+try:
+    from urllib2 import urlopen, HTTPError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+
+from kgtool.core import *  # noqa
+from kgtool.cns_model import *  # noqa
+from kgtool.cns_validate import *  # noqa
+from kgtool.cns_validate_server import *  # noqa
+
+
+class ValidateServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename_schema = os.path.join(self.dirname, "cns_top_v2.0.jsonld")
+        shutil.copy(file2abspath("../schema/cns_top_v2.0.jsonld"), self.filename_schema)
+
+        self.service = ValidationService(self.filename_schema, self.dirname)
+        self.server = start_validation_server(self.service, port=0, reload_interval=0)
+        self.url = "http://{}:{}".format(*self.server.server_address[:2])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.close()
+        shutil.rmtree(self.dirname)
+
+    def _request(self, path, data=None):
+        if data is not None:
+            data = data.encode("utf-8")
+        return json.loads(urlopen(self.url + path, data).read().decode("utf-8"))
+
+    def test_validate(self):
+        items = [
+            {"@id": "1", "name": "a", "@type": ["Thing"], "foo": "x"},
+            {"@id": "2", "name": "b", "@type": ["Thing"]},
+        ]
+        body = u"\n".join([json_dumps(item) for item in items] + [u"", u"not json"])
+        ret = self._request("/validate", body)
+        assert len(ret["items"]) == 3
+        # line numbers of the body, the blank line counts
+        assert ret["items"][2] == {"line": 3, "error": "invalid json object"}
+
+        # same bugs as validating in process
+        report = CnsBugReport()
+        for idx, item in enumerate(items):
+            # items as parsed by the server, unicode text on python2
+            item = json_loads(json_dumps(item))
+            cnt_bug = report.cnt_bug
+            run_validate(self.service.loaded_schema, item, report)
+            assert ret["items"][idx]["@id"] == item["@id"]
+            assert len(ret["items"][idx]["bugs"]) == report.cnt_bug - cnt_bug
+        assert len(ret["items"][0]["bugs"]) >= 1
+        assert ret["report"]["stats"] == json_loads(json_dumps(report.data["stats"]))
+        assert ret["report"]["xtemplate"]["ucp_Thing_foo"] == 1
+
+        stats = self._request("/stats")
+        assert stats["requests"] == 1
+        assert stats["items"] == 3
+        assert stats["latency"]["count"] == 1
+
+        # body larger than max_body_bytes is not read
+        self.server.max_body_bytes = 10
+        try:
+            self._request("/validate", body)
+            assert False
+        except HTTPError as e:
+            assert e.code == 413
+        assert self._request("/stats")["errors"] == 1
+
+    def test_pool(self):
+        service = ValidationService(self.filename_schema, self.dirname, workers=2, chunk_size=1)
+        try:
+            lines = [json_dumps({"@id": str(idx), "name": "a", "@type": ["Thing"], "foo": "x"}) for idx in range(5)]
+            expected = self.service.validate_lines(lines)
+            pool_handle = service._pool_handle
+            pool_handle.users += 1
+            service.reload()
+            # a retired pool in use stays open until its last user is done
+            assert pool_handle.retired
+            assert pool_handle.pool.map(len, [[1]]) == [1]
+            service._release_pool(pool_handle)
+            ret = service.validate_lines(lines)
+            assert ret["items"] == expected["items"]
+            assert json_dumps(ret["report"]) == json_dumps(expected["report"])
+        finally:
+            service.close()
+
+    def test_reload(self):
+        assert not self.service.check_reload()
+        loaded_schema = self.service.loaded_schema
+        mtime = os.path.getmtime(self.filename_schema) + 10
+        os.utime(self.filename_schema, (mtime, mtime))
+        assert self.service.check_reload()
+        assert self.service.loaded_schema is not loaded_schema
+        assert self._request("/stats")["reloads"] == 1
+
+    def test_reload_import(self):
+        # no schema_dir, imports are found in ./schema
+        from kgtool.cns_validate import _LOADED_SCHEMA
+        cwd = os.getcwd()
+        os.chdir(self.dirname)
+        service = None
+        try:
+            os.mkdir("schema")
+            for name in ["cns_top_v2.0", "cns_place_v2.0"]:
+                shutil.copy(file2abspath("../schema/{}.jsonld".format(name)), os.path.join("schema", name + ".jsonld"))
+            filename_schema = os.path.join(self.dirname, "cns_organization_v2.0.jsonld")
+            shutil.copy(file2abspath("../schema/cns_organization_v2.0.jsonld"), filename_schema)
+            _LOADED_SCHEMA[(filename_schema, None)] = "task_validate"
+
+            service = ValidationService(filename_schema)
+            filename_import = os.path.abspath(os.path.join("schema", "cns_place_v2.0.jsonld"))
+            assert filename_import in service.schema_files()
+            assert not service.check_reload()
+            mtime = os.path.getmtime(filename_import) + 10
+            os.utime(filename_import, (mtime, mtime))
+            assert service.check_reload()
+            # the schema of task_validate in this process is left alone
+            assert _LOADED_SCHEMA.pop((filename_schema, None)) == "task_validate"
+        finally:
+            if service is not None:
+                service.close()
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,6 +13,10 @@ except ImportError:
 from kgtool.core import *  # noqa
 
 
+def _shard2list(filename, shard):
+    return list(file2iter4shard(filename, shard))
+
+
 class CoreTestCase(unittest.TestCase):
     def setUp(self):
         pass
@@ -41,6 +45,120 @@ class CoreTestCase(unittest.TestCase):
         str_iter = file2iter(filename)
         assert len(list(str_iter)) == 5
 
+    def test_file2shards(self):
+        filename = "test_stats_kg1.jsons"
+        filename = file2abspath(filename, __file__)
+        expected = list(file2iter(filename))
+        for shard_count in [1, 2, 3, 10, 100000]:
+            shards = file2shards(filename, shard_count)
+            assert shards[0][0] == 0
+            assert shards[-1][1] == os.path.getsize(filename)
+            actual = []
+            for shard in shards:
+                actual.extend(file2iter4shard(filename, shard))
+            assert actual == expected, shard_count
+
+    def test_file2iter4parallel(self):
+        filename = "test_core_file.json"
+        filename = file2abspath(filename, __file__)
+        expected = list(file2iter(filename))
+        for workers in [1, 2]:
+            actual = []
+            for lines in file2iter4parallel(filename, _shard2list, workers=workers, shard_count=3):
+                actual.extend(lines)
+            assert actual == expected, workers
+
+    def test_file2open_compressed(self):
+        import shutil
+        import tempfile
+        items = [{"name": u"张三", "idx": idx} for idx in range(100)]
+        dirname = tempfile.mkdtemp()
+        try:
+            for ext, compression in [[".gz", "gzip"], [".bz2", "bz2"]]:
+                filename = os.path.join(dirname, "items.jsons" + ext)
+                items2file(items, filename)
+                assert file2compression(filename) == compression
+                assert len(list(file2iter(filename))) == len(items)
+                assert file2shards(filename, 4) == [[0, os.path.getsize(filename)]]
+
+                # detect compression by magic bytes
+                filename_noext = os.path.join(dirname, "items_noext")
+                shutil.copy(filename, filename_noext)
+                lines = list(file2iter(filename_noext))
+                assert json.loads(lines[0]) == items[0]
+
+                filename = os.path.join(dirname, "items.json" + ext)
+                json2file(items, filename)
+                assert file2json(filename) == items
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_item_writer(self):
+        import shutil
+        import tempfile
+        items = [{"name": u"张三", "idx": idx} for idx in range(2500)]
+        expected = [json.dumps(item, ensure_ascii=False, sort_keys=True) for item in items]
+        dirname = tempfile.mkdtemp()
+        try:
+            for background in [False, True]:
+                filename = os.path.join(dirname, "items_{}.jsons".format(background))
+                with ItemWriter(filename, batch_size=100, background=background, fsync_every=1000) as writer:
+                    writer.write_items(items)
+                    assert not os.path.exists(filename)
+                assert writer.cnt_item == len(items)
+                assert list(file2iter(filename)) == expected
+
+            # failed job leaves no output
+            filename = os.path.join(dirname, "failed.jsons")
+            try:
+                with ItemWriter(filename, background=True) as writer:
+                    writer.write_items(items)
+                    raise ValueError("failed job")
+            except ValueError:
+                pass
+            assert not [x for x in os.listdir(dirname) if x.startswith("failed") or ".tmp" in x]
+
+            # failed write in close() leaves no output either
+            for background in [False, True]:
+                try:
+                    with ItemWriter(filename, background=background) as writer:
+                        writer.write_items(items + [{"value": object()}])
+                except TypeError:
+                    pass
+                assert writer._closed
+                assert not [x for x in os.listdir(dirname) if x.startswith("failed") or ".tmp" in x]
+
+            # pipes are written in place, never fsynced
+            if os.path.exists("/dev/fd"):
+                fd_read, fd_write = os.pipe()
+                try:
+                    with ItemWriter("/dev/fd/{}".format(fd_write), fsync_every=1, batch_size=1) as writer:
+                        writer.write_items(items[:2])
+                    assert os.read(fd_read, 1000).decode("utf-8").splitlines() == expected[:2]
+                finally:
+                    os.close(fd_read)
+                    os.close(fd_write)
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_json_codec(self):
+        filename = "test_stats_kg1.jsons"
+        filename = file2abspath(filename, __file__)
+        for line in file2iter(filename):
+            item = json.loads(line)
+            assert json_loads(line) == item
+            assert json_dumps(item) == json.dumps(item, ensure_ascii=False, sort_keys=True)
+            assert json_dumps(item, ensure_ascii=True) == json.dumps(item, sort_keys=True)
+
+        assert json_loads('{"id": 12345678901234567890123}')["id"] == 12345678901234567890123
+        assert json_loads(u'{"id": -9223372036854775809, "name": "张三"}')["id"] == -9223372036854775809
+        from kgtool.core import _json_has_bigint
+        assert not _json_has_bigint(u'{"date": "2019-01-01", "tel": "010-12345678", "name": "张三"}')
+
+        codec = JsonCodec("json")
+        assert codec.loads_name == "json"
+        assert codec.dumps_name == "json"
+
     def test_json_get(self):
 
         json_data = {"a": {"b": 1}, "c": ["d"], "e": "f"}
@@ -65,6 +183,33 @@ class CoreTestCase(unittest.TestCase):
         assert json_get(
             json_data, ["birthPlace", "name"], default="n/a") is None
 
+    def test_json_path_projector(self):
+        json_data_list = [
+            {"a": {"b": 1}, "c": ["d"], "e": "f"},
+            {"father": {"name": "john", "father": {"name": "bob"}}, "birthPlace": "Beijing"},
+            {"father": "john"},
+            [],
+            {},
+        ]
+        paths = [["a"], ["k"], ["a", "b"], ["a", "k"], ["c", "d"], ["e", "k"], ["c"],
+                 ["father", "name"], ["father", "image"], ["father", "father", "name"],
+                 ["birthPlace"], ["birthPlace", "name"], ["father"]]
+        for default in [None, 10]:
+            projector = JsonPathProjector(paths, default=default)
+            rows = list(projector.project_items(json_data_list))
+            for json_data, row in zip(json_data_list, rows):
+                expected = tuple([json_get(json_data, path, default) for path in paths])
+                assert row == expected, (json_data, row, expected)
+
+        projector = JsonPathProjector(["father.name", "birthPlace"])
+        columns = projector.project_columns(json_data_list)
+        assert list(columns.keys()) == ["father.name", "birthPlace"]
+        assert columns["father.name"] == [None, "john", None, None, None]
+
+        batches = list(projector.iter_columns(json_data_list, batch_size=2))
+        assert len(batches) == 3
+        assert batches[2]["birthPlace"] == [None]
+
     def test_json_get_list(self):
 
         json_data = {
@@ -178,6 +323,109 @@ class CoreTestCase(unittest.TestCase):
         tout = any2sha1(tin)
         assert "d3b09abe30cfe2edff4ee9e0a141c93bf5b3af87" == tout, tout
 
+    def test_canonical_hasher(self):
+        items = [
+            "你好世界",
+            ["hello", "world"],
+            ["hello", 1],
+            {"hello": "world"},
+            {"b": [1, 2.5, None, True, False], "a": {"y": "你好", "x": [{"z": -1}]}},
+            [],
+            {},
+            0,
+            1.0e100,
+            [float("inf"), float("nan")],
+        ]
+        for algorithm in ["sha1", "sha256"]:
+            expected = []
+            for item in items:
+                expected.append(hashlib.new(algorithm, any2text(item)).hexdigest())
+            for streaming in [True, False]:
+                hasher = CanonicalHasher(algorithm, cache_size=2, streaming=streaming)
+                # twice, second pass hits the cache
+                assert expected == hasher.hash_items(items), algorithm
+                assert expected == hasher.hash_items(items), algorithm
+            assert expected == hasher.hash_items(items, workers=2), algorithm
+
+        # streamed piece by piece, the json text is never built in one piece
+        chunks = []
+        data = {"items": items * 100}
+        CanonicalHasher()._encode(data, chunks.append)
+        assert b"".join(chunks) == any2text(data)
+        assert max([len(x) for x in chunks]) < 100
+
+        assert any2sha1_batch(["hello world", ["hello", "world"]]) == [
+            "2aae6c35c94fcfb415dbe95f408b9ce91ee846ed",
+            "2ed0a51bbdbc4f57378e8c64a1c7a0cd4386cc09"]
+        assert any2sha256_batch(["你好世界"]) == [
+            "beca6335b20ff57ccc47403ef4d9e0b8fccb4442b3151c2e7d50050673d43172"]
+
+    def test_task_profiler(self):
+        def _work():
+            with profile_stage("outer"):
+                for idx in range(3):
+                    with profile_stage("inner"):
+                        sorted(range(1000), reverse=True)
+
+        # no-op unless the timer profiler is running
+        _work()
+        assert len(PROFILE_TIMER.stages) == 0
+
+        profiler = TaskProfiler(["timer", "cprofile"])
+        profiler.start()
+        _work()
+        profiler.stop()
+        ret = profiler.report("test")
+        assert ret["task"] == "test"
+        assert ret["stages"]["outer"]["count"] == 1
+        assert ret["stages"]["outer/inner"]["count"] == 3
+        assert ret["cprofile"]["top"]
+        assert "dump_file" not in ret["cprofile"]
+        json_dumps(ret)
+
+        with self.assertRaises(Exception):
+            TaskProfiler(["unknown"])
+
+    def test_item2flatstr(self):
+        item = {"a": {"b": 1, "c": [], "d": ["x"]}, "e": " null ", "f": "  y "}
+        ret = item2flatstr("", item, {})
+        assert ret == {"a.b": "1", "a.d": '["x"]', "f": "y"}, ret
+        assert item2flatstr("", {}, {}) is None
+
+        # deeper than the recursion limit
+        item = {}
+        temp = item
+        for idx in range(sys.getrecursionlimit() + 10):
+            temp["k"] = {}
+            temp = temp["k"]
+        temp["k"] = "v"
+        ret = item2flatstr("", item, {})
+        assert list(ret.values()) == ["v"]
+
+    def test_items2flatcolumns(self):
+        items = [{"a": {"b": "1"}}, None, {"c": "2", "a": {"b": "3"}}]
+        columns = items2flatcolumns(items)
+        assert list(columns.keys()) == ["a.b", "c"], columns
+        assert columns["a.b"] == ["1", "", "3"]
+        assert columns["c"] == ["", "", "2"]
+
+        rows = flatcolumns2rows(columns)
+        assert rows[2] == {"a.b": "3", "c": "2"}, rows
+        assert len(rows) == 3
+
+    def test_lru_cache(self):
+        cache = LruCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        assert cache.get("a") == 1
+        cache.put("c", 3)
+        assert "b" not in cache
+        assert cache.get("b") is None
+        assert len(cache) == 2
+        assert cache.stats["hit"] == 1
+        assert cache.stats["miss"] == 1
+        assert cache.hit_rate() == 0.5
+
     def test_json_dict_copy(self):
         property_list = [
             { "name":"name", "alternateName": ["name","title"]},
@@ -195,6 +443,41 @@ class CoreTestCase(unittest.TestCase):
         ret = parse_list_value(u"原文，正文")
         assert len(ret) == 2
 
+    def test_value_normalizer(self):
+        normalizer = ValueNormalizer(cache_size=10)
+        ret = normalizer.parse_list_value(u"a, b；c")
+        assert ret == ["a", "b", "c"], ret
+        # cached result is not shared with the caller
+        ret.append("d")
+        assert normalizer.parse_list_value(u"a, b；c") == ["a", "b", "c"]
+        assert normalizer.parse_list_value(u"a|b", regex=r"\|") == ["a", "b"]
+        assert normalizer.parse_list_value([u"a", " c "]) == ["a", "c"]
+
+        values = [" x ", "null", " -. ", "", 3, [], {"a": 1}, None, " x "]
+        expected = ["x", None, None, None, "3", None, {"a": 1}, None, "x"]
+        assert [normalizer.normalize_value(v) for v in values] == expected
+        assert [normalizer.is_empty_string(v) for v in [None, " ", "a"]] == [True, True, False]
+
+        stats = normalizer.stats()
+        assert stats["parse_list_value"]["hit"] == 1, stats
+        assert stats["normalize_value"]["hit"] == 1, stats
+
+    def test_external_sorter(self):
+        import random
+        rand = random.Random(0)
+        lines = [u"{},张三\n{}".format(rand.randint(0, 50), idx % 7) for idx in range(200)]
+        lines.extend([u"", u"\"a,b\"", u"# x"])
+        with ExternalSorter(buffer_size=16) as sorter:
+            sorter.extend(lines)
+            runs = list(sorter._runs)
+            assert len(runs) == 12
+            assert list(sorter) == sorted(lines)
+        assert not [filename for filename in runs if os.path.exists(filename)]
+
+        with ExternalSorter() as sorter:
+            sorter.extend(lines)
+            assert list(sorter) == sorted(lines)
+
 
 
 
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Path hack
+import os
+import sys
+import shutil
+import tempfile
+sys.path.insert(0, os.path.abspath('..'))
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from kgtool.core import *  # noqa
+from kgtool.jsons_index import *  # noqa
+
+
+class JsonsIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, "items.jsons")
+        self.items = [{"@id": u"id{}".format(idx), "name": u"张三{}".format(idx)} for idx in range(100)]
+        lines = [u"# comment", u""]
+        lines.extend([json_dumps(item) for item in self.items])
+        lines.append(json_dumps({"name": u"no id"}))
+        lines2file(lines, self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_lookup(self):
+        with JsonsIndex(self.filename) as index:
+            assert len(index) == 101
+            assert os.path.exists(index.index_filename)
+            expected = list(file2iter(self.filename))
+            for line_number in [0, 50, 100]:
+                assert index.get_line(line_number) == expected[line_number]
+
+            assert index.get_item_by_id(u"id42") == self.items[42]
+            assert index.get_item_by_id(u"id100") is None
+
+    def test_build_chunks(self):
+        items = [{"@id": 42}, {"@id": [u"id1"]}, {"@id": u"id7"}]
+        items2file(items, self.filename, modifier="a")
+        index = JsonsIndex(self.filename)
+        index.build()
+        with JsonsIndex(self.filename, index_filename=self.filename + ".idx2", chunk_size=7) as index_chunked:
+            assert list(index_chunked.id_hashes) == list(index.id_hashes)
+            assert list(index_chunked.id_offsets) == list(index.id_offsets)
+            # @id that is not a string is skipped
+            assert len(index_chunked.id_hashes) == 101
+            assert index_chunked.get_items_by_id(u"id7") == [self.items[7], items[2]]
+
+    def test_invalidate(self):
+        index = JsonsIndex(self.filename)
+        assert not index.load()
+        index.build()
+        assert index.load()
+
+        items2file([{"@id": u"new"}], self.filename, modifier="a")
+        index = JsonsIndex(self.filename)
+        assert not index.load()
+
+        with JsonsIndex(self.filename) as index:
+            assert len(index) == 102
+            assert index.get_item_by_id(u"new") == {"@id": u"new"}
+
+    def test_id_hash_set(self):
+        for bloom_error_rate in [None, 0.01]:
+            id_set = IdHashSet(bloom_error_rate=bloom_error_rate, chunk_size=7)
+            for item in self.items + self.items[:10]:
+                id_set.add(item["@id"])
+            id_set.freeze()
+            assert len(id_set) == 100
+            assert list(id_set.hashes) == sorted(id_set.hashes)
+            assert u"id42" in id_set
+            assert u"id100" not in id_set
+
+            filename = os.path.join(self.dirname, "items.ids")
+            id_set.save(filename)
+            id_set = IdHashSet(bloom_error_rate=bloom_error_rate).load(filename)
+            assert u"id99" in id_set
+            assert u"张三" not in id_set
+
+        bloom = BloomFilter(1000, 0.01)
+        for idx in range(1000):
+            bloom.add_hash(id2hash64(u"id{}".format(idx)))
+        assert all([bloom.contains_hash(id2hash64(u"id{}".format(idx))) for idx in range(1000)])
+        assert sum([bloom.contains_hash(id2hash64(u"x{}".format(idx))) for idx in range(1000)]) < 50
+
+
+if __name__ == '__main__':
+    unittest.main()
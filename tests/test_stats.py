@@ -63,6 +63,50 @@ class CoreTestCase(unittest.TestCase):
         assert len(wm["count"]) == 37, len(wm["count"])
         assert len(wm["sample"]) == 35, len(wm["sample"])
 
+    def test_stat_json_path_merge(self):
+        tin = "test_stats_kg1.jsons"
+        tin = file2abspath(tin, __file__)
+
+        wm_serial = {
+            "count":collections.Counter(),
+            "unique":collections.Counter(),
+            "sample": collections.defaultdict(list),
+            "distribution": collections.defaultdict(dict),
+        }
+        for line in file2iter(tin):
+            stat_json_path(json.loads(line), "", wm_serial)
+
+        wm = {
+            "count":collections.Counter(),
+            "unique":collections.Counter(),
+            "sample": collections.defaultdict(list),
+            "distribution": collections.defaultdict(dict),
+        }
+        for shard in file2shards(tin, 2):
+            wm_shard = {
+                "count":collections.Counter(),
+                "unique":collections.Counter(),
+                "sample": collections.defaultdict(list),
+                "distribution": collections.defaultdict(dict),
+            }
+            for line in file2iter4shard(tin, shard):
+                stat_json_path(json.loads(line), "", wm_shard)
+            stat_json_path_merge(wm, wm_shard)
+
+        assert wm["count"] == wm_serial["count"]
+        assert wm["sample"] == wm_serial["sample"]
+
+        # a value repeated across shards is one unique value
+        from kgtool.stats import _stat_json_path_init
+        wm = _stat_json_path_init()
+        for items in [[{"a": "x"}, {"a": "y"}], [{"a": "x"}, {"a": "z"}]]:
+            wm_shard = _stat_json_path_init()
+            for item in items:
+                stat_json_path(item, "", wm_shard)
+            stat_json_path_merge(wm, wm_shard)
+        assert wm["unique"]["a"] == 3
+        assert wm["distribution"]["a"] == {"x": 2, "y": 1, "z": 1}
+
     def test_stat_jsonld(self):
         tin = "test_stats_kg1.jsonld"
         tout = file2abspath(tin, __file__)